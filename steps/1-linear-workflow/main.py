@@ -1,8 +1,10 @@
+import hashlib
 import logging
 import operator
 import os
 import random
 import readline
+import sys
 from typing import Annotated, Literal
 
 from dotenv import load_dotenv
@@ -10,6 +12,7 @@ from langchain_community.document_loaders import WikipediaLoader
 from langchain_community.tools import TavilySearchResults
 from langchain_core.messages import HumanMessage, SystemMessage
 from langchain_core.runnables import RunnableConfig
+from langchain_core.runnables.graph import MermaidDrawMethod
 from langchain_openai import ChatOpenAI
 from langgraph.graph import END, START, StateGraph
 from langgraph.types import Command
@@ -242,14 +245,47 @@ builder.add_edge("closure", END)
 # Possible Exercise: add a cache to the graph
 graph = builder.compile()
 
-# Generate the PNG byte data
-png_data = graph.get_graph().draw_mermaid_png()
 
-# Save the PNG data to a file in the same directory than this script
-script_dir = os.path.dirname(os.path.abspath(__file__))
-file_path = os.path.join(script_dir, "langgraph_mermaid_graph.png")
-with open(file_path, "wb") as f:
-    f.write(png_data)
+def draw_graph(local: bool = False) -> None:
+    """
+    Save the graph as a PNG in the same directory than this script.
+
+    Run with `python main.py --draw-graph`, add `--local` to render with a local browser (pyppeteer)
+    instead of the remote mermaid.ink API.
+    The PNG is only rendered again when the graph topology changes,
+    a hash of the Mermaid source is kept next to it.
+    """
+    mermaid_graph = graph.get_graph()
+    mermaid_hash = hashlib.sha256(mermaid_graph.draw_mermaid().encode()).hexdigest()
+
+    script_dir = os.path.dirname(os.path.abspath(__file__))
+    file_path = os.path.join(script_dir, "langgraph_mermaid_graph.png")
+    hash_path = file_path + ".sha256"
+    if os.path.exists(file_path) and os.path.exists(hash_path):
+        with open(hash_path) as f:
+            if f.read().strip() == mermaid_hash:
+                logging.info("Graph unchanged, PNG not rendered again.")
+                return
+
+    # Generate the PNG byte data
+    try:
+        png_data = mermaid_graph.draw_mermaid_png(
+            draw_method=MermaidDrawMethod.PYPPETEER if local else MermaidDrawMethod.API
+        )
+    except ImportError:
+        # pyppeteer is optional, only needed by --local
+        logging.error(
+            "Rendering with --local needs pyppeteer, install it with `uv sync --extra local-graph`"
+            " (it downloads Chromium on its first run), or render with mermaid.ink without --local."
+        )
+        return
+
+    # Save the PNG data to a file in the same directory than this script
+    with open(file_path, "wb") as f:
+        f.write(png_data)
+    with open(hash_path, "w") as f:
+        f.write(mermaid_hash + "\n")
+    logging.info(f"Graph saved to {file_path}.")
 
 
 def run_graph(question):
@@ -287,6 +323,10 @@ def complete(text, state):
 
 
 if __name__ == "__main__":
+    if "--draw-graph" in sys.argv:
+        draw_graph(local="--local" in sys.argv)
+        exit(0)
+
     print("Welcome to the Osedea Workshop on Agent demo!")
     print()
     print("Here are some examples of questions you can ask (autocomplete with tab):")
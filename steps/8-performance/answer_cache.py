@@ -0,0 +1,161 @@
+import threading
+import time
+from collections import OrderedDict
+from dataclasses import dataclass
+
+import numpy as np
+
+from embeddings import Embedder
+from search_cache import normalize_question
+
+
+@dataclass(frozen=True)
+class AnswerCacheHit:
+    """An answer found in the cache for a similar question"""
+
+    answer: str
+    question: str
+    """The question the answer was generated for"""
+    run_id: str
+    """The run that generated the answer"""
+    similarity: float
+    """The cosine similarity between the two questions"""
+
+
+@dataclass
+class _Entry:
+    question: str
+    answer: str
+    run_id: str
+    vector: np.ndarray
+    created_at: float
+    size: int
+    ttl: float | None
+    """The TTL of this answer, the one of the cache if None"""
+
+
+class SemanticAnswerCache:
+    """
+    The good answers, found again for questions with a similar embedding.
+
+    - Each user has its own answers, an answer is never returned to another user.
+    - An answer expires after the TTL, or after its own shorter TTL (e.g. found on the web).
+    - The least recently used answers are evicted over max_entries or max_bytes.
+    """
+
+    def __init__(
+        self,
+        embedder: Embedder,
+        threshold: float = 0.9,
+        ttl: float | None = None,
+        max_entries: int = 1024,
+        max_bytes: int = 16 * 1024 * 1024,
+    ):
+        self.embedder = embedder
+        """The embedder of the questions"""
+        self.threshold = threshold
+        """The minimum cosine similarity between two questions to share an answer"""
+        self.ttl = ttl
+        """Time to live of an answer in seconds. If None, answers never expire."""
+        self.max_entries = max_entries
+        """Maximum number of answers, all users together"""
+        self.max_bytes = max_bytes
+        """Maximum size of the answers and their vectors, all users together"""
+        self.hits = 0
+        """Number of questions answered from the cache"""
+        self.misses = 0
+        """Number of questions that needed a run of the graph"""
+        self._entries: OrderedDict[tuple[str, int], _Entry] = OrderedDict()
+        self._users: dict[str, dict[int, _Entry]] = {}
+        # The stacked vectors of each user, built again after a change
+        self._matrices: dict[str, tuple[list[int], np.ndarray]] = {}
+        self._size = 0
+        self._next_id = 0
+        self._lock = threading.Lock()
+
+    def get(self, user_id: str, question: str) -> AnswerCacheHit | None:
+        """Return the answer of the most similar question of the user, if similar enough"""
+        vector = self.embedder.embed([normalize_question(question)])[0]
+        with self._lock:
+            self._expire(user_id)
+            if user_id in self._users:
+                ids, matrix = self._matrix(user_id)
+                similarities = matrix @ vector
+                best = int(np.argmax(similarities))
+                if similarities[best] >= self.threshold:
+                    key = (user_id, ids[best])
+                    self._entries.move_to_end(key)
+                    entry = self._entries[key]
+                    self.hits += 1
+                    return AnswerCacheHit(
+                        answer=entry.answer,
+                        question=entry.question,
+                        run_id=entry.run_id,
+                        similarity=float(similarities[best]),
+                    )
+            self.misses += 1
+            return None
+
+    def set(
+        self, user_id: str, question: str, answer: str, run_id: str, ttl: float | None = None
+    ) -> None:
+        """Store a good answer of the user, for ttl seconds if shorter than the TTL of the cache"""
+        if ttl is not None and self.ttl is not None and ttl >= self.ttl:
+            ttl = None
+        vector = self.embedder.embed([normalize_question(question)])[0]
+        entry = _Entry(
+            question=question,
+            answer=answer,
+            run_id=run_id,
+            vector=vector,
+            created_at=time.time(),
+            size=len(answer.encode()) + len(question.encode()) + vector.nbytes,
+            ttl=ttl,
+        )
+        with self._lock:
+            entry_id = self._next_id
+            self._next_id += 1
+            self._entries[(user_id, entry_id)] = entry
+            self._users.setdefault(user_id, {})[entry_id] = entry
+            self._matrices.pop(user_id, None)
+            self._size += entry.size
+            while self._entries and (
+                len(self._entries) > self.max_entries or self._size > self.max_bytes
+            ):
+                self._delete(*next(iter(self._entries)))
+
+    def stats(self) -> dict:
+        """Hit/miss counters and size, to follow the hit rate"""
+        lookups = self.hits + self.misses
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / lookups if lookups else 0.0,
+            "entries": len(self._entries),
+            "bytes": self._size,
+        }
+
+    # The private methods are called with the lock held.
+    def _matrix(self, user_id: str) -> tuple[list[int], np.ndarray]:
+        if user_id not in self._matrices:
+            entries = self._users[user_id]
+            self._matrices[user_id] = (
+                list(entries),
+                np.stack([entry.vector for entry in entries.values()]),
+            )
+        return self._matrices[user_id]
+
+    def _expire(self, user_id: str) -> None:
+        now = time.time()
+        for entry_id, entry in list(self._users.get(user_id, {}).items()):
+            ttl = self.ttl if entry.ttl is None else entry.ttl
+            if ttl is not None and now - entry.created_at > ttl:
+                self._delete(user_id, entry_id)
+
+    def _delete(self, user_id: str, entry_id: int) -> None:
+        entry = self._entries.pop((user_id, entry_id))
+        self._size -= entry.size
+        del self._users[user_id][entry_id]
+        if not self._users[user_id]:
+            del self._users[user_id]
+        self._matrices.pop(user_id, None)
@@ -0,0 +1,87 @@
+import re
+from typing import Literal
+
+REFUSAL_PHRASES = [
+    "I'm sorry",
+    "I couldn't find",
+    "I don't know",
+    "I can't answer",
+    "I don't have enough information",
+    "I need more context",
+    "I need more information",
+    "I need more details",
+    "I need more data",
+]
+"""The phrases making an answer bad, the same as in the check_answer_quality template"""
+
+HEDGE_PATTERNS = [
+    r"\bsorry\b",
+    r"\bi (?:do not|cannot|can not|could not|am unable to|was unable to)\b",
+    r"\bunable to\b",
+    r"\bnot sure\b",
+    r"\bno (?:information|results?|data)\b",
+    r"\bnot (?:enough|sufficient) (?:information|context|details|data)\b",
+]
+"""Close to a refusal without being one of the phrases, the LLM has to decide"""
+
+ANSWER_MIN_LENGTH = 2
+"""An answer shorter than this (in characters) is left to the LLM"""
+
+
+def normalize_answer(text: str) -> str:
+    """Lowercase, straight apostrophes and single spaces, to match the phrases in any form"""
+    text = text.lower().replace("’", "'").replace("‘", "'")
+    return re.sub(r"\s+", " ", text).strip()
+
+
+# One regular expression for all the phrases, the answer is scanned once.
+REFUSAL_REGEX = re.compile(
+    "|".join(re.escape(normalize_answer(phrase)) for phrase in REFUSAL_PHRASES)
+)
+HEDGE_REGEX = re.compile("|".join(HEDGE_PATTERNS))
+
+
+def classify_answer(text: str) -> Literal["good", "bad"] | None:
+    """
+    Classify the answer without the LLM.
+
+    Return "bad" if the answer contains a refusal phrase,
+    "good" if it is clearly not a refusal,
+    and None when it is ambiguous and the LLM has to check it.
+    """
+    answer = normalize_answer(text)
+    if REFUSAL_REGEX.search(answer):
+        return "bad"
+    if len(answer) < ANSWER_MIN_LENGTH or HEDGE_REGEX.search(answer):
+        return None
+    return "good"
+
+
+REFUSAL_MAX_LENGTH = max(len(normalize_answer(phrase)) for phrase in REFUSAL_PHRASES)
+"""The length of the longest refusal phrase, a phrase can be split across chunks"""
+
+
+class RefusalDetector:
+    """
+    Find a refusal phrase in an answer while it is generated, chunk by chunk.
+
+    Only the end of the previous chunks is kept and scanned again with the new chunk,
+    the whole answer is not normalized again at each token.
+    """
+
+    def __init__(self):
+        self.found = False
+        """True once a refusal phrase was found"""
+        self.length = 0
+        """The number of characters read so far"""
+        self._tail = ""
+
+    def feed(self, text: str) -> bool:
+        """Read the next chunk of the answer, return True if the answer is a refusal"""
+        self.length += len(text)
+        # Raw characters, twice the phrase length leaves room for the extra spaces
+        window = self._tail + text
+        self._tail = window[-2 * REFUSAL_MAX_LENGTH :]
+        if REFUSAL_REGEX.search(normalize_answer(window)):
+            self.found = True
+        return self.found
@@ -0,0 +1,176 @@
+"""
+Replay many questions through the graph, for evaluations and backfills.
+
+Usage:
+    python batch.py questions.jsonl results.jsonl --concurrency 8 --mode async
+
+Each line of the input is a JSON object with a "question",
+and optionally a "user_id" and a "session_id" used for the Langfuse traces.
+A line can also be a plain JSON string, the question itself.
+The other fields of the input line are copied to the result line, e.g. an "id".
+A question that fails, or a malformed line, is written with an "error", the batch goes on.
+The checkpoints of a failed run are kept, it can be resumed with its "run_id".
+
+Each line of the output is written as soon as its question is answered,
+so the results are not in the input order.
+"""
+
+import argparse
+import asyncio
+import json
+import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from typing import IO, Iterable, Iterator
+
+from main import finish_run, graph, langfuse_handler, prefetches, prepare_run
+
+BATCH_CONCURRENCY = 8
+"""The maximum number of questions running at the same time"""
+
+
+def read_questions(path: str) -> Iterator[dict]:
+    """
+    Read the questions from a JSONL file, lazily.
+
+    A line that is not JSON is passed on as is, it fails and is written with its error.
+    """
+    with open(path) as f:
+        for number, line in enumerate(f, start=1):
+            if line.strip():
+                try:
+                    item = json.loads(line)
+                except ValueError:
+                    yield {"line": number, "input": line.strip()}
+                    continue
+                yield item if isinstance(item, dict) else {"question": item}
+
+
+def prepare_item(item: dict | str) -> tuple[dict, str, dict, dict]:
+    """Prepare the graph input and config for a question of the batch"""
+    if isinstance(item, str):
+        item = {"question": item}
+    if not isinstance(item.get("question"), str) or not item["question"].strip():
+        raise ValueError("The line must be a JSON object with a question, or a JSON string")
+    run_id, initial_state, config = prepare_run(
+        item["question"], user_id=item.get("user_id"), session_id=item.get("session_id")
+    )
+    return item, run_id, initial_state, config
+
+
+def result_record(item: dict, run_id: str, config: dict, result_state: dict) -> dict:
+    """The line written in the output for an answered question"""
+    answer = result_state["answer"]
+    return {
+        **item,
+        "user_id": config["metadata"]["langfuse_user_id"],
+        "session_id": config["metadata"]["langfuse_session_id"],
+        "run_id": run_id,
+        "answer": getattr(answer, "content", answer),
+        "steps_history": result_state["steps_history"],
+        "llm_calls": result_state["llm_calls"],
+        "llm_calls_saved": result_state["llm_calls_saved"],
+    }
+
+
+def error_record(item: dict | str, run_id: str | None, error: Exception) -> dict:
+    """
+    The line written in the output for a question that failed, the batch goes on.
+
+    The run ID is None when the question could not be prepared (e.g. a malformed line).
+    """
+    if isinstance(item, str):
+        item = {"question": item}
+    logging.exception(f"Question failed: {item.get('question', item)}")
+    return {**item, "run_id": run_id, "error": repr(error)}
+
+
+def run_batch(
+    questions: Iterable[dict | str], output: IO[str], concurrency: int = BATCH_CONCURRENCY
+) -> int:
+    """
+    Run the questions with a pool of threads, each one calling graph.invoke.
+
+    The questions are consumed lazily, only `concurrency` questions are in flight.
+    Return the number of questions answered.
+    """
+    iterator = iter(questions)
+    lock = threading.Lock()
+    count = 0
+
+    def worker():
+        nonlocal count
+        while True:
+            with lock:
+                item = next(iterator, None)
+            if item is None:
+                return
+            run_id = None
+            try:
+                item, run_id, initial_state, config = prepare_item(item)
+                result_state = graph.invoke(initial_state, config)
+                finish_run(run_id, item["question"], config, result_state)
+                record = result_record(item, run_id, config, result_state)
+            except Exception as e:
+                # The checkpoints are kept to resume the run, not its prefetched searches
+                prefetches.cancel(run_id)
+                record = error_record(item, run_id, e)
+            with lock:
+                output.write(json.dumps(record) + "\n")
+                output.flush()
+                count += 1
+
+    with ThreadPoolExecutor(max_workers=concurrency, thread_name_prefix="batch") as pool:
+        for _ in range(concurrency):
+            pool.submit(worker)
+
+    if langfuse_handler.initialized:
+        langfuse_handler.get().flush()
+    return count
+
+
+async def arun_batch(
+    questions: Iterable[dict | str], output: IO[str], concurrency: int = BATCH_CONCURRENCY
+) -> int:
+    """Same as run_batch, with tasks calling graph.ainvoke on the event loop"""
+    iterator = iter(questions)
+    count = 0
+
+    async def worker():
+        nonlocal count
+        for item in iterator:
+            run_id = None
+            try:
+                item, run_id, initial_state, config = prepare_item(item)
+                result_state = await graph.ainvoke(initial_state, config)
+                finish_run(run_id, item["question"], config, result_state)
+                record = result_record(item, run_id, config, result_state)
+            except Exception as e:
+                # The checkpoints are kept to resume the run, not its prefetched searches
+                prefetches.cancel(run_id)
+                record = error_record(item, run_id, e)
+            output.write(json.dumps(record) + "\n")
+            output.flush()
+            count += 1
+
+    await asyncio.gather(*(worker() for _ in range(concurrency)))
+
+    if langfuse_handler.initialized:
+        langfuse_handler.get().flush()
+    return count
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Run a batch of questions through the graph.")
+    parser.add_argument("input", help="JSONL file with the questions")
+    parser.add_argument("output", help="JSONL file for the results")
+    parser.add_argument("--concurrency", type=int, default=BATCH_CONCURRENCY)
+    parser.add_argument("--mode", choices=["async", "threads"], default="async")
+    args = parser.parse_args()
+
+    with open(args.output, "w") as output:
+        if args.mode == "async":
+            count = asyncio.run(arun_batch(read_questions(args.input), output, args.concurrency))
+        else:
+            count = run_batch(read_questions(args.input), output, args.concurrency)
+    logging.info(f"{count} questions answered, results in {args.output}.")
@@ -0,0 +1,173 @@
+"""
+Small benchmarks of the step 8 optimizations.
+
+Usage:
+    python benchmarks.py import
+    python benchmarks.py chains
+    python benchmarks.py checkpoints
+    python benchmarks.py tracing
+"""
+
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+import timeit
+
+BENCHMARK_REPEAT = 5
+"""The number of measures per benchmark, the median is reported"""
+
+
+def benchmark_import() -> None:
+    """Time to import main (what every CLI call, test or worker pays), then to warm up the clients"""
+    script_dir = os.path.dirname(os.path.abspath(__file__))
+    code = (
+        "import time\n"
+        "start = time.perf_counter()\n"
+        "import main\n"
+        "imported = time.perf_counter()\n"
+        "main.clients.warm_up()\n"
+        "print(imported - start, time.perf_counter() - imported)\n"
+    )
+    imports, warm_ups = [], []
+    for _ in range(BENCHMARK_REPEAT):
+        output = subprocess.run(
+            [sys.executable, "-c", code],
+            cwd=script_dir,
+            capture_output=True,
+            text=True,
+            check=True,
+        ).stdout
+        import_time, warm_up_time = map(float, output.split())
+        imports.append(import_time)
+        warm_ups.append(warm_up_time)
+    print(f"import main: {statistics.median(imports) * 1000:.0f} ms")
+    print(f"clients warm up: {statistics.median(warm_ups) * 1000:.0f} ms")
+
+
+def benchmark_chains() -> None:
+    """Per call overhead to get the generate_answer chain, rebuilt each time or from the registry"""
+    from langchain_core.language_models.fake_chat_models import FakeListChatModel
+    from langfuse.model import Prompt_Text, TextPromptClient  # type: ignore
+    from prompts import ChainRegistry, PromptCache, compile_prompt
+
+    langfuse_prompt = TextPromptClient(
+        Prompt_Text(
+            name="research-wikipedia-tavily-kind",
+            version=1,
+            prompt="You are kind.\nYou are a searcher that will use Wikipedia and Tavily search "
+            "to answer the question: {{question}}, using this context: {{context}}.",
+            config={},
+            labels=["production"],
+            tags=[],
+        )
+    )
+    llm = FakeListChatModel(responses=["ok"])
+    registry = ChainRegistry(PromptCache(lambda name: langfuse_prompt), lambda: llm)
+
+    def rebuild():
+        return compile_prompt(langfuse_prompt).template | llm
+
+    def reuse():
+        return registry.get(langfuse_prompt.name)
+
+    calls = 2000
+    for name, function in [("rebuilt per call", rebuild), ("chain registry", reuse)]:
+        seconds = min(timeit.repeat(function, number=calls, repeat=BENCHMARK_REPEAT))
+        print(f"{name}: {seconds / calls * 1_000_000:.1f} µs per call")
+
+
+def benchmark_checkpoints() -> None:
+    """Per step overhead of the checkpointers, on a graph of 10 steps carrying documents"""
+    import operator
+    from typing import Annotated
+
+    from checkpoints import SqliteCheckpointSaver
+    from context import ContextDocument
+    from langgraph.checkpoint.memory import InMemorySaver
+    from langgraph.graph import END, START, StateGraph
+    from typing_extensions import TypedDict
+
+    steps = 10
+
+    class State(TypedDict):
+        context: Annotated[list, operator.add]
+
+    def search(state: State) -> dict:
+        document = ContextDocument(
+            url=f"https://example.com/{len(state['context'])}",
+            title="Example",
+            content="Some content of a search result. " * 30,
+            source_tool="search_web",
+        )
+        return {"context": [document]}
+
+    builder = StateGraph(State)
+    builder.add_node("search", search)
+    builder.add_edge(START, "search")
+    builder.add_conditional_edges(
+        "search", lambda state: END if len(state["context"]) >= steps else "search"
+    )
+
+    with tempfile.TemporaryDirectory() as directory:
+        checkpointers = [
+            ("no checkpointer", None),
+            ("memory", InMemorySaver()),
+            ("sqlite", SqliteCheckpointSaver(os.path.join(directory, "checkpoints.sqlite"))),
+        ]
+        runs = 50
+        for name, checkpointer in checkpointers:
+            graph = builder.compile(checkpointer=checkpointer)
+            count = iter(range(runs * BENCHMARK_REPEAT))
+
+            def run():
+                config = {"configurable": {"thread_id": str(next(count))}}
+                graph.invoke({"context": []}, config)
+
+            seconds = min(timeit.repeat(run, number=runs, repeat=BENCHMARK_REPEAT))
+            print(f"{name}: {seconds / runs / steps * 1_000_000:.0f} µs per step")
+
+
+def benchmark_tracing() -> None:
+    """Per call overhead of the tracing of a chain: off, recorded (tail sampling), or traced"""
+    import logging
+
+    from langchain_core.language_models.fake_chat_models import FakeListChatModel
+    from langchain_core.prompts import ChatPromptTemplate
+    from langfuse.callback import CallbackHandler
+    from tracing import RunTracer
+
+    # Nothing listens there, the events are dropped by the background thread of Langfuse
+    handler = CallbackHandler(
+        public_key="pk", secret_key="sk", host="http://127.0.0.1:9", max_retries=1, timeout=1
+    )
+    # After the handler, the Langfuse client sets its own log level
+    logging.getLogger("langfuse").setLevel(logging.CRITICAL)
+    chain = ChatPromptTemplate.from_template("Answer {question}") | FakeListChatModel(
+        responses=["Paris is the capital of France."]
+    )
+
+    calls = 200
+    for name, sampling in [("off", None), ("recorded", "tail"), ("traced", "head")]:
+
+        def run():
+            tracer = RunTracer(sampling, lambda: handler) if sampling else None
+            chain.invoke({"question": "?"}, config={"callbacks": [tracer] if tracer else []})
+
+        seconds = min(timeit.repeat(run, number=calls, repeat=BENCHMARK_REPEAT))
+        print(f"{name}: {seconds / calls * 1_000_000:.0f} µs per call")
+    handler.langfuse.shutdown()
+
+
+BENCHMARKS = {
+    "import": benchmark_import,
+    "chains": benchmark_chains,
+    "checkpoints": benchmark_checkpoints,
+    "tracing": benchmark_tracing,
+}
+
+if __name__ == "__main__":
+    names = sys.argv[1:] or list(BENCHMARKS)
+    for name in names:
+        BENCHMARKS[name]()
@@ -0,0 +1,453 @@
+from __future__ import annotations
+
+import atexit
+import logging
+import os
+import sqlite3
+import threading
+import time
+import zlib
+from collections.abc import AsyncIterator, Iterator, Sequence
+from typing import Any
+
+from langchain_core.runnables import RunnableConfig
+from langgraph.checkpoint.base import (
+    WRITES_IDX_MAP,
+    BaseCheckpointSaver,
+    ChannelVersions,
+    Checkpoint,
+    CheckpointMetadata,
+    CheckpointTuple,
+    get_checkpoint_id,
+    get_checkpoint_metadata,
+)
+from langgraph.checkpoint.base.id import UUID
+from langgraph.checkpoint.memory import InMemorySaver
+from langgraph.checkpoint.serde.types import TASKS
+
+CHECKPOINT_FLUSH_SECONDS = 0.1
+"""
+How long the checkpoints wait in memory before being written, all together in one transaction.
+The durability window: the checkpoints of the last CHECKPOINT_FLUSH_SECONDS are lost on a crash.
+"""
+
+CHECKPOINT_TTL_SECONDS = 7 * 24 * 3600
+"""The runs not checkpointed for this long are deleted, e.g. the failed runs never resumed"""
+
+CHECKPOINT_PRUNE_INTERVAL_SECONDS = 3600
+"""How often the runs older than CHECKPOINT_TTL_SECONDS are looked for, while writing"""
+
+CHECKPOINT_COMPRESS_MIN_BYTES = 512
+"""The serialized values bigger than this are compressed"""
+
+COMPRESSED_PREFIX = "zlib:"
+
+
+class SqliteCheckpointSaver(BaseCheckpointSaver[str]):
+    """
+    LangGraph checkpoints stored in a SQLite file, to resume a failed run.
+
+    The layout is the one of InMemorySaver: a row per checkpoint without its channel values,
+    a row per new version of a channel (a step only stores the channels it changed),
+    and a row per write of a task.
+
+    The writes are batched: put() and put_writes() only queue the rows,
+    a background thread writes them CHECKPOINT_FLUSH_SECONDS after the first one,
+    in one transaction. The queue is flushed before any read, and when the process exits.
+    A crash (not an exception of the run, which is checkpointed) loses the rows still queued:
+    the run resumes from an earlier step. With synchronous=NORMAL, a power loss can also
+    lose the last transactions written, not the older ones.
+
+    The runs not checkpointed for ttl_seconds (None to keep them) are deleted
+    at startup, then every CHECKPOINT_PRUNE_INTERVAL_SECONDS while writing.
+    """
+
+    def __init__(self, path: str, ttl_seconds: float | None = CHECKPOINT_TTL_SECONDS, **kwargs):
+        super().__init__(**kwargs)
+        if os.path.dirname(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+        self._connection = sqlite3.connect(path, check_same_thread=False)
+        # WAL: the readers do not wait for the writer, and a commit does not wait for a full sync
+        self._connection.execute("PRAGMA journal_mode=WAL")
+        self._connection.execute("PRAGMA synchronous=NORMAL")
+        self._connection.executescript(
+            "CREATE TABLE IF NOT EXISTS checkpoints ("
+            " thread_id TEXT NOT NULL,"
+            " checkpoint_ns TEXT NOT NULL,"
+            " checkpoint_id TEXT NOT NULL,"
+            " parent_checkpoint_id TEXT,"
+            " type TEXT NOT NULL,"
+            " checkpoint BLOB NOT NULL,"
+            " metadata_type TEXT NOT NULL,"
+            " metadata BLOB NOT NULL,"
+            " PRIMARY KEY (thread_id, checkpoint_ns, checkpoint_id));"
+            "CREATE TABLE IF NOT EXISTS blobs ("
+            " thread_id TEXT NOT NULL,"
+            " checkpoint_ns TEXT NOT NULL,"
+            " channel TEXT NOT NULL,"
+            " version TEXT NOT NULL,"
+            " type TEXT NOT NULL,"
+            " value BLOB NOT NULL,"
+            " PRIMARY KEY (thread_id, checkpoint_ns, channel, version));"
+            "CREATE TABLE IF NOT EXISTS writes ("
+            " thread_id TEXT NOT NULL,"
+            " checkpoint_ns TEXT NOT NULL,"
+            " checkpoint_id TEXT NOT NULL,"
+            " task_id TEXT NOT NULL,"
+            " idx INTEGER NOT NULL,"
+            " channel TEXT NOT NULL,"
+            " type TEXT NOT NULL,"
+            " value BLOB NOT NULL,"
+            " task_path TEXT NOT NULL,"
+            " PRIMARY KEY (thread_id, checkpoint_ns, checkpoint_id, task_id, idx));"
+        )
+        self._connection.commit()
+        self._lock = threading.Lock()
+        self._pending: list[tuple[str, tuple]] = []
+        self._queued = threading.Condition(self._lock)
+        """Notified when rows are queued, the writer sleeps on it meanwhile"""
+        self._writer: threading.Thread | None = None
+        self.ttl_seconds = ttl_seconds
+        self._pruned_at = 0.0
+        self._prune()
+        atexit.register(self.flush)
+
+    # Same versions as InMemorySaver: sortable strings, unique across concurrent runs
+    get_next_version = InMemorySaver.get_next_version
+
+    def flush(self) -> None:
+        """Write the queued checkpoints now"""
+        with self._lock:
+            pending, self._pending = self._pending, []
+            if not pending:
+                return
+            with self._connection:
+                for statement, parameters in pending:
+                    self._connection.execute(statement, parameters)
+
+    def put(
+        self,
+        config: RunnableConfig,
+        checkpoint: Checkpoint,
+        metadata: CheckpointMetadata,
+        new_versions: ChannelVersions,
+    ) -> RunnableConfig:
+        thread_id = config["configurable"]["thread_id"]
+        checkpoint_ns = config["configurable"]["checkpoint_ns"]
+        c = checkpoint.copy()
+        c.pop("pending_sends", None)  # type: ignore[misc]
+        values: dict[str, Any] = c.pop("channel_values")  # type: ignore[misc]
+        rows = []
+        for channel, version in new_versions.items():
+            value_type, value = (
+                self._dumps(values[channel]) if channel in values else ("empty", b"")
+            )
+            rows.append(
+                (
+                    "INSERT OR REPLACE INTO blobs VALUES (?, ?, ?, ?, ?, ?)",
+                    (thread_id, checkpoint_ns, channel, str(version), value_type, value),
+                )
+            )
+        rows.append(
+            (
+                "INSERT OR REPLACE INTO checkpoints VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                (
+                    thread_id,
+                    checkpoint_ns,
+                    checkpoint["id"],
+                    config["configurable"].get("checkpoint_id"),
+                    *self._dumps(c),
+                    *self._dumps(get_checkpoint_metadata(config, metadata)),
+                ),
+            )
+        )
+        self._queue(rows)
+        return {
+            "configurable": {
+                "thread_id": thread_id,
+                "checkpoint_ns": checkpoint_ns,
+                "checkpoint_id": checkpoint["id"],
+            }
+        }
+
+    def put_writes(
+        self,
+        config: RunnableConfig,
+        writes: Sequence[tuple[str, Any]],
+        task_id: str,
+        task_path: str = "",
+    ) -> None:
+        thread_id = config["configurable"]["thread_id"]
+        checkpoint_ns = config["configurable"].get("checkpoint_ns", "")
+        checkpoint_id = config["configurable"]["checkpoint_id"]
+        rows = []
+        for idx, (channel, value) in enumerate(writes):
+            idx = WRITES_IDX_MAP.get(channel, idx)
+            # Like InMemorySaver, a regular write is never replaced, a special one (e.g. an error) is
+            verb = "INSERT OR IGNORE" if idx >= 0 else "INSERT OR REPLACE"
+            rows.append(
+                (
+                    f"{verb} INTO writes VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                    (
+                        thread_id,
+                        checkpoint_ns,
+                        checkpoint_id,
+                        task_id,
+                        idx,
+                        channel,
+                        *self._dumps(value),
+                        task_path,
+                    ),
+                )
+            )
+        self._queue(rows)
+
+    def get_tuple(self, config: RunnableConfig) -> CheckpointTuple | None:
+        thread_id = config["configurable"]["thread_id"]
+        checkpoint_ns = config["configurable"].get("checkpoint_ns", "")
+        query = (
+            "SELECT checkpoint_id, parent_checkpoint_id, type, checkpoint, metadata_type, metadata"
+            " FROM checkpoints WHERE thread_id = ? AND checkpoint_ns = ?"
+        )
+        parameters: tuple = (thread_id, checkpoint_ns)
+        if checkpoint_id := get_checkpoint_id(config):
+            query += " AND checkpoint_id = ?"
+            parameters += (checkpoint_id,)
+        query += " ORDER BY checkpoint_id DESC LIMIT 1"
+
+        self.flush()
+        with self._lock:
+            row = self._connection.execute(query, parameters).fetchone()
+            if row is None:
+                return None
+            return self._load_tuple(thread_id, checkpoint_ns, row)
+
+    def list(
+        self,
+        config: RunnableConfig | None,
+        *,
+        filter: dict[str, Any] | None = None,
+        before: RunnableConfig | None = None,
+        limit: int | None = None,
+    ) -> Iterator[CheckpointTuple]:
+        query = (
+            "SELECT thread_id, checkpoint_ns, checkpoint_id, parent_checkpoint_id,"
+            " type, checkpoint, metadata_type, metadata FROM checkpoints WHERE 1 = 1"
+        )
+        parameters: tuple = ()
+        if config is not None:
+            query += " AND thread_id = ?"
+            parameters += (config["configurable"]["thread_id"],)
+            if (checkpoint_ns := config["configurable"].get("checkpoint_ns")) is not None:
+                query += " AND checkpoint_ns = ?"
+                parameters += (checkpoint_ns,)
+            if checkpoint_id := get_checkpoint_id(config):
+                query += " AND checkpoint_id = ?"
+                parameters += (checkpoint_id,)
+        if before is not None and (before_id := get_checkpoint_id(before)):
+            query += " AND checkpoint_id < ?"
+            parameters += (before_id,)
+        query += " ORDER BY checkpoint_id DESC"
+
+        self.flush()
+        with self._lock:
+            rows = self._connection.execute(query, parameters).fetchall()
+        for thread_id, checkpoint_ns, *row in rows:
+            if limit is not None and limit <= 0:
+                break
+            if filter:
+                metadata = self._loads(row[4], row[5])
+                if not all(metadata.get(key) == value for key, value in filter.items()):
+                    continue
+            if limit is not None:
+                limit -= 1
+            with self._lock:
+                item = self._load_tuple(thread_id, checkpoint_ns, row)
+            yield item
+
+    def delete_older_than(self, seconds: float) -> int:
+        """Delete the runs whose last checkpoint is older than seconds, return their number"""
+        # The checkpoint IDs are UUIDv6, ordered by time: compare with the ID of the cutoff time
+        cutoff = str(checkpoint_id_at(time.time() - seconds))
+        self.flush()
+        with self._lock, self._connection:
+            threads = self._connection.execute(
+                "SELECT thread_id FROM checkpoints"
+                " GROUP BY thread_id HAVING MAX(checkpoint_id) < ?",
+                (cutoff,),
+            ).fetchall()
+            for table in ("checkpoints", "blobs", "writes"):
+                self._connection.executemany(f"DELETE FROM {table} WHERE thread_id = ?", threads)
+        return len(threads)
+
+    def delete_thread(self, thread_id: str) -> None:
+        """Delete the checkpoints of a run, e.g. once it finished"""
+        self._queue(
+            [
+                (f"DELETE FROM {table} WHERE thread_id = ?", (thread_id,))
+                for table in ("checkpoints", "blobs", "writes")
+            ]
+        )
+
+    # The async versions run the sync ones, the queries are local and small.
+    async def aget_tuple(self, config: RunnableConfig) -> CheckpointTuple | None:
+        return self.get_tuple(config)
+
+    async def alist(
+        self,
+        config: RunnableConfig | None,
+        *,
+        filter: dict[str, Any] | None = None,
+        before: RunnableConfig | None = None,
+        limit: int | None = None,
+    ) -> AsyncIterator[CheckpointTuple]:
+        for item in self.list(config, filter=filter, before=before, limit=limit):
+            yield item
+
+    async def aput(
+        self,
+        config: RunnableConfig,
+        checkpoint: Checkpoint,
+        metadata: CheckpointMetadata,
+        new_versions: ChannelVersions,
+    ) -> RunnableConfig:
+        return self.put(config, checkpoint, metadata, new_versions)
+
+    async def aput_writes(
+        self,
+        config: RunnableConfig,
+        writes: Sequence[tuple[str, Any]],
+        task_id: str,
+        task_path: str = "",
+    ) -> None:
+        self.put_writes(config, writes, task_id, task_path)
+
+    async def adelete_thread(self, thread_id: str) -> None:
+        self.delete_thread(thread_id)
+
+    def _queue(self, rows: list[tuple[str, tuple]]) -> None:
+        with self._lock:
+            self._pending.extend(rows)
+            self._queued.notify()
+            if self._writer is None:
+                self._writer = threading.Thread(
+                    target=self._write_loop, name="checkpoints", daemon=True
+                )
+                self._writer.start()
+
+    def _write_loop(self) -> None:
+        while True:
+            with self._lock:
+                self._queued.wait_for(lambda: self._pending)
+            # The next rows of the runs join the same transaction
+            time.sleep(CHECKPOINT_FLUSH_SECONDS)
+            try:
+                self.flush()
+                if time.monotonic() - self._pruned_at >= CHECKPOINT_PRUNE_INTERVAL_SECONDS:
+                    self._prune()
+            except Exception as e:
+                logging.warning(f"Checkpoints not written: {e}")
+
+    def _prune(self) -> None:
+        if self.ttl_seconds is None:
+            return
+        self._pruned_at = time.monotonic()
+        deleted = self.delete_older_than(self.ttl_seconds)
+        if deleted:
+            logging.info(f"Deleted the checkpoints of {deleted} runs older than the TTL.")
+
+    def _dumps(self, value: Any) -> tuple[str, bytes]:
+        value_type, data = self.serde.dumps_typed(value)
+        if len(data) > CHECKPOINT_COMPRESS_MIN_BYTES:
+            return COMPRESSED_PREFIX + value_type, zlib.compress(data, 1)
+        return value_type, data
+
+    def _loads(self, value_type: str, data: bytes) -> Any:
+        if value_type.startswith(COMPRESSED_PREFIX):
+            value_type, data = value_type[len(COMPRESSED_PREFIX) :], zlib.decompress(data)
+        return self.serde.loads_typed((value_type, data))
+
+    def _load_tuple(self, thread_id: str, checkpoint_ns: str, row: Sequence) -> CheckpointTuple:
+        """Build the checkpoint tuple of a row of checkpoints, called with the lock held"""
+        checkpoint_id, parent_checkpoint_id, value_type, data, metadata_type, metadata = row
+        checkpoint: Checkpoint = self._loads(value_type, data)
+
+        channel_values = {}
+        for channel, version in checkpoint["channel_versions"].items():
+            blob = self._connection.execute(
+                "SELECT type, value FROM blobs"
+                " WHERE thread_id = ? AND checkpoint_ns = ? AND channel = ? AND version = ?",
+                (thread_id, checkpoint_ns, channel, str(version)),
+            ).fetchone()
+            if blob is not None and blob[0] != "empty":
+                channel_values[channel] = self._loads(*blob)
+
+        writes = self._connection.execute(
+            "SELECT task_id, channel, type, value FROM writes"
+            " WHERE thread_id = ? AND checkpoint_ns = ? AND checkpoint_id = ?"
+            " ORDER BY task_id, idx",
+            (thread_id, checkpoint_ns, checkpoint_id),
+        ).fetchall()
+        # The tasks sent by the parent checkpoint, e.g. the Send of the fan out routing
+        sends = []
+        if parent_checkpoint_id:
+            sends = self._connection.execute(
+                "SELECT type, value FROM writes"
+                " WHERE thread_id = ? AND checkpoint_ns = ? AND checkpoint_id = ? AND channel = ?"
+                " ORDER BY task_path, task_id, idx",
+                (thread_id, checkpoint_ns, parent_checkpoint_id, TASKS),
+            ).fetchall()
+
+        return CheckpointTuple(
+            config={
+                "configurable": {
+                    "thread_id": thread_id,
+                    "checkpoint_ns": checkpoint_ns,
+                    "checkpoint_id": checkpoint_id,
+                }
+            },
+            checkpoint={
+                **checkpoint,
+                "channel_values": channel_values,
+                "pending_sends": [self._loads(*send) for send in sends],
+            },
+            metadata=self._loads(metadata_type, metadata),
+            pending_writes=[
+                (task_id, channel, self._loads(value_type, value))
+                for task_id, channel, value_type, value in writes
+            ],
+            parent_config=(
+                {
+                    "configurable": {
+                        "thread_id": thread_id,
+                        "checkpoint_ns": checkpoint_ns,
+                        "checkpoint_id": parent_checkpoint_id,
+                    }
+                }
+                if parent_checkpoint_id
+                else None
+            ),
+        )
+
+
+def checkpoint_id_at(timestamp: float) -> UUID:
+    """The smallest checkpoint ID (UUIDv6, as made by LangGraph) of a time in seconds"""
+    ticks = int(timestamp * 10_000_000) + 0x01B21DD213814000
+    return UUID(int=(ticks >> 12) << 80 | (ticks & 0x0FFF) << 64, version=6)
+
+
+def make_checkpointer(backend: str, path: str) -> BaseCheckpointSaver | None:
+    """
+    Create the checkpointer for the given backend ("none", "memory" or "sqlite").
+
+    Any other LangGraph checkpointer (e.g. PostgresSaver) can be given to builder.compile instead.
+    """
+    logging.info(f"Using {backend} checkpointer.")
+    if backend == "none":
+        return None
+    elif backend == "memory":
+        return InMemorySaver()
+    elif backend == "sqlite":
+        return SqliteCheckpointSaver(path)
+    else:
+        raise ValueError(f"Unknown checkpointer backend: {backend}")
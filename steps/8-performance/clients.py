@@ -0,0 +1,68 @@
+import logging
+import threading
+import time
+from typing import Callable, Generic, TypeVar
+
+T = TypeVar("T")
+
+
+class LazyClient(Generic[T]):
+    """
+    A client built on first use, then shared by every thread.
+
+    Importing the module or starting a worker does not pay for the client,
+    only the first call to get() does.
+    """
+
+    def __init__(self, name: str, factory: Callable[[], T]):
+        self.name = name
+        """The name of the client, for the logs"""
+        self._factory = factory
+        self._client: T | None = None
+        self._lock = threading.Lock()
+
+    @property
+    def initialized(self) -> bool:
+        """Was the client already built?"""
+        return self._client is not None
+
+    def get(self) -> T:
+        """Return the client, building it if needed"""
+        # Fast path without the lock once the client is built.
+        client = self._client
+        if client is not None:
+            return client
+        with self._lock:
+            if self._client is None:
+                start = time.perf_counter()
+                self._client = self._factory()
+                logging.info(
+                    f"Client {self.name} initialized in {time.perf_counter() - start:.3f}s."
+                )
+            return self._client
+
+    def set(self, client: T) -> None:
+        """Replace the client, e.g. with a stub in tests"""
+        with self._lock:
+            self._client = client
+
+
+class ClientRegistry:
+    """The lazy clients of the application, to pre-warm them at server startup"""
+
+    def __init__(self):
+        self._clients: dict[str, LazyClient] = {}
+
+    def register(self, name: str, factory: Callable[[], T]) -> LazyClient[T]:
+        """Register a client factory, the client is built on first use"""
+        client = LazyClient(name, factory)
+        self._clients[name] = client
+        return client
+
+    def warm_up(self, *names: str) -> None:
+        """Build the given clients now (all of them by default), instead of during the first run"""
+        for name in names or self._clients:
+            self._clients[name].get()
+
+    def __getitem__(self, name: str) -> LazyClient:
+        return self._clients[name]
@@ -0,0 +1,92 @@
+import logging
+from dataclasses import dataclass
+from typing import Callable, Literal
+
+RESET_CONTEXT = "__reset_context__"
+"""Put first in a context update to drop the previous context, e.g. the one leading to a bad answer"""
+
+DEFAULT_SCORE = 0.5
+"""The relevance of a document without score, e.g. Wikipedia pages"""
+
+
+def estimate_tokens(text: str) -> int:
+    """Rough number of tokens of a text, about 4 characters per token in English"""
+    return len(text) // 4 + 1
+
+
+@dataclass(frozen=True, slots=True)
+class ContextDocument:
+    """A document found by a search tool, as stored in State.context"""
+
+    url: str
+    """Where the document comes from, also the key to deduplicate the context"""
+    title: str
+    content: str
+    source_tool: str
+    """The search node that found the document"""
+    score: float | None = None
+    """The relevance given by the search tool, if any"""
+    tokens: int = 0
+    """The number of tokens of the content, computed at creation when not given"""
+
+    def __post_init__(self):
+        if not self.tokens:
+            object.__setattr__(self, "tokens", estimate_tokens(self.content))
+
+    def render(self) -> str:
+        """The document in the prompt format"""
+        return f'<Document href="{self.url}" title="{self.title}"/>\n{self.content}\n</Document>'
+
+
+def render_context(documents: list[ContextDocument]) -> str:
+    """The context in the prompt format, rendered once when generating the answer"""
+    return "\n\n---\n\n".join(document.render() for document in documents)
+
+
+def make_context_reducer(
+    max_tokens: int,
+    eviction: Literal["oldest", "lowest_relevance"] = "oldest",
+) -> Callable[[list, list], list]:
+    """
+    Create the reducer of State.context.
+
+    - Documents are deduplicated by URL, the newest version is kept.
+    - An update starting with RESET_CONTEXT replaces the whole context.
+    - When the context is over max_tokens, documents are evicted
+      (the oldest ones first, or the least relevant ones first) until it fits.
+      The last document is always kept, even if it does not fit alone.
+    """
+
+    def reduce_context(current: list, update: list) -> list:
+        if update and update[0] == RESET_CONTEXT:
+            current, update = [], update[1:]
+
+        documents: dict[str, ContextDocument] = {}
+        for document in current + update:
+            # Re-inserted at the end, the newest version is also the youngest
+            documents.pop(document.url, None)
+            documents[document.url] = document
+        context = list(documents.values())
+
+        tokens = sum(document.tokens for document in context)
+        if tokens <= max_tokens:
+            return context
+
+        if eviction == "lowest_relevance":
+            # Stable sort, the oldest document goes first between equal scores
+            candidates = sorted(
+                range(len(context)),
+                key=lambda i: DEFAULT_SCORE if context[i].score is None else context[i].score,
+            )
+        else:
+            candidates = list(range(len(context)))
+        evicted = set()
+        for i in candidates:
+            if tokens <= max_tokens or len(evicted) == len(context) - 1:
+                break
+            evicted.add(i)
+            tokens -= context[i].tokens
+        logging.info(f"Context over budget, {len(evicted)} documents evicted ({eviction}).")
+        return [item for i, item in enumerate(context) if i not in evicted]
+
+    return reduce_context
@@ -0,0 +1,410 @@
+"""
+A small on-disk inverted index with BM25 scoring, for the Osedea docs.
+
+Usage:
+    python document_index.py [--rebuild] [query]
+
+The index is made of segments, like Lucene:
+- each update writes one new segment with the new and modified documents only,
+- a modified or deleted document is dropped from its old segment by the manifest,
+- when there are too many segments, they are merged into one by a full rebuild.
+
+Each segment has 4 files:
+- <segment>.terms.json: term -> (offset, count) in the postings,
+- <segment>.postings: the (document, term frequency) pairs as uint32, memory-mapped,
+- <segment>.docs.json: the title, URL and length of each document,
+- <segment>.text: the text of the documents, memory-mapped.
+"""
+
+import argparse
+import html.parser
+import json
+import logging
+import math
+import mmap
+import os
+import re
+import threading
+import time
+from array import array
+from collections import Counter
+from dataclasses import dataclass
+
+from packing import BM25_B, BM25_K1, tokenize
+
+INDEX_MAX_SEGMENTS = 8
+"""Over this number of segments, the next update merges them into one"""
+
+INDEX_EXTENSIONS = (".md", ".markdown", ".html", ".htm")
+"""The files of the docs directory that are indexed"""
+
+INDEX_STOPWORDS = frozenset(
+    "a an and are as at be by can do does for from has have he her his how i in is it its "
+    "me my of on or our she that the their them they this to was we what when where which "
+    "who why will with you your".split()
+)
+"""Frequent English words, not indexed: they would count in the best possible score of a query"""
+
+MANIFEST_NAME = "manifest.json"
+
+
+@dataclass(frozen=True)
+class IndexHit:
+    """A document found by the index"""
+
+    path: str
+    """The path of the document, relative to the docs directory"""
+    url: str
+    title: str
+    content: str
+    score: float
+    """The BM25 score divided by the best possible score of the query, between 0 and 1"""
+
+
+def index_terms(text: str) -> list[str]:
+    """The terms of a text, as indexed and searched"""
+    return [term for term in tokenize(text) if term not in INDEX_STOPWORDS]
+
+
+def list_documents(docs_dir: str) -> dict[str, list[int]]:
+    """The documents to index, by path relative to docs_dir, with their version (mtime and size)"""
+    files = {}
+    for root, _, names in os.walk(docs_dir):
+        for name in names:
+            if name.endswith(INDEX_EXTENSIONS):
+                path = os.path.join(root, name)
+                stat = os.stat(path)
+                files[os.path.relpath(path, docs_dir)] = [stat.st_mtime_ns, stat.st_size]
+    return files
+
+
+def document_url(base_url: str, path: str) -> str:
+    """The URL of a document: the base URL followed by its path without extension"""
+    return base_url + os.path.splitext(path)[0].replace(os.sep, "/")
+
+
+class _TextExtractor(html.parser.HTMLParser):
+    """The visible text and the title of an HTML page"""
+
+    SKIPPED_TAGS = {"script", "style", "head"}
+    BLOCK_TAGS = {"p", "div", "section", "article", "li", "br", "tr", "h1", "h2", "h3", "h4", "h5", "h6"}
+
+    def __init__(self):
+        super().__init__()
+        self.title = ""
+        self.parts: list[str] = []
+        self._stack: list[str] = []
+
+    def handle_starttag(self, tag, attrs):
+        self._stack.append(tag)
+        if tag in self.BLOCK_TAGS:
+            self.parts.append("\n\n")
+
+    def handle_endtag(self, tag):
+        if tag in self._stack:
+            while self._stack.pop() != tag:
+                pass
+
+    def handle_data(self, data):
+        if "title" in self._stack:
+            self.title += data.strip()
+        elif not self.SKIPPED_TAGS.intersection(self._stack):
+            self.parts.append(data)
+
+
+def read_document(path: str) -> tuple[str, str]:
+    """Read a Markdown or HTML file, return its title and its text"""
+    with open(path, encoding="utf-8") as f:
+        raw = f.read()
+    name = os.path.splitext(os.path.basename(path))[0]
+
+    if path.endswith((".html", ".htm")):
+        extractor = _TextExtractor()
+        extractor.feed(raw)
+        text = re.sub(r"\n\s*\n\s*", "\n\n", "".join(extractor.parts)).strip()
+        return extractor.title or name, text
+
+    # Markdown is indexed as is, the title is the first heading
+    match = re.search(r"^#\s+(.+)$", raw, re.M)
+    return (match.group(1).strip() if match else name), raw.strip()
+
+
+class _Segment:
+    """A read-only segment, its postings and texts are memory-mapped"""
+
+    def __init__(self, directory: str, name: str):
+        self.name = name
+        base = os.path.join(directory, name)
+        with open(base + ".terms.json") as f:
+            self.terms: dict[str, list[int]] = json.load(f)
+        with open(base + ".docs.json") as f:
+            self.docs: list[dict] = json.load(f)
+        self._postings_map = map_file(base + ".postings")
+        self.postings = memoryview(self._postings_map).cast("I") if self._postings_map else None
+        self._text_map = map_file(base + ".text")
+
+    def text(self, doc: int) -> str:
+        start, length = self.docs[doc]["text"]
+        return self._text_map[start : start + length].decode("utf-8")  # type: ignore[index]
+
+
+def map_file(path: str) -> mmap.mmap | None:
+    """Memory-map a file for reading, None if it is empty (mmap does not allow it)"""
+    with open(path, "rb") as f:
+        if os.fstat(f.fileno()).st_size == 0:
+            return None
+        return mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+
+def write_atomic(path: str, data: bytes) -> None:
+    """Write a file through a temporary one, a crash never leaves a half written file"""
+    with open(path + ".tmp", "wb") as f:
+        f.write(data)
+    os.replace(path + ".tmp", path)
+
+
+class DocumentIndex:
+    """
+    BM25 search over a directory of Markdown and HTML documents, stored on disk.
+
+    Opening the index only reads the manifest and the term dictionaries,
+    the postings and the texts stay on disk and are paged in by the OS when searched.
+    """
+
+    def __init__(self, index_dir: str, docs_dir: str, base_url: str = ""):
+        self.index_dir = index_dir
+        """Where the index files are"""
+        self.docs_dir = docs_dir
+        """The directory of the documents to index"""
+        self.base_url = base_url
+        """The URL of a document is the base URL followed by its path without extension"""
+        self._lock = threading.Lock()
+        self._manifest = {"next_segment": 0, "segments": [], "documents": {}}
+        self._segments: list[_Segment] = []
+        self._live: dict[str, set[int]] = {}
+        self._doc_count = 0
+        self._average_length = 0.0
+        os.makedirs(index_dir, exist_ok=True)
+        self._load()
+
+    def update(self, rebuild: bool = False) -> int:
+        """
+        Index the documents added or modified since the last update, forget the deleted ones.
+
+        Return the number of documents (re)indexed.
+        """
+        files = list_documents(self.docs_dir)
+        with self._lock:
+            manifest = json.loads(json.dumps(self._manifest))
+        documents = manifest["documents"]
+        rebuild = rebuild or len(manifest["segments"]) >= INDEX_MAX_SEGMENTS
+        if rebuild:
+            changed = sorted(files)
+            documents.clear()
+            manifest["segments"] = []
+        else:
+            changed = sorted(
+                path for path, version in files.items()
+                if documents.get(path, {}).get("version") != version
+            )
+        deleted = [path for path in documents if path not in files]
+        if not changed and not deleted:
+            return 0
+
+        for path in deleted:
+            del documents[path]
+        if changed:
+            segment = f"segment-{manifest['next_segment']}"
+            manifest["next_segment"] += 1
+            self._write_segment(segment, changed)
+            manifest["segments"].append(segment)
+            for doc, path in enumerate(changed):
+                documents[path] = {"segment": segment, "doc": doc, "version": files[path]}
+        # Segments without live documents are not needed anymore
+        used = {entry["segment"] for entry in documents.values()}
+        manifest["segments"] = [name for name in manifest["segments"] if name in used]
+
+        write_atomic(
+            os.path.join(self.index_dir, MANIFEST_NAME), json.dumps(manifest).encode()
+        )
+        self._load()
+        self._delete_unused_files()
+        logging.info(
+            f"Document index updated: {len(changed)} indexed, {len(deleted)} deleted, "
+            f"{len(self._segments)} segments."
+        )
+        return len(changed)
+
+    def search(self, query: str, k: int = 3, min_score: float = 0.0) -> list[IndexHit]:
+        """Return the k best documents for the query, with a score of at least min_score"""
+        with self._lock:
+            segments, live = self._segments, self._live
+            doc_count, average_length = self._doc_count, self._average_length
+        if not doc_count:
+            return []
+
+        scores: dict[tuple[int, int], float] = {}
+        best_score = 0.0
+        for term in set(index_terms(query)):
+            postings = []
+            for i, segment in enumerate(segments):
+                offset, count = segment.terms.get(term, (0, 0))
+                for j in range(offset, offset + count):
+                    doc = segment.postings[2 * j]  # type: ignore[index]
+                    if doc in live[segment.name]:
+                        postings.append((i, doc, segment.postings[2 * j + 1]))  # type: ignore[index]
+            # A term of the query missing from the index still counts in the best score
+            idf = math.log(1 + (doc_count - len(postings) + 0.5) / (len(postings) + 0.5))
+            best_score += idf * (BM25_K1 + 1)
+            for i, doc, frequency in postings:
+                length = segments[i].docs[doc]["length"]
+                norm = BM25_K1 * (1 - BM25_B + BM25_B * length / average_length)
+                scores[(i, doc)] = scores.get((i, doc), 0.0) + idf * frequency * (
+                    BM25_K1 + 1
+                ) / (frequency + norm)
+
+        ranking = sorted(scores.items(), key=lambda item: -item[1])
+        hits = []
+        for (i, doc), score in ranking[:k]:
+            score /= best_score
+            if score < min_score:
+                break
+            entry = segments[i].docs[doc]
+            hits.append(
+                IndexHit(
+                    path=entry["path"],
+                    url=entry["url"],
+                    title=entry["title"],
+                    content=segments[i].text(doc),
+                    score=score,
+                )
+            )
+        return hits
+
+    def stats(self) -> dict:
+        """The size of the index"""
+        with self._lock:
+            return {
+                "documents": self._doc_count,
+                "segments": len(self._segments),
+                "terms": sum(len(segment.terms) for segment in self._segments),
+            }
+
+    def _write_segment(self, segment: str, paths: list[str]) -> None:
+        postings_by_term: dict[str, list[int]] = {}
+        docs = []
+        text = bytearray()
+        for doc, path in enumerate(paths):
+            title, content = read_document(os.path.join(self.docs_dir, path))
+            frequencies = Counter(index_terms(content))
+            for term, frequency in frequencies.items():
+                postings_by_term.setdefault(term, []).extend((doc, frequency))
+            encoded = content.encode("utf-8")
+            docs.append(
+                {
+                    "path": path,
+                    "url": document_url(self.base_url, path),
+                    "title": title,
+                    "length": sum(frequencies.values()),
+                    "text": [len(text), len(encoded)],
+                }
+            )
+            text += encoded
+
+        terms = {}
+        postings = array("I")
+        for term in sorted(postings_by_term):
+            terms[term] = [len(postings) // 2, len(postings_by_term[term]) // 2]
+            postings.extend(postings_by_term[term])
+
+        base = os.path.join(self.index_dir, segment)
+        write_atomic(base + ".postings", postings.tobytes())
+        write_atomic(base + ".text", bytes(text))
+        write_atomic(base + ".docs.json", json.dumps(docs).encode())
+        write_atomic(base + ".terms.json", json.dumps(terms).encode())
+
+    def _load(self) -> None:
+        start = time.perf_counter()
+        path = os.path.join(self.index_dir, MANIFEST_NAME)
+        if os.path.exists(path):
+            with open(path) as f:
+                manifest = json.load(f)
+        else:
+            manifest = {"next_segment": 0, "segments": [], "documents": {}}
+
+        # The segments already open are kept, only the new ones are read
+        opened = {segment.name: segment for segment in self._segments}
+        segments = [
+            opened.get(name) or _Segment(self.index_dir, name) for name in manifest["segments"]
+        ]
+        live: dict[str, set[int]] = {name: set() for name in manifest["segments"]}
+        total_length = 0
+        index = {segment.name: segment for segment in segments}
+        for entry in manifest["documents"].values():
+            live[entry["segment"]].add(entry["doc"])
+            total_length += index[entry["segment"]].docs[entry["doc"]]["length"]
+        doc_count = len(manifest["documents"])
+
+        with self._lock:
+            self._manifest = manifest
+            self._segments = segments
+            self._live = live
+            self._doc_count = doc_count
+            self._average_length = total_length / doc_count if doc_count else 0.0
+        logging.info(
+            f"Document index loaded in {time.perf_counter() - start:.3f}s "
+            f"({doc_count} documents, {len(segments)} segments)."
+        )
+
+    def _delete_unused_files(self) -> None:
+        used = set(self._manifest["segments"])
+        for name in os.listdir(self.index_dir):
+            if name.startswith("segment-") and name.split(".")[0] not in used:
+                os.remove(os.path.join(self.index_dir, name))
+
+
+def combine_hits(
+    lexical: list[IndexHit], vector: list[IndexHit], vector_weight: float
+) -> list[IndexHit]:
+    """
+    Hybrid search: the score of a document is the weighted sum of its lexical and vector scores.
+
+    A document missing from one of the lists has a score of 0 there.
+    The content of the lexical hit (the whole document) is kept over the vector one (its chunks).
+    """
+    documents: dict[str, IndexHit] = {}
+    scores: dict[str, float] = {}
+    for hits, weight in ((vector, vector_weight), (lexical, 1 - vector_weight)):
+        for hit in hits:
+            documents[hit.url] = hit
+            scores[hit.url] = scores.get(hit.url, 0.0) + weight * hit.score
+    ranking = sorted(scores, key=lambda url: -scores[url])
+    return [
+        IndexHit(
+            path=documents[url].path,
+            url=url,
+            title=documents[url].title,
+            content=documents[url].content,
+            score=scores[url],
+        )
+        for url in ranking
+    ]
+
+
+if __name__ == "__main__":
+    from main import OSEDEA_DOCS_DIR, OSEDEA_DOCS_URL, OSEDEA_INDEX_DIR
+
+    parser = argparse.ArgumentParser(description="Update the index of the Osedea docs.")
+    parser.add_argument("query", nargs="?", help="Search the index after the update")
+    parser.add_argument("--rebuild", action="store_true", help="Index every document again")
+    args = parser.parse_args()
+
+    index = DocumentIndex(OSEDEA_INDEX_DIR, OSEDEA_DOCS_DIR, OSEDEA_DOCS_URL)
+    index.update(rebuild=args.rebuild)
+    logging.info(f"Document index: {index.stats()}")
+    if args.query:
+        start = time.perf_counter()
+        hits = index.search(args.query)
+        logging.info(f"Search done in {(time.perf_counter() - start) * 1000:.3f}ms.")
+        for hit in hits:
+            print(f"{hit.score:.3f} {hit.title} ({hit.url})")
@@ -0,0 +1,74 @@
+import zlib
+from typing import Protocol
+
+import numpy as np
+
+from document_index import index_terms
+
+HASHING_DIMENSION = 512
+"""The number of dimensions of the hashing embedder"""
+
+
+class Embedder(Protocol):
+    """Turn texts into vectors, the vectors of an index and of its queries come from the same embedder"""
+
+    name: str
+    """Identify the embedder and its parameters, an index built with another embedder is rebuilt"""
+    dimension: int
+
+    def embed(self, texts: list[str]) -> np.ndarray:
+        """Return a (len(texts), dimension) float32 matrix, each row of norm 1 (or 0)"""
+        ...
+
+
+def normalize_rows(vectors: np.ndarray) -> np.ndarray:
+    """Divide each row by its norm, a cosine similarity is then a dot product"""
+    norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+    return (vectors / np.maximum(norms, 1e-12)).astype(np.float32)
+
+
+class HashingEmbedder:
+    """
+    Words and pairs of words hashed into a fixed number of dimensions (the hashing trick).
+
+    Deterministic and without model, for the tests and as a baseline:
+    it only matches words, like BM25, but in a vector.
+    """
+
+    def __init__(self, dimension: int = HASHING_DIMENSION):
+        self.dimension = dimension
+        self.name = f"hashing-{dimension}"
+
+    def embed(self, texts: list[str]) -> np.ndarray:
+        vectors = np.zeros((len(texts), self.dimension), dtype=np.float32)
+        for i, text in enumerate(texts):
+            words = index_terms(text)
+            for feature in words + [f"{a} {b}" for a, b in zip(words, words[1:])]:
+                # crc32 and not hash(), which changes from one process to another
+                h = zlib.crc32(feature.encode())
+                vectors[i, h % self.dimension] += 1.0 if h & 0x80000000 else -1.0
+        return normalize_rows(vectors)
+
+
+class SentenceTransformerEmbedder:
+    """A local model run on CPU, needs the optional sentence-transformers package"""
+
+    def __init__(self, model_name: str):
+        from sentence_transformers import SentenceTransformer  # type: ignore
+
+        self._model = SentenceTransformer(model_name, device="cpu")
+        self.dimension = self._model.get_sentence_embedding_dimension()
+        self.name = f"sentence-transformers-{model_name}"
+
+    def embed(self, texts: list[str]) -> np.ndarray:
+        vectors = self._model.encode(texts, batch_size=64, convert_to_numpy=True)
+        return normalize_rows(vectors)
+
+
+def make_embedder(name: str) -> Embedder:
+    """Create an embedder: "hashing" or "sentence-transformers:<model name>" """
+    if name == "hashing":
+        return HashingEmbedder()
+    if name.startswith("sentence-transformers:"):
+        return SentenceTransformerEmbedder(name.split(":", 1)[1])
+    raise ValueError(f"Unknown embedder: {name}")
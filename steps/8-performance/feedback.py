@@ -0,0 +1,307 @@
+"""
+Send the scores (e.g. user feedback) to Langfuse in batches, from a background thread.
+
+A request handler only puts the score in a bounded queue, it never waits for Langfuse.
+The background thread writes the scores to an on-disk spool (SQLite) before sending them,
+and deletes them once Langfuse accepted them: the scores survive a crash or an outage
+of Langfuse, and are sent again at the next start.
+"""
+
+import atexit
+import json
+import logging
+import os
+import queue
+import random
+import sqlite3
+import threading
+import time
+import uuid
+from dataclasses import asdict, dataclass
+from typing import Callable, Iterable
+
+FEEDBACK_RETRY_STATUSES = frozenset({408, 429, 500, 502, 503, 504})
+"""The statuses of the Langfuse ingestion errors worth sending again, the others are dropped"""
+
+SCORE_DATA_TYPES = frozenset({"NUMERIC", "BOOLEAN", "CATEGORICAL"})
+"""The data types of a score accepted by Langfuse"""
+
+
+@dataclass(frozen=True)
+class Score:
+    """A score of a run, as sent to Langfuse"""
+
+    id: str
+    """The ID of the score, the same for each try: a score sent twice is only stored once"""
+    run_id: str
+    """The run (the Langfuse trace) scored"""
+    name: str
+    value: float | str
+    data_type: str | None = None
+    """"NUMERIC", "BOOLEAN" or "CATEGORICAL", inferred by Langfuse if None"""
+    comment: str | None = None
+    timestamp: float = 0.0
+
+
+SendScores = Callable[[list[Score]], Iterable[str]]
+"""Send a batch of scores, return the IDs of those to send again. Raise if the whole batch failed."""
+
+
+def langfuse_sender(get_langfuse: Callable) -> SendScores:
+    """Send the scores with the Langfuse ingestion API, in one request per batch"""
+
+    def send(scores: list[Score]) -> list[str]:
+        from langfuse.api.resources.ingestion.types import IngestionEvent_ScoreCreate, ScoreBody
+
+        events = []
+        for score in scores:
+            # A score Langfuse cannot accept is dropped alone, not with its whole batch
+            try:
+                events.append(
+                    IngestionEvent_ScoreCreate(
+                        id=score.id,
+                        timestamp=time.strftime(
+                            "%Y-%m-%dT%H:%M:%S.000Z", time.gmtime(score.timestamp)
+                        ),
+                        body=ScoreBody(
+                            id=score.id,
+                            traceId=score.run_id,
+                            name=score.name,
+                            value=score.value,
+                            dataType=score.data_type,
+                            comment=score.comment,
+                        ),
+                    )
+                )
+            except ValueError as e:
+                logging.warning(f"Score {score.id} dropped, invalid: {e}")
+        if not events:
+            return []
+        response = get_langfuse().client.ingestion.batch(batch=events)
+        for error in response.errors:
+            if error.status not in FEEDBACK_RETRY_STATUSES:
+                logging.warning(f"Score {error.id} rejected by Langfuse: {error.message}")
+        return [error.id for error in response.errors if error.status in FEEDBACK_RETRY_STATUSES]
+
+    return send
+
+
+class ScoreSpool:
+    """The scores not sent yet, in a SQLite file, with their next try time"""
+
+    def __init__(self, path: str):
+        if os.path.dirname(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+        self._connection = sqlite3.connect(path, check_same_thread=False)
+        self._connection.execute("PRAGMA journal_mode=WAL")
+        self._connection.execute(
+            "CREATE TABLE IF NOT EXISTS scores ("
+            " id TEXT PRIMARY KEY,"
+            " score TEXT NOT NULL,"
+            " attempts INTEGER NOT NULL DEFAULT 0,"
+            " next_attempt_at REAL NOT NULL DEFAULT 0)"
+        )
+        self._connection.commit()
+        self._lock = threading.Lock()
+
+    def add(self, scores: list[Score]) -> None:
+        with self._lock:
+            self._connection.executemany(
+                "INSERT OR IGNORE INTO scores (id, score) VALUES (?, ?)",
+                [(score.id, json.dumps(asdict(score))) for score in scores],
+            )
+            self._connection.commit()
+
+    def due(self, limit: int) -> list[tuple[Score, int]]:
+        """The oldest scores to send now, with their number of tries"""
+        with self._lock:
+            rows = self._connection.execute(
+                "SELECT score, attempts FROM scores WHERE next_attempt_at <= ?"
+                " ORDER BY rowid LIMIT ?",
+                (time.time(), limit),
+            ).fetchall()
+        return [(Score(**json.loads(score)), attempts) for score, attempts in rows]
+
+    def delete(self, ids: Iterable[str]) -> None:
+        with self._lock:
+            self._connection.executemany("DELETE FROM scores WHERE id = ?", [(i,) for i in ids])
+            self._connection.commit()
+
+    def postpone(self, ids: Iterable[str], delay: float) -> None:
+        """Count a failed try and set the time of the next one"""
+        with self._lock:
+            self._connection.executemany(
+                "UPDATE scores SET attempts = attempts + 1, next_attempt_at = ? WHERE id = ?",
+                [(time.time() + delay, i) for i in ids],
+            )
+            self._connection.commit()
+
+    def retry_now(self) -> int:
+        """Make all the scores due now, return their number"""
+        with self._lock:
+            self._connection.execute("UPDATE scores SET next_attempt_at = 0")
+            self._connection.commit()
+            return self._connection.execute("SELECT COUNT(*) FROM scores").fetchone()[0]
+
+    def count(self) -> int:
+        with self._lock:
+            return self._connection.execute("SELECT COUNT(*) FROM scores").fetchone()[0]
+
+    def next_attempt_in(self) -> float | None:
+        """Seconds until the next score to send, None if the spool is empty"""
+        with self._lock:
+            row = self._connection.execute("SELECT MIN(next_attempt_at) FROM scores").fetchone()
+        return None if row[0] is None else max(0.0, row[0] - time.time())
+
+
+class FeedbackQueue:
+    """
+    Accept scores without blocking, and send them in batches from a background thread.
+
+    - submit() puts the score in a queue of max_queue scores, it returns False when full.
+    - The thread moves the queued scores to the spool, then sends the spool by batches
+      of batch_size, at least every flush_interval seconds.
+    - A failed batch is sent again after a backoff, doubling from backoff to max_backoff.
+    - Over max_spool scores in the spool (e.g. a long outage), the thread stops taking
+      the queued scores: the queue fills up and submit() returns False.
+    """
+
+    def __init__(
+        self,
+        send: SendScores,
+        spool_path: str,
+        max_queue: int = 10_000,
+        max_spool: int = 100_000,
+        batch_size: int = 100,
+        flush_interval: float = 1.0,
+        backoff: float = 1.0,
+        max_backoff: float = 60.0,
+    ):
+        self.send = send
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.max_spool = max_spool
+        self.submitted = 0
+        """Number of scores accepted"""
+        self.rejected = 0
+        """Number of scores rejected because the queue was full"""
+        self.sent = 0
+        """Number of scores accepted by Langfuse"""
+        self.failures = 0
+        """Number of failed tries of a batch (or of a score of a batch)"""
+        self._queue: queue.Queue[Score] = queue.Queue(maxsize=max_queue)
+        self._spool = ScoreSpool(spool_path)
+        # The scores of a previous process are sent first
+        pending = self._spool.retry_now()
+        if pending:
+            logging.info(f"{pending} scores left in the spool, sending them.")
+        self._idle = threading.Event()
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, name="feedback", daemon=True)
+        self._thread.start()
+        atexit.register(self.close)
+
+    def submit(
+        self,
+        run_id: str,
+        name: str,
+        value: float | str,
+        data_type: str | None = None,
+        comment: str | None = None,
+    ) -> bool:
+        """
+        Queue a score of the run, return False if the queue is full.
+
+        Raise ValueError if the data type is not one of SCORE_DATA_TYPES.
+        """
+        if data_type is not None and data_type not in SCORE_DATA_TYPES:
+            raise ValueError(f"Unknown score data type: {data_type}")
+        score = Score(
+            id=str(uuid.uuid4()),
+            run_id=run_id,
+            name=name,
+            value=value,
+            data_type=data_type,
+            comment=comment,
+            timestamp=time.time(),
+        )
+        try:
+            self._queue.put_nowait(score)
+        except queue.Full:
+            self.rejected += 1
+            return False
+        self._idle.clear()
+        self.submitted += 1
+        return True
+
+    def flush(self, timeout: float | None = None) -> bool:
+        """Wait until the queue and the spool are sent, return False on timeout"""
+        self._idle.clear()
+        return self._idle.wait(timeout)
+
+    def close(self) -> None:
+        """Stop the thread and spool the queued scores, they are sent at the next start"""
+        if self._stop.is_set():
+            return
+        self._stop.set()
+        self._thread.join(timeout=self.flush_interval * 2)
+        self._spool.add(self._drain())
+
+    def stats(self) -> dict:
+        """The counters of the queue, to follow the backlog"""
+        return {
+            "submitted": self.submitted,
+            "rejected": self.rejected,
+            "sent": self.sent,
+            "failures": self.failures,
+            "queued": self._queue.qsize(),
+            "spooled": self._spool.count(),
+        }
+
+    def _drain(self, first_timeout: float = 0.0) -> list[Score]:
+        """Take the queued scores, waiting up to first_timeout for the first one"""
+        scores = []
+        try:
+            if first_timeout:
+                scores.append(self._queue.get(timeout=first_timeout))
+            while True:
+                scores.append(self._queue.get_nowait())
+        except queue.Empty:
+            return scores
+
+    def _run(self) -> None:
+        while not self._stop.is_set():
+            next_attempt_in = self._spool.next_attempt_in()
+            if next_attempt_in is None and self._queue.empty():
+                self._idle.set()
+            wait = self.flush_interval if next_attempt_in is None else next_attempt_in
+            if self._spool.count() < self.max_spool:
+                scores = self._drain(min(wait, self.flush_interval) or 0.001)
+                if scores:
+                    # Written before being sent, a crash from now on does not lose them
+                    self._spool.add(scores)
+            else:
+                self._stop.wait(min(wait, self.flush_interval))
+            while not self._stop.is_set():
+                batch = self._spool.due(self.batch_size)
+                if not batch:
+                    break
+                self._send(batch)
+
+    def _send(self, batch: list[tuple[Score, int]]) -> None:
+        scores = [score for score, _ in batch]
+        try:
+            retry = set(self.send(scores))
+        except Exception as e:
+            logging.warning(f"Sending {len(scores)} scores failed, retrying later: {e}")
+            retry = {score.id for score in scores}
+        self._spool.delete(score.id for score in scores if score.id not in retry)
+        self.sent += len(scores) - len(retry)
+        self.failures += len(retry)
+        if retry:
+            # Exponential backoff with jitter, the processes sharing an outage do not retry together
+            attempts = max(count for score, count in batch if score.id in retry)
+            delay = min(self.max_backoff, self.backoff * 2**attempts) * random.uniform(0.5, 1)
+            self._spool.postpone(retry, delay)
@@ -0,0 +1,1486 @@
+import asyncio
+import hashlib
+import logging
+import operator
+import os
+import random
+import readline
+import sys
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import aclosing, closing
+from typing import Annotated, AsyncIterator, Iterator, Literal
+
+from dotenv import load_dotenv
+from langchain_community.tools import TavilySearchResults
+from langchain_core.messages import (
+    AIMessage,
+    HumanMessage,
+    SystemMessage,
+    message_chunk_to_message,
+)
+from langchain_core.runnables import RunnableConfig, RunnableLambda
+from langchain_core.runnables.graph import MermaidDrawMethod
+from answer_quality import RefusalDetector, classify_answer
+from checkpoints import make_checkpointer
+from clients import ClientRegistry
+from context import RESET_CONTEXT, ContextDocument, make_context_reducer, render_context
+from document_index import combine_hits
+from langgraph.graph import END, START, StateGraph
+from langgraph.types import CachePolicy, Command, Send
+from node_cache import make_node_cache, state_key
+from packing import pack_context, token_counter
+from prefetch import PrefetchRegistry
+from prompts import ChainRegistry, PromptCache
+from search_cache import make_search_cache
+from streaming import STREAM_MODES, GraphStreamReader, StreamEvent, message_text
+from tracing import RunTracer, TraceSampler
+from typing_extensions import TypedDict
+from wikipedia_cache import WikipediaPageCache
+
+logging.basicConfig(level=logging.INFO)
+
+load_dotenv()
+
+# Constants (default values)
+GRAPH_STEPS_MAX = 10
+"""The maximum number of steps to run the graph (inclusive)"""
+GRAPH_OSEDEA_FIND_PERCENT = 0.15
+"""
+The minimum score of a document found in Osedea docs, between 0 and 1.
+The score is the BM25 score divided by the best possible score of the question.
+If set to 0, any document sharing a word with the question is a result.
+If set to 1, almost nothing will be found.
+"""
+GRAPH_WEB_MAX_RESULTS_AT_START = 1
+"""
+The maximum number of results to return from web search.
+If the search returns no results, we will increase this value by 2 each time we search again.
+"""
+GRAPH_GEN_ANSWER_PROMPTS = [
+    "research-wikipedia-tavily-kind",
+    "research-wikipedia-tavily-concise",
+]
+SEARCH_CACHE_BACKEND = "memory"
+"""The backend of the web search cache: "memory" or "sqlite" (persisted across runs)"""
+SEARCH_CACHE_TTL_SECONDS = 24 * 60 * 60
+"""How long a web search result stays valid in the cache"""
+SEARCH_CACHE_MAX_ENTRIES = 1024
+"""The maximum number of questions kept in the web search cache"""
+SEARCH_CACHE_PATH = os.path.join(
+    os.path.dirname(os.path.abspath(__file__)), ".cache", "search_web.sqlite"
+)
+"""The SQLite file used by the "sqlite" web search cache backend"""
+WIKIPEDIA_CACHE_PATH = os.path.join(
+    os.path.dirname(os.path.abspath(__file__)), ".cache", "wikipedia.sqlite"
+)
+"""
+The SQLite file storing the Wikipedia pages (compressed).
+Set to ":memory:" to keep the pages in memory only.
+"""
+WIKIPEDIA_CACHE_TTL_SECONDS = 7 * 24 * 60 * 60
+"""How long a Wikipedia page (and the result of a Wikipedia search) stays valid in the cache"""
+WIKIPEDIA_CACHE_NEGATIVE_TTL_SECONDS = 10 * 60
+"""How long a Wikipedia search without any page stays valid, short: the pages may come later"""
+OSEDEA_DOCS_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "osedea_docs")
+"""The Markdown and HTML documents searched by search_osedea"""
+OSEDEA_DOCS_URL = "https://osedea.com/docs/"
+"""The URL of a document is this URL followed by its path in OSEDEA_DOCS_DIR, without extension"""
+OSEDEA_INDEX_DIR = os.path.join(
+    os.path.dirname(os.path.abspath(__file__)), ".cache", "osedea_index"
+)
+"""The BM25 index of the Osedea docs, updated with the new and modified documents at startup"""
+OSEDEA_SEARCH_MAX_RESULTS = 3
+"""The maximum number of documents returned by search_osedea"""
+OSEDEA_VECTOR_INDEX_DIR = os.path.join(
+    os.path.dirname(os.path.abspath(__file__)), ".cache", "osedea_vectors"
+)
+"""The embeddings of the Osedea docs, as a NumPy matrix memory-mapped when searching"""
+OSEDEA_EMBEDDER = "hashing"
+"""
+The embedder of the Osedea docs and of the questions:
+- "hashing": words hashed into a vector, deterministic and without model,
+- "sentence-transformers:<model>": a local model, e.g. "sentence-transformers:all-MiniLM-L6-v2".
+"""
+GRAPH_OSEDEA_SEARCH_MODE = "lexical"
+"""
+How search_osedea ranks the documents:
+- "lexical": BM25 on the words of the question,
+- "vector": similarity of the embeddings,
+- "hybrid": both scores, weighted by GRAPH_OSEDEA_VECTOR_WEIGHT.
+"""
+GRAPH_OSEDEA_VECTOR_WEIGHT = 0.5
+"""The weight of the vector score in hybrid mode, the lexical score has the rest"""
+ANSWER_CACHE_ENABLED = True
+"""Answer a question with the good answer of a similar question of the same user, without running the graph"""
+ANSWER_CACHE_EMBEDDER = "hashing"
+"""The embedder of the questions for the answer cache, see OSEDEA_EMBEDDER"""
+ANSWER_CACHE_THRESHOLD = 0.85
+"""The minimum cosine similarity between two questions to share an answer"""
+ANSWER_CACHE_TTL_SECONDS = 24 * 60 * 60
+"""How long an answer stays valid in the answer cache"""
+ANSWER_CACHE_WEB_TTL_SECONDS = 15 * 60
+"""How long an answer using web search results stays valid, shorter: the news change"""
+ANSWER_CACHE_MAX_ENTRIES = 10_000
+"""The maximum number of answers kept, the least recently used ones are evicted"""
+ANSWER_CACHE_MAX_BYTES = 64 * 1024 * 1024
+"""The maximum size of the answer cache (answers, questions and their vectors)"""
+SESSION_MEMORY_ENABLED = True
+"""Start a question with the relevant documents and answers of the previous turns of its session"""
+SESSION_MEMORY_MAX_TOKENS = 8000
+"""The maximum number of tokens kept per session, the oldest documents are evicted"""
+SESSION_MEMORY_MAX_SESSIONS = 1000
+"""The maximum number of sessions kept, the least recently used ones are evicted"""
+SESSION_MEMORY_IDLE_SECONDS = 30 * 60
+"""How long an idle session is kept"""
+SESSION_MEMORY_MIN_SCORE = 0.4
+"""The minimum share (0 to 1) of the terms of a follow-up found in its session to reuse the session"""
+TRACE_SAMPLE_RATE = 1.0
+"""The share of the runs traced in Langfuse (head sampling), lower it at peak to save the tracing overhead"""
+TRACE_ALWAYS_USER_IDS: list[str] = []
+"""The users whose runs are always traced, e.g. to debug their issue"""
+TRACE_TAIL_SAMPLING = True
+"""Record the callbacks of the runs not drawn, and send them if the run ends with a TRACE_TAIL_STEPS"""
+TRACE_TAIL_STEPS = ["too many steps", "too many LLM calls"]
+"""The last steps of the runs always traced, the runs worth a look"""
+FEEDBACK_SPOOL_PATH = os.path.join(
+    os.path.dirname(os.path.abspath(__file__)), ".cache", "feedback_spool.sqlite"
+)
+"""The SQLite file keeping the scores until Langfuse accepted them"""
+FEEDBACK_QUEUE_SIZE = 10_000
+"""The maximum number of scores waiting to be spooled, the next ones are rejected"""
+FEEDBACK_SPOOL_MAX = 100_000
+"""The maximum number of scores in the spool, e.g. during a Langfuse outage"""
+FEEDBACK_BATCH_SIZE = 100
+"""The maximum number of scores sent to Langfuse in one request"""
+FEEDBACK_FLUSH_SECONDS = 1.0
+"""The maximum time a score waits before being sent"""
+FEEDBACK_BACKOFF_SECONDS = 1.0
+"""The delay before sending a failed batch again, doubled at each failure up to a minute"""
+GRAPH_CACHE_BACKEND = "memory"
+"""
+Where the graph caches the writes of search_web, search_wikipedia and generate_answer:
+"none", "memory" or "sqlite" (GRAPH_CACHE_PATH).
+A node called again with the same state fields is skipped, e.g. on a retry or a replay.
+"""
+GRAPH_CACHE_PATH = os.path.join(
+    os.path.dirname(os.path.abspath(__file__)), ".cache", "graph_nodes.sqlite"
+)
+"""The SQLite file of the node cache, with the "sqlite" backend"""
+GRAPH_CACHE_TTL_SEARCH_WEB = 60 * 60
+"""How long the writes of search_web stay in the node cache, in seconds"""
+GRAPH_CACHE_TTL_SEARCH_WIKIPEDIA = 24 * 60 * 60
+"""How long the writes of search_wikipedia stay in the node cache, in seconds"""
+GRAPH_CACHE_TTL_GENERATE_ANSWER = 10 * 60
+"""How long the writes of generate_answer stay in the node cache, in seconds"""
+GRAPH_CHECKPOINT_BACKEND = "sqlite"
+"""
+Where the graph saves its state after each step, to resume a failed run: "none", "memory" or "sqlite".
+Any other LangGraph checkpointer can be given to builder.compile instead.
+"""
+GRAPH_CHECKPOINT_PATH = os.path.join(
+    os.path.dirname(os.path.abspath(__file__)), ".cache", "checkpoints.sqlite"
+)
+"""The SQLite file of the checkpoints, with the "sqlite" backend"""
+GRAPH_CHECKPOINT_KEEP_FINISHED = False
+"""Keep the checkpoints of the runs that finished, they are only needed to resume a failed run"""
+GRAPH_ROUTING_MODE = "single"
+"""
+How choose_tool routes the question:
+- "single": one search tool at a time, another one is tried if the answer is bad,
+- "fan_out": every search tool at once, their results are joined before generating the answer.
+"""
+GRAPH_SEARCH_TIMEOUT_SECONDS = 10.0
+"""The maximum time to wait for a search tool, a slow source will not hold up the answer"""
+GRAPH_ANSWER_CHECK_RULES = True
+"""
+Check the answer with local rules (refusal phrases) before asking the LLM.
+The LLM is only called when the rules cannot decide.
+"""
+GRAPH_SPECULATIVE_CHECK = True
+"""
+Stream the answer and look for a refusal phrase while it is generated.
+A refusal stops the generation at once, check_answer_quality then routes back to choose_tool
+without the LLM: we neither wait for nor pay the rest of a bad answer.
+"""
+GRAPH_NO_ANSWER = "I couldn't find a complete answer to this question."
+"""
+The answer of a run ending without a complete answer, e.g. its only try was cancelled
+by GRAPH_SPECULATIVE_CHECK. Otherwise the run keeps the last complete answer.
+"""
+GRAPH_PREFETCH_NEXT_SEARCH = False
+"""
+Start the web search of the next try (with 2 more results) while the answer is generated
+and checked. If the answer is bad, choose_tool goes to search_web and the results are ready.
+Costs a web search for each answer found good, the unused searches are cancelled.
+"""
+GRAPH_CONTEXT_MAX_TOKENS = 6000
+"""
+The maximum number of tokens kept in the context, whatever the number of loops.
+Documents are evicted following GRAPH_CONTEXT_EVICTION when the context is bigger.
+"""
+GRAPH_CONTEXT_EVICTION = "oldest"
+"""Which documents to evict first from the context: "oldest" or "lowest_relevance" (search score)"""
+GRAPH_RESET_CONTEXT_ON_RETRY = False
+"""Drop the context leading to a bad answer before trying another tool"""
+GRAPH_PACK_MAX_TOKENS = 3000
+"""
+The maximum number of context tokens put in the answer prompt.
+The passages most relevant to the question (BM25) are selected when the context is bigger.
+"""
+GRAPH_PACK_PASSAGE_TOKENS = 200
+"""The size in tokens of the passages the documents are split into for the packing"""
+GRAPH_MODEL_CALLS_MAX = 6
+"""The maximum number of LLM calls to make (inclusive)"""
+MODEL_NAME = "gpt-4o-mini"
+"""The model to use for the LLM"""
+MODEL_TEMPERATURE = 0.0
+"""The temperature to use for the LLM"""
+PROMPT_CACHE_TTL_SECONDS = 60
+"""Time after which a prompt is refreshed from Langfuse, in the background"""
+PROMPT_FALLBACK_DIR = os.path.join(
+    os.path.dirname(os.path.abspath(__file__)), ".cache", "prompts"
+)
+"""The last known version of each prompt, used when Langfuse is unreachable"""
+EXAMPLES = [
+    (
+        "Who is Carl from Osedea?",
+        "will use Osedea docs, and find the page about Carl",
+    ),
+    ("Who is Darth Vader according to Wikipedia?", "will normally use Wikipedia"),
+    (
+        "Is the best way to win a war is to never start it?",
+        "will normally use web search",
+    ),
+    ("What is the capital of France?", "will normally use web search"),
+    (
+        "What will be the weather tomorrow in L.A.?",
+        "will normally use web search and reach max steps or LLM calls",
+    ),
+]
+
+
+# The clients are created on first use, see clients.ClientRegistry.
+# Their packages are imported there too, the OpenAI and Langfuse SDKs are slow to import.
+def create_langfuse_handler():
+    """Create the Langfuse callback handler to trace the runs"""
+    from langfuse.callback import CallbackHandler  # type: ignore
+
+    # Make sure to set the environment variables
+    # LANGFUSE_PUBLIC_KEY, LANGFUSE_SECRET_KEY, and LANGFUSE_HOST
+    return CallbackHandler()
+
+
+def create_langfuse():
+    """Create the Langfuse client to use langfuse objects and helpers"""
+    from langfuse import Langfuse  # type: ignore
+
+    return Langfuse()
+
+
+def create_llm():
+    """Create the LLM client"""
+    from langchain_openai import ChatOpenAI
+
+    # We can create a new LLM instance for each node, but it is not necessary in this simple graph example.
+    # The token usage is also sent when streaming, see GRAPH_SPECULATIVE_CHECK
+    return ChatOpenAI(model=MODEL_NAME, temperature=MODEL_TEMPERATURE, stream_usage=True)
+
+
+def create_osedea_index():
+    """Open the index of the Osedea docs, indexing the documents changed since the last run"""
+    from document_index import DocumentIndex
+
+    index = DocumentIndex(OSEDEA_INDEX_DIR, OSEDEA_DOCS_DIR, OSEDEA_DOCS_URL)
+    index.update()
+    return index
+
+
+def create_osedea_vectors():
+    """Open the vector index of the Osedea docs, embedding the documents changed since the last run"""
+    from embeddings import make_embedder
+    from vector_index import VectorIndex
+
+    index = VectorIndex(
+        OSEDEA_VECTOR_INDEX_DIR, OSEDEA_DOCS_DIR, make_embedder(OSEDEA_EMBEDDER), OSEDEA_DOCS_URL
+    )
+    index.update()
+    return index
+
+
+def create_answer_cache():
+    """Create the cache of the good answers, keyed by the embedding of the question"""
+    from answer_cache import SemanticAnswerCache
+    from embeddings import make_embedder
+
+    return SemanticAnswerCache(
+        make_embedder(ANSWER_CACHE_EMBEDDER),
+        threshold=ANSWER_CACHE_THRESHOLD,
+        ttl=ANSWER_CACHE_TTL_SECONDS,
+        max_entries=ANSWER_CACHE_MAX_ENTRIES,
+        max_bytes=ANSWER_CACHE_MAX_BYTES,
+    )
+
+
+def create_session_memory():
+    """Create the memory of the documents and answers of each session"""
+    from session_memory import SessionMemory
+
+    return SessionMemory(
+        max_tokens=SESSION_MEMORY_MAX_TOKENS,
+        max_sessions=SESSION_MEMORY_MAX_SESSIONS,
+        idle_ttl=SESSION_MEMORY_IDLE_SECONDS,
+        min_score=SESSION_MEMORY_MIN_SCORE,
+    )
+
+
+def create_feedback():
+    """Create the queue sending the scores to Langfuse from a background thread"""
+    from feedback import FeedbackQueue, langfuse_sender
+
+    return FeedbackQueue(
+        langfuse_sender(langfuse.get),
+        FEEDBACK_SPOOL_PATH,
+        max_queue=FEEDBACK_QUEUE_SIZE,
+        max_spool=FEEDBACK_SPOOL_MAX,
+        batch_size=FEEDBACK_BATCH_SIZE,
+        flush_interval=FEEDBACK_FLUSH_SECONDS,
+        backoff=FEEDBACK_BACKOFF_SECONDS,
+    )
+
+
+clients = ClientRegistry()
+langfuse_handler = clients.register("langfuse_handler", create_langfuse_handler)
+langfuse = clients.register("langfuse", create_langfuse)
+llm = clients.register("llm", create_llm)
+osedea_index = clients.register("osedea_index", create_osedea_index)
+osedea_vectors = clients.register("osedea_vectors", create_osedea_vectors)
+answer_cache = clients.register("answer_cache", create_answer_cache)
+session_memory = clients.register("session_memory", create_session_memory)
+feedback = clients.register("feedback", create_feedback)
+
+# Compiled prompts, to avoid a fetch and a template parse for each answer.
+# The Langfuse cache is disabled, the refresh happens in our background thread.
+prompt_cache = PromptCache(
+    lambda name: langfuse.get().get_prompt(name, cache_ttl_seconds=0),
+    ttl=PROMPT_CACHE_TTL_SECONDS,
+    fallback_dir=PROMPT_FALLBACK_DIR,
+)
+
+# And the chains built from them, one per prompt version.
+answer_chains = ChainRegistry(prompt_cache, llm.get)
+
+# Cache the web search results, the same questions come back again and again
+# and the loop can visit search_web several times during the same run.
+web_search_cache = make_search_cache(
+    SEARCH_CACHE_BACKEND,
+    ttl=SEARCH_CACHE_TTL_SECONDS,
+    max_entries=SEARCH_CACHE_MAX_ENTRIES,
+    path=SEARCH_CACHE_PATH,
+)
+
+# Searches run in this pool so that we can stop waiting for them after a timeout.
+search_executor = ThreadPoolExecutor(thread_name_prefix="search")
+
+# The web searches started for the next try of a run, see GRAPH_PREFETCH_NEXT_SEARCH.
+prefetches = PrefetchRegistry()
+
+# Which runs are traced in Langfuse, and their tracing overhead.
+trace_sampler = TraceSampler(
+    rate=TRACE_SAMPLE_RATE,
+    always_user_ids=TRACE_ALWAYS_USER_IDS,
+    tail_steps=TRACE_TAIL_STEPS,
+    tail=TRACE_TAIL_SAMPLING,
+)
+
+# Same for Wikipedia, each page is stored once and shared by all the queries leading to it.
+wikipedia_cache = WikipediaPageCache(
+    WIKIPEDIA_CACHE_PATH,
+    ttl=WIKIPEDIA_CACHE_TTL_SECONDS,
+    negative_ttl=WIKIPEDIA_CACHE_NEGATIVE_TTL_SECONDS,
+)
+
+
+class ConfigSchema(TypedDict):
+    """Config schema for the graph."""
+
+    steps_max: int
+    """The maximum number of steps to run"""
+    model_calls_max: int
+    """The maximum number of LLM calls to make"""
+    osedea_find_percent: float
+    """The minimum score (0 to 1) of a document found in Osedea docs"""
+    osedea_search_mode: Literal["lexical", "vector", "hybrid"]
+    """How search_osedea ranks the documents"""
+    osedea_vector_weight: float
+    """The weight of the vector score in hybrid mode"""
+    gen_answer_prompts: list[str]
+    """The list of prompts to use for the answer generation"""
+    routing_mode: Literal["single", "fan_out"]
+    """Use one search tool at a time or every search tool at once"""
+    search_timeout_seconds: float
+    """The maximum time to wait for a search tool"""
+    answer_check_rules: bool
+    """Check the answer with local rules before asking the LLM"""
+    speculative_check: bool
+    """Look for a refusal while the answer is generated, and stop the generation if found"""
+    prefetch_next_search: bool
+    """Start the web search of the next try while the answer is generated and checked"""
+    reset_context_on_retry: bool
+    """Drop the context leading to a bad answer before trying another tool"""
+    pack_max_tokens: int
+    """The maximum number of context tokens put in the answer prompt"""
+    pack_passage_tokens: int
+    """The size in tokens of the passages for the packing"""
+
+
+class State(TypedDict):
+    """State of the graph. Will be passed to each node."""
+
+    question: str
+    """The original question to answer"""
+    context: Annotated[
+        list, make_context_reducer(GRAPH_CONTEXT_MAX_TOKENS, GRAPH_CONTEXT_EVICTION)
+    ]
+    """The documents to use for the answer, deduplicated and bounded in tokens"""
+    answer: str
+    """The answer to the question"""
+    llm_calls: int
+    """The number of LLM calls made so far. Beware, we use a simple state update, this will not work with multiple concurrent calls."""
+    llm_calls_saved: int
+    """The number of answer checks decided by the local rules instead of the LLM"""
+    web_max_results: int
+    """The maximum number of results to return from web search"""
+    steps_history: Annotated[list[str], operator.add]
+    """The steps made so far"""
+
+
+def choose_tool(
+    state: State, config: RunnableConfig
+) -> Command[Literal["search_osedea", "search_web", "search_wikipedia", "generate_answer"]]:
+    """Node to choose the tool to use based on the question"""
+    logging.info(f"Choosing a tool for the question: {state['question']}")
+
+    # A follow-up starting with documents of its session is answered without searching first.
+    # If the answer is bad, we get back here and search as usual.
+    if not state["steps_history"] and state["context"]:
+        logging.info("Routing to the answer with the context of the session...")
+        return Command(
+            update={"steps_history": ["choose session"]},
+            goto="generate_answer",
+        )
+
+    # In fan out mode, call every search tool in parallel.
+    # The results are joined before generate_answer since they run in the same step.
+    if config["configurable"].get("routing_mode") == "fan_out":
+        logging.info("Routing to every search tool...")
+        return Command(
+            update={"steps_history": ["choose all"]},
+            goto=[
+                Send(tool, state)
+                for tool in ["search_osedea", "search_web", "search_wikipedia"]
+            ],
+        )
+
+    # If the web search of this try was prefetched, its results are ready.
+    if prefetches.has(config["configurable"]["thread_id"], web_search_key(state)):
+        logging.info("Routing to the prefetched web search...")
+        return Command(update={"steps_history": ["choose prefetched"]}, goto="search_web")
+
+    # If we already tried a tool and get back, try something else randomly.
+    if len(state["steps_history"]) > 0:
+        logging.info("Routing to a different tool randomly...")
+        return Command(
+            update={"steps_history": ["choose random"]},
+            goto=random.choice(["search_osedea", "search_web", "search_wikipedia"]),
+        )
+    
+    # Check "naively" if the question is about a specific topic that we can find in the question.
+    # In a real-world scenario, you would use a more sophisticated method to determine the tool to use.
+    if "wikipedia" in state["question"].lower() and "choose wikipedia" not in state["steps_history"]:
+        logging.info("Routing to Wikipedia search...")
+        return Command(
+            update={"steps_history": ["choose wikipedia"]},
+            goto="search_wikipedia",
+        )
+    elif "osedea" in state["question"].lower() and "choose osedea" not in state["steps_history"]:
+        logging.info("Routing to Osedea search...")
+        return Command(
+            update={"steps_history": ["choose osedea"]},
+            goto="search_osedea",
+        )
+    else:
+        logging.info("Routing to web search...")
+        return Command(
+            update={"steps_history": ["choose web"]},
+            goto="search_web",
+        )
+
+
+def search_osedea(state: State, config: RunnableConfig) -> dict:
+    """
+    Node to search in Osedea docs, with the local BM25 index, the vector index, or both.
+
+    The documents scoring under osedea_find_percent are not results.
+    """
+
+    logging.info("Searching in Osedea docs...")
+
+    mode = config["configurable"].get("osedea_search_mode", GRAPH_OSEDEA_SEARCH_MODE)
+    min_score = config["configurable"]["osedea_find_percent"]
+    # The indexes are on disk and memory-mapped, a search takes about a millisecond.
+    if mode == "lexical":
+        hits = osedea_index.get().search(
+            state["question"], k=OSEDEA_SEARCH_MAX_RESULTS, min_score=min_score
+        )
+    else:
+        # More candidates than results, a document can be good in only one of the rankings.
+        candidates = OSEDEA_SEARCH_MAX_RESULTS * (3 if mode == "hybrid" else 1)
+        hits = osedea_vectors.get().search([state["question"]], k=candidates)[0]
+        if mode == "hybrid":
+            hits = combine_hits(
+                osedea_index.get().search(state["question"], k=candidates),
+                hits,
+                config["configurable"].get("osedea_vector_weight", GRAPH_OSEDEA_VECTOR_WEIGHT),
+            )
+        hits = [hit for hit in hits if hit.score >= min_score][:OSEDEA_SEARCH_MAX_RESULTS]
+    if hits:
+        logging.info(f"Result found in Osedea docs: {[hit.path for hit in hits]}")
+        return {
+            "steps_history": ["result from osedea"],
+            "context": [
+                ContextDocument(
+                    url=hit.url,
+                    title=hit.title,
+                    content=hit.content,
+                    source_tool="search_osedea",
+                    score=hit.score,
+                )
+                for hit in hits
+            ],
+        }
+    else:
+        logging.info("No result found in Osedea docs.")
+        # No document added to the context, the steps history keeps track of the empty search.
+        return {"steps_history": ["no result from osedea"]}
+
+
+def call_with_timeout(function, timeout: float, *args, **kwargs):
+    """
+    Call a blocking search function, give up waiting after the timeout.
+
+    Return None on timeout. The call keeps running in the background,
+    so its result still ends up in the caches for the next time.
+    """
+    future = search_executor.submit(function, *args, **kwargs)
+    try:
+        return future.result(timeout=timeout)
+    except TimeoutError:
+        logging.warning(f"{function.__qualname__} timed out after {timeout}s.")
+        return None
+
+
+def fetch_web_results(question: str, max_results: int) -> list | str:
+    """Search in the web with Tavily, through the web search cache"""
+    search_docs = web_search_cache.get(question, max_results)
+    if search_docs is not None:
+        logging.info("Web search results found in cache.")
+        return search_docs
+
+    tavily_search = TavilySearchResults(max_results=max_results)
+    search_docs = tavily_search.invoke(question)
+    # Tavily returns an error message as a string when the search fails,
+    # do not keep it in the cache.
+    if isinstance(search_docs, list):
+        web_search_cache.set(question, max_results, search_docs)
+    return search_docs
+
+
+async def acall_with_timeout(function, timeout: float, *args, **kwargs):
+    """Async version of call_with_timeout, the call is shielded from the cancellation"""
+    task = asyncio.ensure_future(function(*args, **kwargs))
+    try:
+        return await asyncio.wait_for(asyncio.shield(task), timeout=timeout)
+    except TimeoutError:
+        logging.warning(f"{function.__qualname__} timed out after {timeout}s.")
+        return None
+
+
+async def afetch_web_results(question: str, max_results: int) -> list | str:
+    """Async version of fetch_web_results"""
+    search_docs = web_search_cache.get(question, max_results)
+    if search_docs is not None:
+        logging.info("Web search results found in cache.")
+        return search_docs
+
+    tavily_search = TavilySearchResults(max_results=max_results)
+    search_docs = await tavily_search.ainvoke(question)
+    if isinstance(search_docs, list):
+        web_search_cache.set(question, max_results, search_docs)
+    return search_docs
+
+
+def search_web(state: State, config: RunnableConfig) -> dict:
+    """Node to search in the web for the question"""
+    logging.info("Searching in web...")
+
+    timeout = config["configurable"].get("search_timeout_seconds", GRAPH_SEARCH_TIMEOUT_SECONDS)
+    prefetched = prefetches.take(config["configurable"]["thread_id"], web_search_key(state))
+    if prefetched is not None:
+        logging.info("Using the prefetched web search.")
+        try:
+            search_docs = prefetched.result(timeout=timeout)
+        except TimeoutError:
+            logging.warning(f"Prefetched web search timed out after {timeout}s.")
+            search_docs = None
+        return web_search_update(state, search_docs)
+
+    search_docs = call_with_timeout(
+        fetch_web_results, timeout, state["question"], state["web_max_results"]
+    )
+    return web_search_update(state, search_docs)
+
+
+async def asearch_web(state: State, config: RunnableConfig) -> dict:
+    """Async version of search_web"""
+    logging.info("Searching in web...")
+
+    timeout = config["configurable"].get("search_timeout_seconds", GRAPH_SEARCH_TIMEOUT_SECONDS)
+    prefetched = prefetches.take(config["configurable"]["thread_id"], web_search_key(state))
+    if prefetched is not None:
+        logging.info("Using the prefetched web search.")
+        try:
+            search_docs = await asyncio.wait_for(asyncio.shield(prefetched), timeout=timeout)
+        except TimeoutError:
+            logging.warning(f"Prefetched web search timed out after {timeout}s.")
+            search_docs = None
+        return web_search_update(state, search_docs)
+
+    search_docs = await acall_with_timeout(
+        afetch_web_results, timeout, state["question"], state["web_max_results"]
+    )
+    return web_search_update(state, search_docs)
+
+
+def web_search_key(state: State, more_results: int = 0) -> tuple:
+    """The key of a prefetched web search"""
+    return ("search_web", state["question"], state["web_max_results"] + more_results)
+
+
+def should_prefetch(state: State, config: RunnableConfig) -> bool:
+    """
+    Whether to prefetch the web search of the next try, while the answer is generated.
+
+    Not if the next try cannot happen: the limits checked by route_answer_quality
+    will be reached after this answer (one more step, one more LLM call).
+    """
+    configurable = config["configurable"]
+    return (
+        configurable.get("prefetch_next_search", GRAPH_PREFETCH_NEXT_SEARCH)
+        and configurable.get("routing_mode") != "fan_out"
+        and len(state["steps_history"]) + 1 < configurable["steps_max"]
+        and state["llm_calls"] + 1 < configurable["model_calls_max"]
+    )
+
+
+def web_search_update(state: State, search_docs: list | str | None) -> dict:
+    """Format the web search results as a state update"""
+    if search_docs is None:
+        return {"steps_history": ["timeout from web"]}
+
+    documents = [
+        ContextDocument(
+            url=doc["url"],
+            title=doc.get("title", ""),
+            content=doc["content"],
+            source_tool="search_web",
+            score=doc.get("score"),
+        )
+        for doc in search_docs
+    ]
+    logging.info(
+        f"Search results: {len(search_docs)} results found (max results: {state['web_max_results']})."
+    )
+
+    # Un comment to simulate a web search with no results and reach max steps or LLM calls.
+    # return {"steps_history": ["result from web"]}
+    return {"steps_history": ["result from web"], "context": documents}
+
+
+def search_wikipedia(state: State, config: RunnableConfig) -> dict:
+    """Node to search in Wikipedia for the question"""
+    logging.info("Searching in Wikipedia...")
+
+    search_docs = call_with_timeout(
+        wikipedia_cache.load,
+        config["configurable"].get("search_timeout_seconds", GRAPH_SEARCH_TIMEOUT_SECONDS),
+        state["question"],
+        load_max_docs=2,
+    )
+    return wikipedia_search_update(search_docs)
+
+
+async def asearch_wikipedia(state: State, config: RunnableConfig) -> dict:
+    """Async version of search_wikipedia"""
+    logging.info("Searching in Wikipedia...")
+
+    search_docs = await acall_with_timeout(
+        wikipedia_cache.aload,
+        config["configurable"].get("search_timeout_seconds", GRAPH_SEARCH_TIMEOUT_SECONDS),
+        state["question"],
+        load_max_docs=2,
+    )
+    return wikipedia_search_update(search_docs)
+
+
+def wikipedia_search_update(search_docs: list | None) -> dict:
+    """Format the Wikipedia pages as a state update"""
+    if search_docs is None:
+        return {"steps_history": ["timeout from wikipedia"]}
+
+    documents = [
+        ContextDocument(
+            url=doc.metadata["source"],
+            title=doc.metadata.get("title", ""),
+            content=doc.page_content,
+            source_tool="search_wikipedia",
+        )
+        for doc in search_docs
+    ]
+
+    # Extract the page names for logging
+    pages = [doc.metadata["source"].split("/")[-1] for doc in search_docs]
+    logging.info(f"Pages from Wikipedia: {pages}")
+
+    return {
+        "steps_history": ["result from wikipedia"],
+        "context": documents,
+    }
+
+
+def prepare_generate_answer(state: State, config: RunnableConfig) -> tuple:
+    """Prepare the chain, its input and its config to generate an answer"""
+
+    # Prepare system prompt from langfuse
+    prompt_name = random.choice(config["configurable"]["gen_answer_prompts"])
+    logging.info(f"Using prompt: {prompt_name}")
+    # The chain (compiled prompt | llm) is built once per prompt version and reused.
+    generate_answer_chain = answer_chains.get(prompt_name)
+
+    # Keep the passages most relevant to the question, under the token budget
+    packed = pack_context(
+        state["question"],
+        state["context"],
+        max_tokens=config["configurable"].get("pack_max_tokens", GRAPH_PACK_MAX_TOKENS),
+        passage_tokens=config["configurable"].get(
+            "pack_passage_tokens", GRAPH_PACK_PASSAGE_TOKENS
+        ),
+        count_tokens=token_counter(MODEL_NAME),
+    )
+    # The packed size is attached to the generation in the trace
+    chain_config = {
+        **config,
+        "metadata": {**config.get("metadata", {}), **packed.metadata()},
+    }
+
+    # Prepare chain_context related to the prompt
+    chain_context = {
+        "question": state["question"],
+        # The documents are only serialized to the prompt format here
+        "context": render_context(packed.documents),
+    }
+
+    return generate_answer_chain, chain_context, chain_config
+
+
+def generate_answer_update(state: State, answer, detector: RefusalDetector | None) -> dict:
+    """
+    The update of generate_answer, its step is "answer cancelled" if a refusal stopped it.
+
+    A single step either way: a cancelled try costs the same of GRAPH_STEPS_MAX as a bad answer.
+    The truncated answer of a cancelled try is dropped, the state keeps the last complete one.
+    """
+    update = {
+        "steps_history": ["generate answer"],
+        "llm_calls": state["llm_calls"] + 1,
+        "answer": answer,
+    }
+    if detector is not None:
+        # The chunks are joined into a single message, as returned by invoke
+        update["answer"] = message_chunk_to_message(answer) if answer else AIMessage(content="")
+        if detector.found:
+            logging.info(f"Refusal found after {detector.length} characters, generation cancelled.")
+            update["steps_history"] = ["answer cancelled"]
+            del update["answer"]
+    return update
+
+
+def generate_answer(state: State, config: RunnableConfig) -> dict:
+    """Node to generate an answer using the context and the question"""
+
+    logging.info("Generating answer...")
+
+    # route_answer_quality adds 2 web results to the next try
+    if should_prefetch(state, config):
+        logging.info("Prefetching the web search of the next try...")
+        prefetches.start(
+            config["configurable"]["thread_id"],
+            web_search_key(state, more_results=2),
+            search_executor.submit(
+                fetch_web_results, state["question"], state["web_max_results"] + 2
+            ),
+        )
+
+    generate_answer_chain, chain_context, chain_config = prepare_generate_answer(
+        state, config
+    )
+    if not config["configurable"].get("speculative_check", GRAPH_SPECULATIVE_CHECK):
+        answer = generate_answer_chain.invoke(chain_context, config=chain_config)
+        return generate_answer_update(state, answer, None)
+
+    # Closing the stream on a refusal stops the generation
+    detector, answer = RefusalDetector(), None
+    with closing(generate_answer_chain.stream(chain_context, config=chain_config)) as chunks:
+        for chunk in chunks:
+            answer = chunk if answer is None else answer + chunk
+            if detector.feed(message_text(chunk)):
+                break
+    return generate_answer_update(state, answer, detector)
+
+
+async def agenerate_answer(state: State, config: RunnableConfig) -> dict:
+    """Async version of generate_answer"""
+
+    logging.info("Generating answer...")
+
+    if should_prefetch(state, config):
+        logging.info("Prefetching the web search of the next try...")
+        prefetches.start(
+            config["configurable"]["thread_id"],
+            web_search_key(state, more_results=2),
+            asyncio.ensure_future(
+                afetch_web_results(state["question"], state["web_max_results"] + 2)
+            ),
+        )
+
+    # Does not block once the prompts are cached, warmed up at startup by server.py.
+    generate_answer_chain, chain_context, chain_config = prepare_generate_answer(
+        state, config
+    )
+    if not config["configurable"].get("speculative_check", GRAPH_SPECULATIVE_CHECK):
+        answer = await generate_answer_chain.ainvoke(chain_context, config=chain_config)
+        return generate_answer_update(state, answer, None)
+
+    detector, answer = RefusalDetector(), None
+    async with aclosing(
+        generate_answer_chain.astream(chain_context, config=chain_config)
+    ) as chunks:
+        async for chunk in chunks:
+            answer = chunk if answer is None else answer + chunk
+            if detector.feed(message_text(chunk)):
+                break
+    return generate_answer_update(state, answer, detector)
+
+
+def check_answer_messages(state: State) -> list:
+    """Messages asking the LLM to check the answer quality"""
+    check_template = """Check if the answer is good enough to be sent to the user.
+    If the answer contains "I'm sorry",
+    or "I couldn't find",
+    or "I don't know",
+    or "I can't answer",
+    or "I don't have enough information",
+    or "I need more context",
+    or "I need more information",
+    or "I need more details",
+    or "I need more context",
+    or "I need more data", then the answer is bad.
+    Otherwise, the answer is good.
+    Return only "good" or "bad", nothing else.
+    Just choose between "good" or "bad".
+    Answer: {answer}"""
+    check_instructions = check_template.format(answer=state["answer"])
+    return [SystemMessage(content=check_instructions)] + [
+        HumanMessage(content="Check the answer quality.")
+    ]
+
+
+def check_answer_rules(state: State, config: RunnableConfig) -> str | None:
+    """Check the answer with the local rules, None if the LLM has to decide"""
+    # Already found bad while it was generated
+    if state["steps_history"][-1] == "answer cancelled":
+        return "bad"
+    if not config["configurable"].get("answer_check_rules", GRAPH_ANSWER_CHECK_RULES):
+        return None
+    return classify_answer(message_text(state["answer"]))
+
+
+def check_answer_quality(
+    state: State, config: RunnableConfig
+) -> Command[Literal["closure", "choose_tool"]]:
+    logging.info("Checking answer quality...")
+
+    verdict = check_answer_rules(state, config)
+    if verdict is not None:
+        return route_answer_quality(state, config, verdict, llm_call=False)
+
+    check_answer = llm.get().invoke(check_answer_messages(state), config=config)
+    return route_answer_quality(state, config, message_text(check_answer), llm_call=True)
+
+
+async def acheck_answer_quality(
+    state: State, config: RunnableConfig
+) -> Command[Literal["closure", "choose_tool"]]:
+    logging.info("Checking answer quality...")
+
+    verdict = check_answer_rules(state, config)
+    if verdict is not None:
+        return route_answer_quality(state, config, verdict, llm_call=False)
+
+    check_answer = await llm.get().ainvoke(check_answer_messages(state), config=config)
+    return route_answer_quality(state, config, message_text(check_answer), llm_call=True)
+
+
+def route_answer_quality(
+    state: State, config: RunnableConfig, content: str, llm_call: bool
+) -> Command[Literal["closure", "choose_tool"]]:
+    """Route to closure or to another try depending on the answer quality check"""
+    logging.info(
+        f"Answer quality check ({'LLM' if llm_call else 'rules'}): {content}"
+    )
+    llm_calls = state["llm_calls"] + (1 if llm_call else 0)
+    llm_calls_saved = state["llm_calls_saved"] + (0 if llm_call else 1)
+
+    # Did we reach the maximum number of steps?
+    # If yes, whatever the answer quality, we stop the graph.
+    if len(state["steps_history"]) >= config["configurable"]["steps_max"]:
+        logging.info("Reached maximum number of steps.")
+        return Command(
+            update={
+                "steps_history": ["too many steps"],
+            },
+            goto="closure",
+        )
+
+    # Did we reach the maximum number of LLM calls?
+    # If yes, whatever the answer quality, we stop the graph.
+    if state["llm_calls"] >= config["configurable"]["model_calls_max"]:
+        logging.info("Reached maximum number of LLM calls.")
+        return Command(
+            update={
+                "steps_history": ["too many LLM calls"],
+            },
+            goto="closure",
+        )
+
+    # Possible Exercise: use Pydantic to force the return type of the LLM call to be "good" or "bad"
+    if "good" in content.lower():
+        return Command(
+            update={
+                "steps_history": ["answer is good"],
+                "llm_calls": llm_calls,
+                "llm_calls_saved": llm_calls_saved,
+            },
+            goto="closure",
+        )
+    else:
+        # Try to search on the web with more results
+        update = {
+            "steps_history": ["answer is bad"],
+            "llm_calls": llm_calls,
+            "llm_calls_saved": llm_calls_saved,
+            "web_max_results": state["web_max_results"] + 2,
+        }
+        # The context reducer deduplicates and bounds the context,
+        # it can also drop the context that leads to the answer considered bad.
+        if config["configurable"].get("reset_context_on_retry", GRAPH_RESET_CONTEXT_ON_RETRY):
+            update["context"] = [RESET_CONTEXT]
+        return Command(update=update, goto="choose_tool")
+
+
+def closure(state: State) -> dict:
+    """Node to stop the graph and return the answer"""
+    logging.info("Ending the graph.")
+
+    logging.info("Steps history: " + " -> ".join(state["steps_history"]))
+    logging.info(f"Number of LLM calls: {state['llm_calls']}")
+    logging.info(f"Number of LLM calls saved by the answer check rules: {state['llm_calls_saved']}")
+    logging.info(f"Web search cache: {web_search_cache.stats()}")
+    logging.info(f"Wikipedia cache: {wikipedia_cache.stats()}")
+    logging.info(f"Prompt cache: {prompt_cache.stats()}")
+    if answer_cache.initialized:
+        logging.info(f"Answer cache: {answer_cache.get().stats()}")
+    logging.info(f"Prefetched web searches: {prefetches.stats()}")
+    logging.info(f"Trace sampling: {trace_sampler.stats()}")
+    if session_memory.initialized:
+        logging.info(f"Session memory: {session_memory.get().stats()}")
+
+    # No complete answer, e.g. the only try was cancelled before "too many steps"
+    if not message_text(state["answer"]).strip():
+        return {"answer": AIMessage(content=GRAPH_NO_ANSWER)}
+    return {}
+
+
+# Build the graph
+builder = StateGraph(State, config_schema=ConfigSchema)
+
+# Nodes
+# Nodes doing I/O have a sync and an async version, used by graph.invoke and graph.ainvoke.
+# The other nodes only compute and are run in a thread by graph.ainvoke.
+builder.add_node("choose_tool", choose_tool)
+builder.add_node("search_osedea", search_osedea)
+# The cached nodes are keyed on the state fields they read, the TTLs are fixed at compile time.
+builder.add_node(
+    "search_web",
+    RunnableLambda(search_web, asearch_web),
+    cache_policy=CachePolicy(
+        key_func=state_key("question", "web_max_results"), ttl=GRAPH_CACHE_TTL_SEARCH_WEB
+    ),
+)
+builder.add_node(
+    "search_wikipedia",
+    RunnableLambda(search_wikipedia, asearch_wikipedia),
+    cache_policy=CachePolicy(
+        key_func=state_key("question"), ttl=GRAPH_CACHE_TTL_SEARCH_WIKIPEDIA
+    ),
+)
+builder.add_node(
+    "generate_answer",
+    RunnableLambda(generate_answer, agenerate_answer),
+    # llm_calls is read to count the call
+    cache_policy=CachePolicy(
+        key_func=state_key("question", "context", "llm_calls"),
+        ttl=GRAPH_CACHE_TTL_GENERATE_ANSWER,
+    ),
+)
+builder.add_node(
+    "check_answer_quality",
+    RunnableLambda(check_answer_quality, acheck_answer_quality),
+    # Needed to draw the graph, the Command destinations cannot be read from a RunnableLambda
+    destinations=("closure", "choose_tool"),
+)
+builder.add_node("closure", closure)
+
+# Edges
+# In "fan_out" routing mode, choose_tool uses Send to call every search_ nodes
+builder.add_edge(START, "choose_tool")
+builder.add_edge("search_osedea", "generate_answer")
+builder.add_edge("search_wikipedia", "generate_answer")
+builder.add_edge("search_web", "generate_answer")
+builder.add_edge("generate_answer", "check_answer_quality")
+builder.add_edge("closure", END)
+
+# Compile the graph, with the cache of the node writes,
+# and the checkpointer saving the state after each step (the thread is the run).
+checkpointer = make_checkpointer(GRAPH_CHECKPOINT_BACKEND, GRAPH_CHECKPOINT_PATH)
+graph = builder.compile(
+    cache=make_node_cache(GRAPH_CACHE_BACKEND, GRAPH_CACHE_PATH), checkpointer=checkpointer
+)
+
+
+def draw_graph(local: bool = False) -> None:
+    """
+    Save the graph as a PNG in the same directory than this script.
+
+    Run with `python main.py --draw-graph`, add `--local` to render with a local browser (pyppeteer)
+    instead of the remote mermaid.ink API.
+    The PNG is only rendered again when the graph topology changes,
+    a hash of the Mermaid source is kept next to it.
+    """
+    mermaid_graph = graph.get_graph()
+    mermaid_hash = hashlib.sha256(mermaid_graph.draw_mermaid().encode()).hexdigest()
+
+    script_dir = os.path.dirname(os.path.abspath(__file__))
+    file_path = os.path.join(script_dir, "langgraph_mermaid_graph.png")
+    hash_path = file_path + ".sha256"
+    if os.path.exists(file_path) and os.path.exists(hash_path):
+        with open(hash_path) as f:
+            if f.read().strip() == mermaid_hash:
+                logging.info("Graph unchanged, PNG not rendered again.")
+                return
+
+    # Generate the PNG byte data
+    try:
+        png_data = mermaid_graph.draw_mermaid_png(
+            draw_method=MermaidDrawMethod.PYPPETEER if local else MermaidDrawMethod.API
+        )
+    except ImportError:
+        # pyppeteer is optional, only needed by --local
+        logging.error(
+            "Rendering with --local needs pyppeteer, install it with `uv sync --extra local-graph`"
+            " (it downloads Chromium on its first run), or render with mermaid.ink without --local."
+        )
+        return
+
+    # Save the PNG data to a file in the same directory than this script
+    with open(file_path, "wb") as f:
+        f.write(png_data)
+    with open(hash_path, "w") as f:
+        f.write(mermaid_hash + "\n")
+    logging.info(f"Graph saved to {file_path}.")
+
+
+def prepare_run(
+    question: str,
+    user_id: str | None = None,
+    session_id: str | None = None,
+    run_id: str | None = None,
+) -> tuple[str, State, dict]:
+    """
+    Prepare the run ID, the initial state and the config to run the graph with a question.
+
+    Give the run_id of a failed run to resume it.
+    """
+
+    # Simulate a user ID from an authentication system.
+    # In a real application, you would get this from your authentication system.
+    # For example, you could get the user ID from the JWT token or from the session.
+    # or you can use a fixed user ID for testing traces related to a fixed user.
+
+    # Simulate multiple questions from the same user during the same run with sessions.
+    # Run this graph multiple times with the same user ID and session ID to see how the traces are grouped.
+    # Sessions are useful to group traces related to the same user interaction.
+    user_id = user_id or "42"
+    session_id = session_id or "session-42"
+    # or generate randomly.
+    # user_id = str(uuid.uuid4())
+    # session_id = f"session-{str(uuid.uuid4()[:8])}"
+
+    # Prepare a managed run ID so that the trace can be sent to Langfuse
+    # even after the graph has run.
+    predefined_run_id = run_id or str(uuid.uuid4())
+
+    # Trace the run in Langfuse, record it for the tail sampling, or neither
+    tracer = trace_sampler.start(predefined_run_id, user_id, langfuse_handler.get)
+
+    # Initialize state
+    initial_state = State(
+        question=question,
+        context=[],
+        answer="",
+        steps_history=[],
+        llm_calls=0,
+        llm_calls_saved=0,
+        web_max_results=GRAPH_WEB_MAX_RESULTS_AT_START,
+    )
+
+    # Config (read-only in langgraph!)
+    config = {
+        "run_id": predefined_run_id,
+        # The checkpoints of the run are saved in their own thread
+        "thread_id": predefined_run_id,
+        "steps_max": GRAPH_STEPS_MAX,
+        "model_calls_max": GRAPH_MODEL_CALLS_MAX,
+        "osedea_find_percent": GRAPH_OSEDEA_FIND_PERCENT,
+        "osedea_search_mode": GRAPH_OSEDEA_SEARCH_MODE,
+        "osedea_vector_weight": GRAPH_OSEDEA_VECTOR_WEIGHT,
+        "gen_answer_prompts": GRAPH_GEN_ANSWER_PROMPTS,
+        "routing_mode": GRAPH_ROUTING_MODE,
+        "search_timeout_seconds": GRAPH_SEARCH_TIMEOUT_SECONDS,
+        "answer_check_rules": GRAPH_ANSWER_CHECK_RULES,
+        "speculative_check": GRAPH_SPECULATIVE_CHECK,
+        "prefetch_next_search": GRAPH_PREFETCH_NEXT_SEARCH,
+        "reset_context_on_retry": GRAPH_RESET_CONTEXT_ON_RETRY,
+        "pack_max_tokens": GRAPH_PACK_MAX_TOKENS,
+        "pack_passage_tokens": GRAPH_PACK_PASSAGE_TOKENS,
+        "callbacks": [tracer] if tracer is not None else [],
+        "metadata": {
+            "langfuse_user_id": user_id,
+            "langfuse_session_id": session_id,
+            "trace_sampling": tracer.sampling if tracer is not None else "off",
+        },
+    }
+
+    return predefined_run_id, initial_state, config
+
+
+def cached_answer(run_id: str, question: str, config: dict) -> AIMessage | None:
+    """
+    Return the good answer of a similar question of the user, from the answer cache.
+
+    A hit has its own Langfuse trace, tagged with "answer_cache": "hit",
+    a miss is tagged with "answer_cache": "miss" in the trace of the graph.
+    """
+    if not ANSWER_CACHE_ENABLED:
+        return None
+    metadata = config["metadata"]
+    hit = answer_cache.get().get(metadata["langfuse_user_id"], question)
+    if hit is None:
+        metadata["answer_cache"] = "miss"
+        return None
+
+    logging.info(f"Answer found in the cache for: {hit.question} ({hit.similarity:.3f})")
+    # The run ends here, without callbacks: counted by the sampler, nothing to replay
+    trace_sampler.finish(run_tracer(config), [])
+    if metadata["trace_sampling"] not in ("user", "head"):
+        return AIMessage(content=hit.answer)
+    langfuse.get().trace(
+        id=run_id,
+        name="LangGraph",
+        user_id=metadata["langfuse_user_id"],
+        session_id=metadata["langfuse_session_id"],
+        input={"question": question},
+        output=hit.answer,
+        metadata={
+            "answer_cache": "hit",
+            "answer_cache_similarity": hit.similarity,
+            "answer_cache_question": hit.question,
+            "answer_cache_run_id": hit.run_id,
+        },
+    )
+    return AIMessage(content=hit.answer)
+
+
+def remember_answer(run_id: str, question: str, config: dict, result_state: dict) -> None:
+    """Store the answer in the answer cache if check_answer_quality found it good"""
+    if ANSWER_CACHE_ENABLED and result_state["steps_history"][-1] == "answer is good":
+        answer = result_state["answer"]
+        web = any(document.source_tool == "search_web" for document in result_state["context"])
+        answer_cache.get().set(
+            config["metadata"]["langfuse_user_id"],
+            question,
+            getattr(answer, "content", answer),
+            run_id,
+            ttl=ANSWER_CACHE_WEB_TTL_SECONDS if web else None,
+        )
+
+
+def recall_session(question: str, initial_state: State, config: dict) -> None:
+    """
+    Start the run with the documents of the session relevant to the question.
+
+    Tagged in the trace with "session_memory": "hit" or "miss".
+    """
+    if not SESSION_MEMORY_ENABLED:
+        return
+    metadata = config["metadata"]
+    documents = session_memory.get().recall(
+        metadata["langfuse_user_id"], metadata["langfuse_session_id"], question
+    )
+    metadata["session_memory"] = "hit" if documents else "miss"
+    if documents:
+        logging.info(f"Reusing {len(documents)} documents of the session.")
+        initial_state["context"] = documents
+
+
+def remember_session(question: str, config: dict, result_state: dict) -> None:
+    """Keep the documents of the run for the next turns of the session, with the answer if good"""
+    if not SESSION_MEMORY_ENABLED:
+        return
+    metadata = config["metadata"]
+    answer = None
+    if result_state["steps_history"][-1] == "answer is good":
+        answer = getattr(result_state["answer"], "content", result_state["answer"])
+    session_memory.get().remember(
+        metadata["langfuse_user_id"],
+        metadata["langfuse_session_id"],
+        question,
+        result_state["context"],
+        answer,
+    )
+
+
+def forget_run(run_id: str) -> None:
+    """Delete the checkpoints of a finished run, see GRAPH_CHECKPOINT_KEEP_FINISHED"""
+    if checkpointer is not None and not GRAPH_CHECKPOINT_KEEP_FINISHED:
+        checkpointer.delete_thread(run_id)
+
+
+def run_tracer(config: dict) -> RunTracer | None:
+    """The tracer of the run, None if the run is not traced"""
+    return next((c for c in config["callbacks"] if isinstance(c, RunTracer)), None)
+
+
+def finish_trace(run_id: str, config: dict, result_state: dict) -> None:
+    """
+    Send the recording of the run if the tail sampling keeps it,
+    and add the tracing overhead to the metadata of the traced runs.
+    """
+    tracer = run_tracer(config)
+    if trace_sampler.finish(tracer, result_state["steps_history"]):
+        # An upsert of the trace, with its start time (the default is now)
+        langfuse.get().trace(
+            id=run_id,
+            timestamp=tracer.started_at,
+            metadata={"tracing_overhead_ms": round(tracer.overhead * 1000, 3)},
+        )
+
+
+def finish_run(run_id: str, question: str, config: dict, result_state: dict) -> None:
+    """Keep what the next questions can reuse, and delete the checkpoints of the run"""
+    finish_trace(run_id, config, result_state)
+    remember_answer(run_id, question, config, result_state)
+    remember_session(question, config, result_state)
+    prefetches.cancel(run_id)
+    forget_run(run_id)
+
+
+def resume_graph(run_id, user_id=None, session_id=None):
+    """
+    Resume a failed run from its last checkpoint.
+
+    The nodes completed before the failure are not run again,
+    e.g. the searches that succeeded when generate_answer timed out.
+    """
+    _, _, config = prepare_run("", user_id, session_id, run_id=run_id)
+    snapshot = graph.get_state({"configurable": {"thread_id": run_id}})
+    if not snapshot.values:
+        raise ValueError(f"No checkpoint for the run {run_id}")
+    if snapshot.next:
+        logging.info(f"Resuming run {run_id} at {', '.join(snapshot.next)}...")
+        result_state = graph.invoke(None, config)
+        finish_run(run_id, result_state["question"], config, result_state)
+    else:
+        result_state = snapshot.values
+        forget_run(run_id)
+
+    return run_id, result_state["answer"]
+
+
+def run_graph(question, user_id=None, session_id=None):
+    """Run the graph with a question, unless a similar question was already answered"""
+    run_id, initial_state, config = prepare_run(question, user_id, session_id)
+    answer = cached_answer(run_id, question, config)
+    if answer is not None:
+        return run_id, answer
+
+    # Run the graph, from the documents of the session if relevant
+    recall_session(question, initial_state, config)
+    result_state = graph.invoke(initial_state, config)
+    finish_run(run_id, question, config, result_state)
+
+    return run_id, result_state["answer"]
+
+
+async def arun_graph(question, user_id=None, session_id=None):
+    """
+    Run the graph with a question, without blocking the event loop.
+
+    Many questions can be answered concurrently on the same event loop,
+    e.g. with asyncio.gather(*(arun_graph(question) for question in questions)).
+    """
+    run_id, initial_state, config = prepare_run(question, user_id, session_id)
+    answer = cached_answer(run_id, question, config)
+    if answer is not None:
+        return run_id, answer
+
+    # Run the graph, from the documents of the session if relevant
+    recall_session(question, initial_state, config)
+    result_state = await graph.ainvoke(initial_state, config)
+    finish_run(run_id, question, config, result_state)
+
+    return run_id, result_state["answer"]
+
+
+def stream_graph(question, user_id=None, session_id=None) -> Iterator[StreamEvent]:
+    """
+    Run the graph with a question, yielding its progress and the answer tokens as they arrive.
+
+    The events are "node" when a node finishes, "token" for each piece of the answer
+    being generated (a bad answer is followed by the tokens of the next try),
+    and "answer" at the end, with the run ID and the final answer.
+    Send them as server-sent events with event.sse().
+    """
+    run_id, initial_state, config = prepare_run(question, user_id, session_id)
+    answer = cached_answer(run_id, question, config)
+    if answer is not None:
+        yield StreamEvent("token", {"text": message_text(answer)})
+        yield StreamEvent("answer", {"run_id": run_id, "answer": message_text(answer), "steps": []})
+        return
+
+    recall_session(question, initial_state, config)
+    reader = GraphStreamReader()
+    for mode, chunk in graph.stream(initial_state, config, stream_mode=STREAM_MODES):
+        yield from reader.read(mode, chunk)
+    finish_run(run_id, question, config, reader.state)
+    yield reader.answer_event(run_id)
+
+
+async def astream_graph(question, user_id=None, session_id=None) -> AsyncIterator[StreamEvent]:
+    """Same as stream_graph, as an async iterator not blocking the event loop"""
+    run_id, initial_state, config = prepare_run(question, user_id, session_id)
+    answer = cached_answer(run_id, question, config)
+    if answer is not None:
+        yield StreamEvent("token", {"text": message_text(answer)})
+        yield StreamEvent("answer", {"run_id": run_id, "answer": message_text(answer), "steps": []})
+        return
+
+    recall_session(question, initial_state, config)
+    reader = GraphStreamReader()
+    async for mode, chunk in graph.astream(initial_state, config, stream_mode=STREAM_MODES):
+        for event in reader.read(mode, chunk):
+            yield event
+    finish_run(run_id, question, config, reader.state)
+    yield reader.answer_event(run_id)
+
+
+def complete(text, state):
+    """Autocomplete function for the question input"""
+    options = [example[0] for example in EXAMPLES]
+    matches = [option for option in options if option.startswith(text)]
+    if state < len(matches):
+        return matches[state]
+    else:
+        return None
+
+
+if __name__ == "__main__":
+    if "--draw-graph" in sys.argv:
+        draw_graph(local="--local" in sys.argv)
+        exit(0)
+
+    if "--resume" in sys.argv:
+        # Resume a failed run, e.g. python main.py --resume <run_id>
+        run_id, answer = resume_graph(sys.argv[sys.argv.index("--resume") + 1])
+        logging.info(f"Answer: {answer.content}")
+        exit(0)
+
+    print("Welcome to the Osedea Workshop on Agent demo!")
+    print()
+    print("Here are some examples of questions you can ask (autocomplete with tab):")
+    for question, description in EXAMPLES:
+        print(f"- {question} ({description})")
+    print()
+
+    readline.set_completer(complete)
+    # To avoid completing only on the start of the last word
+    readline.set_completer_delims("")
+    # This is the default binding, not working well on MacOS and new Linux terminals.
+    # readline.parse_and_bind("tab: complete")
+    readline.parse_and_bind("bind ^I rl_complete")
+    question = input("What is your question? ")
+    if not question:
+        print("No question provided.")
+        exit(0)
+
+    # Stream the answer, the user reads it while it is generated
+    logging.info("Running graph...")
+    line_open = False
+    for event in stream_graph(question):
+        if event.event == "token":
+            print(event.data["text"], end="", flush=True)
+            line_open = True
+        elif line_open:
+            print()
+            line_open = False
+        if event.event == "node":
+            logging.info(f"Node {event.data['node']} done: {', '.join(event.data['steps'])}")
+    run_id = event.data["run_id"]
+    logging.info(f"Answer: {event.data['answer']}")
+    logging.info("Graph finished.")
+
+    # Simulate a user feedback with a note from 1 to 5.
+    # In a real application, you would get this from the user input.
+    # See https://langfuse.com/docs/scores/user-feedback#integration-example
+    # to see how to use the LangfuseWeb component to collect user feedback.
+    # The score is sent in the background, in batches, see feedback.py.
+    user_feedback = random.randint(1, 5)
+    feedback.get().submit(
+        run_id,
+        "user_feedback",
+        user_feedback,
+        data_type="NUMERIC",  # optional, inferred if not provided
+    )
+    logging.info(f"Simulate user feedback: {user_feedback} (1 to 5)")
+    # Before exiting, else the score is sent at the next start
+    feedback.get().flush(timeout=FEEDBACK_FLUSH_SECONDS * 5)
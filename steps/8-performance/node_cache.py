@@ -0,0 +1,150 @@
+import json
+import logging
+import os
+import sqlite3
+import threading
+import time
+from collections.abc import Mapping, Sequence
+from typing import Any, Callable
+
+from langgraph.cache.base import BaseCache, FullKey, Namespace
+from langgraph.cache.memory import InMemoryCache
+from langgraph.constants import ERROR, INTERRUPT
+from langgraph.utils.cache import default_cache_key
+
+
+def state_key(*fields: str) -> Callable[[dict], bytes]:
+    """
+    The cache key function of a node reading only these fields of the state.
+
+    The other fields (e.g. steps_history) change at each loop,
+    they would make every key different.
+    """
+
+    def key(state: dict) -> bytes:
+        # get: the graph is drawn with an empty state
+        return default_cache_key(*(state.get(field) for field in fields))  # type: ignore[return-value]
+
+    return key
+
+
+def is_cacheable(writes: Any) -> bool:
+    """
+    Whether the writes of a node are worth caching.
+
+    A node that failed or was interrupted must run again: LangGraph (sync) still sends
+    its empty writes to the cache, and replaying them crashes the next runs.
+    A search that timed out must be tried again too.
+    """
+    if not writes:
+        return False
+    for channel, value in writes:
+        if channel in (ERROR, INTERRUPT):
+            return False
+        if channel == "steps_history" and any(step.startswith("timeout") for step in value):
+            return False
+    return True
+
+
+class InMemoryNodeCache(InMemoryCache):
+    """The LangGraph in-memory cache, without the writes of timed out searches"""
+
+    def set(self, keys: Mapping[FullKey, tuple[Any, int | None]]) -> None:
+        super().set({key: entry for key, entry in keys.items() if is_cacheable(entry[0])})
+
+
+class SqliteNodeCache(BaseCache):
+    """
+    Node writes cached in a SQLite file.
+
+    Survives restarts and can be shared by several processes on the same host.
+    """
+
+    def __init__(self, path: str, **kwargs):
+        super().__init__(**kwargs)
+        if os.path.dirname(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+        self._connection = sqlite3.connect(path, check_same_thread=False)
+        self._connection.execute(
+            "CREATE TABLE IF NOT EXISTS node_writes ("
+            " namespace TEXT NOT NULL,"
+            " key TEXT NOT NULL,"
+            " encoding TEXT NOT NULL,"
+            " value BLOB NOT NULL,"
+            " expires_at REAL,"
+            " PRIMARY KEY (namespace, key))"
+        )
+        self._connection.commit()
+        self._lock = threading.Lock()
+
+    def get(self, keys: Sequence[FullKey]) -> dict[FullKey, Any]:
+        values = {}
+        now = time.time()
+        with self._lock:
+            for namespace, key in keys:
+                row = self._connection.execute(
+                    "SELECT encoding, value, expires_at FROM node_writes"
+                    " WHERE namespace = ? AND key = ?",
+                    (json.dumps(namespace), key),
+                ).fetchone()
+                if row is None:
+                    continue
+                encoding, value, expires_at = row
+                if expires_at is not None and expires_at < now:
+                    self._connection.execute(
+                        "DELETE FROM node_writes WHERE namespace = ? AND key = ?",
+                        (json.dumps(namespace), key),
+                    )
+                    self._connection.commit()
+                    continue
+                writes = self.serde.loads_typed((encoding, value))
+                # Written before the failed nodes were excluded, the node runs again
+                if is_cacheable(writes):
+                    values[(namespace, key)] = writes
+        return values
+
+    async def aget(self, keys: Sequence[FullKey]) -> dict[FullKey, Any]:
+        return self.get(keys)
+
+    def set(self, pairs: Mapping[FullKey, tuple[Any, int | None]]) -> None:
+        rows = []
+        for (namespace, key), (value, ttl) in pairs.items():
+            if is_cacheable(value):
+                encoding, data = self.serde.dumps_typed(value)
+                expires_at = None if ttl is None else time.time() + ttl
+                rows.append((json.dumps(namespace), key, encoding, data, expires_at))
+        with self._lock:
+            self._connection.executemany(
+                "INSERT OR REPLACE INTO node_writes VALUES (?, ?, ?, ?, ?)", rows
+            )
+            self._connection.commit()
+
+    async def aset(self, pairs: Mapping[FullKey, tuple[Any, int | None]]) -> None:
+        self.set(pairs)
+
+    def clear(self, namespaces: Sequence[Namespace] | None = None) -> None:
+        with self._lock:
+            if namespaces is None:
+                self._connection.execute("DELETE FROM node_writes")
+            else:
+                self._connection.executemany(
+                    "DELETE FROM node_writes WHERE namespace = ?",
+                    [(json.dumps(namespace),) for namespace in namespaces],
+                )
+            self._connection.commit()
+
+    async def aclear(self, namespaces: Sequence[Namespace] | None = None) -> None:
+        self.clear(namespaces)
+
+
+def make_node_cache(backend: str, path: str) -> BaseCache | None:
+    """Create the cache of the node writes for the given backend ("none", "memory" or "sqlite")"""
+    logging.info(f"Using {backend} node cache.")
+    if backend == "none":
+        return None
+    elif backend == "memory":
+        return InMemoryNodeCache()
+    elif backend == "sqlite":
+        return SqliteNodeCache(path)
+    else:
+        raise ValueError(f"Unknown node cache backend: {backend}")
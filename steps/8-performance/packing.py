@@ -0,0 +1,251 @@
+import logging
+import math
+import re
+import threading
+import time
+from collections import Counter
+from dataclasses import dataclass, replace
+from typing import Callable
+
+from context import ContextDocument, estimate_tokens
+
+TOKENIZER_FALLBACK_ENCODING = "o200k_base"
+"""The tiktoken encoding used when the model is unknown to tiktoken"""
+
+TOKENIZER_RETRY_SECONDS = 300.0
+"""After a failed load (e.g. offline), the tokens are estimated this long before loading again"""
+
+BM25_K1 = 1.5
+"""How fast the score of a term saturates with its frequency in the passage"""
+
+BM25_B = 0.75
+"""How much the score is normalized by the length of the passage"""
+
+WORD_REGEX = re.compile(r"\w+")
+
+
+# The counters of the encodings loaded, per model, and the time of the last failed load.
+_token_counters: dict[str, Callable[[str], int]] = {}
+_token_counters_loading: set[str] = set()
+_token_counters_failed: dict[str, float] = {}
+_token_counters_lock = threading.Lock()
+
+
+def token_counter(model_name: str) -> Callable[[str], int]:
+    """
+    Return a function counting the tokens of a text for the model, with tiktoken.
+
+    The encoding is loaded once per model, in a background thread (tiktoken may download it):
+    the caller, e.g. a node on the event loop, never waits, the tokens are estimated meanwhile.
+    If it cannot be loaded, a call after TOKENIZER_RETRY_SECONDS tries again.
+    """
+    counter = _token_counters.get(model_name)
+    if counter is not None:
+        return counter
+    with _token_counters_lock:
+        failed_at = _token_counters_failed.get(model_name)
+        start = model_name not in _token_counters_loading and (
+            failed_at is None or time.monotonic() - failed_at >= TOKENIZER_RETRY_SECONDS
+        )
+        if start:
+            _token_counters_loading.add(model_name)
+    if start:
+        threading.Thread(
+            target=load_token_counter, args=(model_name,), name="tokenizer", daemon=True
+        ).start()
+    return estimate_tokens
+
+
+def load_token_counter(model_name: str) -> Callable[[str], int] | None:
+    """
+    Load the tiktoken encoding of the model now, None if it cannot be loaded.
+
+    Only the first failure is logged as a warning, the retries fail quietly.
+    """
+    try:
+        import tiktoken
+
+        try:
+            encoding = tiktoken.encoding_for_model(model_name)
+        except KeyError:
+            encoding = tiktoken.get_encoding(TOKENIZER_FALLBACK_ENCODING)
+    except Exception as e:
+        with _token_counters_lock:
+            retry = model_name in _token_counters_failed
+            _token_counters_failed[model_name] = time.monotonic()
+        log = logging.debug if retry else logging.warning
+        log(f"No tokenizer for {model_name} yet, the tokens are estimated: {e}")
+        return None
+    else:
+        counter = _token_counters[model_name] = lambda text: len(
+            encoding.encode(text, disallowed_special=())
+        )
+        with _token_counters_lock:
+            _token_counters_failed.pop(model_name, None)
+        return counter
+    finally:
+        with _token_counters_lock:
+            _token_counters_loading.discard(model_name)
+
+
+def tokenize(text: str) -> list[str]:
+    """The lowercase words of a text, for the lexical ranking"""
+    return WORD_REGEX.findall(text.lower())
+
+
+def split_passages(
+    content: str, max_tokens: int, count_tokens: Callable[[str], int]
+) -> list[str]:
+    """
+    Split a document into passages of about max_tokens.
+
+    Paragraphs are kept together and merged while they fit,
+    a paragraph longer than max_tokens is cut between words.
+    """
+    passages: list[str] = []
+    current: list[str] = []
+    current_tokens = 0
+
+    def flush():
+        nonlocal current, current_tokens
+        if current:
+            passages.append("\n\n".join(current))
+        current, current_tokens = [], 0
+
+    for paragraph in re.split(r"\n\s*\n", content):
+        paragraph = paragraph.strip()
+        if not paragraph:
+            continue
+        tokens = count_tokens(paragraph)
+        if tokens > max_tokens:
+            flush()
+            words = paragraph.split()
+            # Cut by number of words, at the average number of tokens per word
+            step = max(1, len(words) * max_tokens // tokens)
+            passages.extend(" ".join(words[i : i + step]) for i in range(0, len(words), step))
+            continue
+        if current_tokens + tokens > max_tokens:
+            flush()
+        current.append(paragraph)
+        current_tokens += tokens
+    flush()
+    return passages
+
+
+class BM25:
+    """
+    The Okapi BM25 ranking of a small set of passages, built for one question.
+
+    The passages of a context are a few dozens, the index is kept in memory
+    and built again for each answer.
+    """
+
+    def __init__(self, passages: list[str], k1: float = BM25_K1, b: float = BM25_B):
+        self.k1 = k1
+        self.b = b
+        self._term_frequencies = [Counter(tokenize(passage)) for passage in passages]
+        self._lengths = [sum(tf.values()) for tf in self._term_frequencies]
+        self._average_length = sum(self._lengths) / len(passages) if passages else 0.0
+        document_frequencies = Counter(
+            term for tf in self._term_frequencies for term in tf
+        )
+        count = len(passages)
+        self._idf = {
+            term: math.log(1 + (count - df + 0.5) / (df + 0.5))
+            for term, df in document_frequencies.items()
+        }
+
+    def scores(self, query: str) -> list[float]:
+        """The score of each passage for the query, in the order of the passages"""
+        terms = [term for term in set(tokenize(query)) if term in self._idf]
+        scores = []
+        for tf, length in zip(self._term_frequencies, self._lengths):
+            norm = self.k1 * (1 - self.b + self.b * length / (self._average_length or 1))
+            scores.append(
+                sum(
+                    self._idf[term] * tf[term] * (self.k1 + 1) / (tf[term] + norm)
+                    for term in terms
+                    if term in tf
+                )
+            )
+        return scores
+
+
+@dataclass(frozen=True)
+class PackedContext:
+    """The documents to put in the prompt, with the numbers to trace"""
+
+    documents: list[ContextDocument]
+    """The documents, each one reduced to its selected passages"""
+    tokens: int
+    """The number of tokens of the selected passages"""
+    tokens_total: int
+    """The number of tokens of the whole context, before packing"""
+    passages: int
+    """The number of passages selected"""
+    passages_total: int
+    """The number of passages of the whole context"""
+
+    def metadata(self) -> dict:
+        """The packing numbers, as trace metadata"""
+        return {
+            "context_tokens": self.tokens,
+            "context_tokens_total": self.tokens_total,
+            "context_passages": self.passages,
+            "context_passages_total": self.passages_total,
+            "context_documents": len(self.documents),
+        }
+
+
+def pack_context(
+    question: str,
+    documents: list[ContextDocument],
+    max_tokens: int,
+    passage_tokens: int,
+    count_tokens: Callable[[str], int],
+) -> PackedContext:
+    """
+    Select the passages of the context most relevant to the question, under max_tokens.
+
+    The passages are ranked with BM25 and taken greedily, best first, skipping those not fitting.
+    The selected passages are put back in their document and in their original order,
+    so the prompt still reads like the documents.
+    """
+    passages: list[tuple[int, str, int]] = []
+    for i, document in enumerate(documents):
+        for passage in split_passages(document.content, passage_tokens, count_tokens):
+            passages.append((i, passage, count_tokens(passage)))
+    tokens_total = sum(tokens for _, _, tokens in passages)
+
+    if tokens_total <= max_tokens:
+        selected = set(range(len(passages)))
+    else:
+        scores = BM25([passage for _, passage, _ in passages]).scores(question)
+        # Stable sort, the earlier passage goes first between equal scores
+        ranking = sorted(range(len(passages)), key=lambda j: -scores[j])
+        selected, budget = set(), max_tokens
+        for j in ranking:
+            if passages[j][2] <= budget:
+                selected.add(j)
+                budget -= passages[j][2]
+
+    by_document: dict[int, list[str]] = {}
+    for j, (i, passage, _) in enumerate(passages):
+        if j in selected:
+            by_document.setdefault(i, []).append(passage)
+    packed_documents = [
+        replace(documents[i], content="\n\n".join(parts), tokens=0)
+        for i, parts in by_document.items()
+    ]
+    packed = PackedContext(
+        documents=packed_documents,
+        tokens=sum(passages[j][2] for j in selected),
+        tokens_total=tokens_total,
+        passages=len(selected),
+        passages_total=len(passages),
+    )
+    logging.info(
+        f"Context packed: {packed.tokens}/{packed.tokens_total} tokens, "
+        f"{packed.passages}/{packed.passages_total} passages."
+    )
+    return packed
@@ -0,0 +1,79 @@
+import asyncio
+import logging
+import threading
+from collections.abc import Hashable
+from concurrent.futures import Future
+
+
+class PrefetchRegistry:
+    """
+    The searches started ahead of time for the next try of each run.
+
+    A search is started while the answer is generated and checked,
+    it is taken by the search node if the answer is bad, or cancelled at the end of the run.
+    The futures are concurrent futures (graph.invoke) or asyncio tasks (graph.ainvoke).
+    """
+
+    def __init__(self):
+        self.started = 0
+        """Number of searches prefetched"""
+        self.used = 0
+        """Number of prefetched searches taken by a search node"""
+        self.cancelled = 0
+        """Number of prefetched searches never used, cancelled at the end of their run"""
+        self._runs: dict[str, dict[Hashable, Future | asyncio.Task]] = {}
+        self._lock = threading.Lock()
+
+    def start(self, run_id: str, key: Hashable, future: Future | asyncio.Task) -> None:
+        """Park a search started for the run, a previous one with the same key is replaced"""
+        with self._lock:
+            previous = self._runs.setdefault(run_id, {}).pop(key, None)
+            self._runs[run_id][key] = future
+            self.started += 1
+        if previous is not None:
+            self._cancel(previous)
+
+    def has(self, run_id: str, key: Hashable) -> bool:
+        """Whether a search is parked for the run"""
+        with self._lock:
+            return key in self._runs.get(run_id, {})
+
+    def take(self, run_id: str, key: Hashable) -> Future | asyncio.Task | None:
+        """Remove and return the search parked for the run, if any"""
+        with self._lock:
+            future = self._runs.get(run_id, {}).pop(key, None)
+            if future is not None:
+                self.used += 1
+            return future
+
+    def cancel(self, run_id: str) -> int:
+        """Cancel the searches of the run never used, return their number"""
+        with self._lock:
+            futures = list(self._runs.pop(run_id, {}).values())
+            self.cancelled += len(futures)
+        for future in futures:
+            self._cancel(future)
+        if futures:
+            logging.info(f"{len(futures)} prefetched searches not used, cancelled.")
+        return len(futures)
+
+    def stats(self) -> dict:
+        """The prefetch counters, to follow how often a prefetch pays off"""
+        with self._lock:
+            return {
+                "started": self.started,
+                "used": self.used,
+                "cancelled": self.cancelled,
+                "pending": sum(len(futures) for futures in self._runs.values()),
+            }
+
+    @staticmethod
+    def _cancel(future: Future | asyncio.Task) -> None:
+        # A concurrent future already running cannot be stopped, its result is only dropped
+        # (it still ends up in the search caches). An asyncio task is cancelled on its loop.
+        if future.done():
+            return
+        if isinstance(future, asyncio.Task):
+            future.get_loop().call_soon_threadsafe(future.cancel)
+        else:
+            future.cancel()
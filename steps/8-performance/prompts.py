@@ -0,0 +1,212 @@
+import json
+import logging
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass
+from typing import Any, Callable
+
+from langchain_core.prompts import PromptTemplate
+
+
+@dataclass(frozen=True)
+class CompiledPrompt:
+    """A Langfuse prompt with its LangChain template, ready to be used in a chain"""
+
+    name: str
+    version: int
+    langfuse_prompt: Any
+    """The Langfuse prompt client, necessary for langfuse to track prompt usage in traces"""
+    template: PromptTemplate
+
+
+def compile_prompt(langfuse_prompt: Any) -> CompiledPrompt:
+    """Build the LangChain template of a Langfuse prompt"""
+    # See https://github.com/langfuse/langfuse/issues/5374#issuecomment-2686397964
+    # about the issue with ChatPromptTemplate or SystemMessagePromptTemplate
+    template = PromptTemplate.from_template(
+        # convert langfuse prompt {{}} to langchain prompt {} for formatting
+        langfuse_prompt.get_langchain_prompt(),
+        # necessary for langfuse to track prompt usage in traces
+        metadata={"langfuse_prompt": langfuse_prompt},
+    )
+    return CompiledPrompt(
+        name=langfuse_prompt.name,
+        version=langfuse_prompt.version,
+        langfuse_prompt=langfuse_prompt,
+        template=template,
+    )
+
+
+class PromptCache:
+    """
+    Compiled prompts, refreshed in the background (stale-while-revalidate).
+
+    - A fresh prompt is returned directly.
+    - A stale prompt is returned directly too, and a refresh is scheduled in the background.
+    - A missing prompt is fetched, or read from the fallback directory if the prompt server is unreachable.
+
+    Compiled templates are kept by prompt name and version,
+    a refresh returning the same version does not parse the template again.
+    Each new version is saved in the fallback directory.
+    """
+
+    def __init__(
+        self,
+        fetch: Callable[[str], Any],
+        ttl: float = 60,
+        fallback_dir: str | None = None,
+    ):
+        self.ttl = ttl
+        """Time in seconds after which a prompt is refreshed in the background"""
+        self.fallback_dir = fallback_dir
+        """Directory of the last known version of each prompt, as <name>.json"""
+        self.hits = 0
+        """Number of prompts returned without waiting for the prompt server"""
+        self.misses = 0
+        """Number of prompts fetched while the caller was waiting"""
+        self.fallbacks = 0
+        """Number of prompts read from the fallback directory"""
+        self._fetch = fetch
+        self._latest: dict[str, tuple[CompiledPrompt, float]] = {}
+        self._compiled: dict[tuple[str, int], CompiledPrompt] = {}
+        self._refreshing: set[str] = set()
+        self._lock = threading.Lock()
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="prompts")
+
+    def get(self, name: str) -> CompiledPrompt:
+        """Return the compiled prompt, only blocking if it was never fetched"""
+        with self._lock:
+            entry = self._latest.get(name)
+        if entry is not None:
+            compiled, fetched_at = entry
+            if time.time() - fetched_at > self.ttl:
+                self._schedule_refresh(name)
+            with self._lock:
+                self.hits += 1
+            return compiled
+
+        with self._lock:
+            self.misses += 1
+        try:
+            return self.refresh(name)
+        except Exception as e:
+            compiled = self._load_fallback(name)
+            if compiled is None:
+                raise
+            logging.warning(f"Using fallback prompt for {name} due to fetch error: {e}")
+            with self._lock:
+                self.fallbacks += 1
+                # Stale right away, the next call will try the prompt server in the background.
+                self._latest[name] = (compiled, 0.0)
+            return compiled
+
+    def refresh(self, name: str) -> CompiledPrompt:
+        """Fetch the prompt now and update the cache"""
+        langfuse_prompt = self._fetch(name)
+        key = (name, langfuse_prompt.version)
+        with self._lock:
+            compiled = self._compiled.get(key)
+        is_new = compiled is None or compiled.langfuse_prompt.is_fallback
+        if is_new:
+            compiled = compile_prompt(langfuse_prompt)
+            self._save_fallback(langfuse_prompt)
+        with self._lock:
+            self._compiled[key] = compiled  # type: ignore[assignment]
+            self._latest[name] = (compiled, time.time())  # type: ignore[assignment]
+        if is_new:
+            logging.info(f"Prompt {name} version {compiled.version} compiled.")  # type: ignore[union-attr]
+        return compiled  # type: ignore[return-value]
+
+    def warm_up(self, names: list[str]) -> None:
+        """Fetch the prompts ahead of time, e.g. at server startup"""
+        for name in names:
+            self.get(name)
+
+    def stats(self) -> dict:
+        """Counters to see how often the prompt server was waited for"""
+        return {"hits": self.hits, "misses": self.misses, "fallbacks": self.fallbacks}
+
+    def _schedule_refresh(self, name: str) -> None:
+        with self._lock:
+            if name in self._refreshing:
+                return
+            self._refreshing.add(name)
+
+        def refresh():
+            try:
+                self.refresh(name)
+            except Exception as e:
+                logging.warning(f"Prompt {name} not refreshed, keeping the cached one: {e}")
+            finally:
+                with self._lock:
+                    self._refreshing.discard(name)
+
+        self._executor.submit(refresh)
+
+    def _fallback_path(self, name: str) -> str:
+        return os.path.join(self.fallback_dir, f"{name}.json")  # type: ignore[arg-type]
+
+    def _save_fallback(self, langfuse_prompt: Any) -> None:
+        if self.fallback_dir is None or langfuse_prompt.is_fallback:
+            return
+        os.makedirs(self.fallback_dir, exist_ok=True)
+        with open(self._fallback_path(langfuse_prompt.name), "w") as f:
+            json.dump(
+                {
+                    "name": langfuse_prompt.name,
+                    "version": langfuse_prompt.version,
+                    "prompt": langfuse_prompt.prompt,
+                    "config": langfuse_prompt.config,
+                    "labels": langfuse_prompt.labels,
+                    "tags": langfuse_prompt.tags,
+                },
+                f,
+            )
+
+    def _load_fallback(self, name: str) -> CompiledPrompt | None:
+        if self.fallback_dir is None or not os.path.exists(self._fallback_path(name)):
+            return None
+        from langfuse.model import Prompt_Text, TextPromptClient  # type: ignore
+
+        with open(self._fallback_path(name)) as f:
+            prompt = Prompt_Text(**json.load(f))
+        return compile_prompt(TextPromptClient(prompt, is_fallback=True))
+
+
+class ChainRegistry:
+    """
+    One `prompt | llm` chain per prompt version, built on first use and reused across runs.
+
+    The chain is built again only when the prompt cache returns a new version
+    (or when the LLM client is replaced).
+    """
+
+    def __init__(self, prompt_cache: PromptCache, llm: Callable[[], Any]):
+        self.prompt_cache = prompt_cache
+        """Where the compiled prompts come from"""
+        self._llm = llm
+        self._chains: dict[str, tuple[CompiledPrompt, Any, Any]] = {}
+        self._lock = threading.Lock()
+
+    def get(self, name: str) -> Any:
+        """Return the chain of the current version of the prompt"""
+        compiled = self.prompt_cache.get(name)
+        llm = self._llm()
+        with self._lock:
+            entry = self._chains.get(name)
+        if entry is not None and entry[0] is compiled and entry[1] is llm:
+            return entry[2]
+
+        # You need this construction to have the prompt tracked in traces.
+        # Otherwise, created manually, the prompt will not be tracked in traces.
+        chain = compiled.template | llm
+        with self._lock:
+            self._chains[name] = (compiled, llm, chain)
+        return chain
+
+    def warm_up(self, names: list[str]) -> None:
+        """Build the chains ahead of time, e.g. at server startup"""
+        for name in names:
+            self.get(name)
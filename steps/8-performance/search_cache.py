@@ -0,0 +1,186 @@
+import json
+import logging
+import os
+import re
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+
+
+def normalize_question(question: str) -> str:
+    """Normalize a question so that trivial variations share the same cache key"""
+    question = re.sub(r"\s+", " ", question.strip().lower())
+    return question.rstrip(" ?!.")
+
+
+class SearchCache:
+    """
+    Base class for the search result caches.
+
+    Entries are keyed by the normalized question.
+    Each entry remembers the `max_results` it was fetched with,
+    so a request for fewer results can be answered by truncating a bigger entry.
+    """
+
+    def __init__(self, ttl: float | None = None, max_entries: int = 1024):
+        self.ttl = ttl
+        """Time to live of an entry in seconds. If None, entries never expire."""
+        self.max_entries = max_entries
+        """Maximum number of entries kept before evicting the least recently used ones"""
+        self.hits = 0
+        """Number of lookups answered from the cache"""
+        self.misses = 0
+        """Number of lookups that needed a real search"""
+        self._lock = threading.Lock()
+
+    def get(self, question: str, max_results: int) -> list | None:
+        """Return the cached results for the question, or None if we need to search"""
+        key = normalize_question(question)
+        with self._lock:
+            entry = self._load(key)
+            if entry is not None:
+                cached_max_results, results, created_at = entry
+                if self._is_expired(created_at):
+                    self._delete(key)
+                elif cached_max_results >= max_results:
+                    self.hits += 1
+                    return results[:max_results]
+            self.misses += 1
+            return None
+
+    def set(self, question: str, max_results: int, results: list) -> None:
+        """Store the results of a search, unless a bigger fresh entry already exists"""
+        key = normalize_question(question)
+        with self._lock:
+            entry = self._load(key)
+            if entry is not None:
+                cached_max_results, _, created_at = entry
+                if cached_max_results > max_results and not self._is_expired(created_at):
+                    return
+            self._store(key, max_results, results, time.time())
+            self._evict()
+
+    def stats(self) -> dict:
+        """Hit/miss counters, to see how many searches the cache saved"""
+        lookups = self.hits + self.misses
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / lookups if lookups else 0.0,
+        }
+
+    def _is_expired(self, created_at: float) -> bool:
+        return self.ttl is not None and time.time() - created_at > self.ttl
+
+    # Backend specific storage, called with the lock held.
+    def _load(self, key: str) -> tuple[int, list, float] | None:
+        raise NotImplementedError
+
+    def _store(self, key: str, max_results: int, results: list, created_at: float) -> None:
+        raise NotImplementedError
+
+    def _delete(self, key: str) -> None:
+        raise NotImplementedError
+
+    def _evict(self) -> None:
+        raise NotImplementedError
+
+
+class InMemorySearchCache(SearchCache):
+    """LRU search cache living in the process memory"""
+
+    def __init__(self, ttl: float | None = None, max_entries: int = 1024):
+        super().__init__(ttl=ttl, max_entries=max_entries)
+        self._entries: OrderedDict[str, tuple[int, list, float]] = OrderedDict()
+
+    def _load(self, key):
+        entry = self._entries.get(key)
+        if entry is not None:
+            self._entries.move_to_end(key)
+        return entry
+
+    def _store(self, key, max_results, results, created_at):
+        self._entries[key] = (max_results, results, created_at)
+        self._entries.move_to_end(key)
+
+    def _delete(self, key):
+        self._entries.pop(key, None)
+
+    def _evict(self):
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+
+
+class SqliteSearchCache(SearchCache):
+    """
+    Search cache persisted in a SQLite file.
+
+    Survives restarts and can be shared by several processes on the same host.
+    """
+
+    def __init__(self, path: str, ttl: float | None = None, max_entries: int = 1024):
+        super().__init__(ttl=ttl, max_entries=max_entries)
+        if os.path.dirname(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+        self._connection = sqlite3.connect(path, check_same_thread=False)
+        self._connection.execute(
+            "CREATE TABLE IF NOT EXISTS search_results ("
+            " question TEXT PRIMARY KEY,"
+            " max_results INTEGER NOT NULL,"
+            " results TEXT NOT NULL,"
+            " created_at REAL NOT NULL,"
+            " accessed_at REAL NOT NULL)"
+        )
+        self._connection.commit()
+
+    def _load(self, key):
+        row = self._connection.execute(
+            "SELECT max_results, results, created_at FROM search_results WHERE question = ?",
+            (key,),
+        ).fetchone()
+        if row is None:
+            return None
+        self._connection.execute(
+            "UPDATE search_results SET accessed_at = ? WHERE question = ?",
+            (time.time(), key),
+        )
+        self._connection.commit()
+        return row[0], json.loads(row[1]), row[2]
+
+    def _store(self, key, max_results, results, created_at):
+        self._connection.execute(
+            "INSERT OR REPLACE INTO search_results VALUES (?, ?, ?, ?, ?)",
+            (key, max_results, json.dumps(results), created_at, created_at),
+        )
+        self._connection.commit()
+
+    def _delete(self, key):
+        self._connection.execute("DELETE FROM search_results WHERE question = ?", (key,))
+        self._connection.commit()
+
+    def _evict(self):
+        if self.ttl is not None:
+            self._connection.execute(
+                "DELETE FROM search_results WHERE created_at < ?",
+                (time.time() - self.ttl,),
+            )
+        self._connection.execute(
+            "DELETE FROM search_results WHERE question NOT IN ("
+            " SELECT question FROM search_results ORDER BY accessed_at DESC LIMIT ?)",
+            (self.max_entries,),
+        )
+        self._connection.commit()
+
+
+def make_search_cache(
+    backend: str, ttl: float | None, max_entries: int, path: str
+) -> SearchCache:
+    """Create the search cache for the given backend ("memory" or "sqlite")"""
+    logging.info(f"Using {backend} search cache (ttl: {ttl}s, max entries: {max_entries}).")
+    if backend == "memory":
+        return InMemorySearchCache(ttl=ttl, max_entries=max_entries)
+    elif backend == "sqlite":
+        return SqliteSearchCache(path, ttl=ttl, max_entries=max_entries)
+    else:
+        raise ValueError(f"Unknown search cache backend: {backend}")
@@ -0,0 +1,341 @@
+"""
+Serve the graph over HTTP, as an ASGI application.
+
+Usage:
+    python server.py --port 8000 --concurrency 8 --queue-size 32
+    uvicorn server:app
+
+Endpoints:
+    POST /answer with {"question": "..."}, answers {"run_id": "...", "answer": "..."}.
+        The user and the session are read from the X-User-Id and X-Session-Id headers.
+    POST /stream, same request, answers the progress and the tokens as server-sent events.
+    POST /feedback with {"run_id": "...", "name": "user_feedback", "value": 4},
+        queues a score of a run for Langfuse, answers 202 (429 when the queue is full).
+    GET /health, answers the load of the server.
+
+All the requests share the graph compiled in main and its clients.
+At most `concurrency` questions run at the same time, the next ones wait in a queue
+of `queue_size` requests for at most `queue_timeout` seconds. When the queue is full,
+or the wait too long, the request is rejected with 429 and a Retry-After header.
+
+To test without LLM or search, give another answer function to AnswerServer
+(e.g. returning a fixed answer), or replace the clients of main before the first request
+(e.g. main.llm.set(FakeListChatModel(responses=[...]))).
+test_server.py drives AnswerServer with stub functions through the ASGI protocol.
+"""
+
+import argparse
+import asyncio
+import json
+import logging
+import uuid
+from typing import AsyncIterator, Awaitable, Callable
+
+from feedback import SCORE_DATA_TYPES
+from main import (
+    GRAPH_GEN_ANSWER_PROMPTS,
+    answer_chains,
+    arun_graph,
+    astream_graph,
+    clients,
+    feedback,
+    langfuse_handler,
+)
+from streaming import StreamEvent, message_text
+
+SERVER_CONCURRENCY = 8
+"""The maximum number of questions answered at the same time"""
+
+SERVER_QUEUE_SIZE = 32
+"""The maximum number of questions waiting for a slot, the next ones are rejected with 429"""
+
+SERVER_QUEUE_TIMEOUT_SECONDS = 30.0
+"""The maximum time a question waits for a slot before being rejected with 429"""
+
+SERVER_RETRY_AFTER_SECONDS = 1
+"""The Retry-After header of the 429 responses"""
+
+SERVER_MAX_BODY_BYTES = 64 * 1024
+"""The maximum size of a request body, a bigger one is rejected with 413"""
+
+AnswerFunction = Callable[[str, str | None, str | None], Awaitable[tuple[str, object]]]
+"""The signature of arun_graph: (question, user_id, session_id) -> (run_id, answer)"""
+
+StreamFunction = Callable[[str, str | None, str | None], AsyncIterator[StreamEvent]]
+"""The signature of astream_graph: (question, user_id, session_id) -> events"""
+
+
+class HTTPError(Exception):
+    """An error answered to the client with its status code"""
+
+    def __init__(self, status: int, message: str, headers: list | None = None):
+        super().__init__(message)
+        self.status = status
+        self.headers = headers or []
+
+
+class AnswerServer:
+    """The ASGI application answering the questions with the graph"""
+
+    def __init__(
+        self,
+        answer: AnswerFunction = arun_graph,
+        stream: StreamFunction = astream_graph,
+        concurrency: int = SERVER_CONCURRENCY,
+        queue_size: int = SERVER_QUEUE_SIZE,
+        queue_timeout: float = SERVER_QUEUE_TIMEOUT_SECONDS,
+        warm_up: bool = True,
+    ):
+        self.answer = answer
+        """The function answering a question, arun_graph or a stub in tests"""
+        self.stream = stream
+        """The function streaming an answer, astream_graph or a stub in tests"""
+        self.concurrency = concurrency
+        self.queue_size = queue_size
+        self.queue_timeout = queue_timeout
+        self.warm_up = warm_up
+        """
+        Build the clients and the answer chains of main at startup, instead of during
+        the first requests (fetching a prompt would block the event loop)
+        """
+        self.running = 0
+        """Number of questions being answered"""
+        self.waiting = 0
+        """Number of questions waiting for a slot"""
+        self.answered = 0
+        self.failed = 0
+        self.rejected = 0
+        # Created on the event loop of the server, at the first request
+        self._slots: asyncio.Semaphore | None = None
+
+    async def __call__(self, scope: dict, receive, send) -> None:
+        if scope["type"] == "lifespan":
+            await self.lifespan(receive, send)
+        elif scope["type"] == "http":
+            try:
+                if scope["path"] == "/stream":
+                    await self.handle_stream(scope, receive, send)
+                else:
+                    status, body = await self.route(scope, receive)
+                    await self.respond(send, status, body)
+            except HTTPError as e:
+                await self.respond(send, e.status, {"error": str(e)}, e.headers)
+
+    async def lifespan(self, receive, send) -> None:
+        """Warm up the clients at startup, spool the scores and flush the traces at shutdown"""
+        while True:
+            message = await receive()
+            if message["type"] == "lifespan.startup":
+                if self.warm_up:
+                    await asyncio.to_thread(clients.warm_up)
+                    try:
+                        await asyncio.to_thread(answer_chains.warm_up, GRAPH_GEN_ANSWER_PROMPTS)
+                    except Exception as e:
+                        # The server still starts, the first requests fetch the prompts
+                        logging.warning(f"Answer chains not warmed up: {e}")
+                await send({"type": "lifespan.startup.complete"})
+            elif message["type"] == "lifespan.shutdown":
+                if feedback.initialized:
+                    await asyncio.to_thread(feedback.get().close)
+                if langfuse_handler.initialized:
+                    await asyncio.to_thread(langfuse_handler.get().flush)
+                await send({"type": "lifespan.shutdown.complete"})
+                return
+
+    async def route(self, scope: dict, receive) -> tuple[int, dict]:
+        """Call the endpoint of the request, return the status and the JSON body"""
+        path, method = scope["path"], scope["method"]
+        if path == "/health":
+            if method != "GET":
+                raise HTTPError(405, "Use GET")
+            return 200, self.stats()
+        if path == "/answer":
+            if method != "POST":
+                raise HTTPError(405, "Use POST")
+            return 200, await self.handle_answer(scope, receive)
+        if path == "/feedback":
+            if method != "POST":
+                raise HTTPError(405, "Use POST")
+            return 202, await self.handle_feedback(receive)
+        raise HTTPError(404, "Not found")
+
+    async def read_question(self, scope: dict, receive) -> tuple[str, str, str]:
+        """The question of the body, the user and the session of the headers"""
+        headers = {name.decode().lower(): value.decode() for name, value in scope["headers"]}
+        user_id = headers.get("x-user-id")
+        if not user_id:
+            raise HTTPError(400, "Missing X-User-Id header")
+        # Without a session, each question is its own session
+        session_id = headers.get("x-session-id") or f"session-{uuid.uuid4().hex[:8]}"
+
+        try:
+            payload = json.loads(await read_body(receive))
+            question = payload["question"].strip()
+        except (ValueError, KeyError, TypeError, AttributeError):
+            raise HTTPError(400, 'The body must be a JSON object with a "question"')
+        if not question:
+            raise HTTPError(400, "The question is empty")
+        return question, user_id, session_id
+
+    async def handle_answer(self, scope: dict, receive) -> dict:
+        """Answer the question of the body, for the user and the session of the headers"""
+        question, user_id, session_id = await self.read_question(scope, receive)
+        await self.acquire()
+        self.running += 1
+        try:
+            run_id, answer = await self.answer(question, user_id, session_id)
+        except Exception:
+            self.failed += 1
+            logging.exception(f"Question failed: {question}")
+            raise HTTPError(500, "The question could not be answered")
+        finally:
+            self.running -= 1
+            self._slots.release()
+        self.answered += 1
+        return {
+            "run_id": run_id,
+            "answer": message_text(answer),
+            "user_id": user_id,
+            "session_id": session_id,
+        }
+
+    async def handle_feedback(self, receive) -> dict:
+        """Queue the score of the body, it is sent to Langfuse in the background"""
+        try:
+            payload = json.loads(await read_body(receive))
+            run_id, name, value = payload["run_id"], payload["name"], payload["value"]
+        except (ValueError, KeyError, TypeError):
+            raise HTTPError(
+                400, 'The body must be a JSON object with a "run_id", a "name" and a "value"'
+            )
+        if not isinstance(value, (int, float, str)) or isinstance(value, bool):
+            raise HTTPError(400, "The value must be a number or a string")
+        data_type = payload.get("data_type")
+        if data_type is not None and data_type not in SCORE_DATA_TYPES:
+            raise HTTPError(
+                400, f"The data_type must be one of {', '.join(sorted(SCORE_DATA_TYPES))}"
+            )
+        # Never waits for Langfuse, the queue only rejects when it is full
+        if not feedback.get().submit(
+            str(run_id), str(name), value, data_type, payload.get("comment")
+        ):
+            raise HTTPError(429, "Too many scores, retry later")
+        return {"run_id": run_id, "name": name}
+
+    async def handle_stream(self, scope: dict, receive, send) -> None:
+        """
+        Stream the answer of the question as server-sent events.
+
+        The errors before the first event are answered with their status code,
+        a failure during the run is sent as an "error" event.
+        """
+        if scope["method"] != "POST":
+            raise HTTPError(405, "Use POST")
+        question, user_id, session_id = await self.read_question(scope, receive)
+        await self.acquire()
+        self.running += 1
+        try:
+            await send(
+                {
+                    "type": "http.response.start",
+                    "status": 200,
+                    "headers": [
+                        (b"content-type", b"text/event-stream"),
+                        (b"cache-control", b"no-cache"),
+                    ],
+                }
+            )
+            try:
+                async for event in self.stream(question, user_id, session_id):
+                    await send(
+                        {"type": "http.response.body", "body": event.sse(), "more_body": True}
+                    )
+                self.answered += 1
+            except Exception:
+                self.failed += 1
+                logging.exception(f"Question failed: {question}")
+                error = StreamEvent("error", {"error": "The question could not be answered"})
+                await send({"type": "http.response.body", "body": error.sse(), "more_body": True})
+            await send({"type": "http.response.body", "body": b""})
+        finally:
+            self.running -= 1
+            self._slots.release()
+
+    async def acquire(self) -> None:
+        """Wait for a slot to answer a question, or reject the request with 429"""
+        if self._slots is None:
+            self._slots = asyncio.Semaphore(self.concurrency)
+        retry_after = [(b"retry-after", str(SERVER_RETRY_AFTER_SECONDS).encode())]
+        if self._slots.locked() and self.waiting >= self.queue_size:
+            self.rejected += 1
+            raise HTTPError(429, "Too many questions, retry later", retry_after)
+        self.waiting += 1
+        try:
+            await asyncio.wait_for(self._slots.acquire(), self.queue_timeout)
+        except TimeoutError:
+            self.rejected += 1
+            raise HTTPError(429, "Too many questions, retry later", retry_after)
+        finally:
+            self.waiting -= 1
+
+    async def respond(self, send, status: int, body: dict, headers: list | None = None) -> None:
+        data = json.dumps(body).encode()
+        await send(
+            {
+                "type": "http.response.start",
+                "status": status,
+                "headers": [
+                    (b"content-type", b"application/json"),
+                    (b"content-length", str(len(data)).encode()),
+                    *(headers or []),
+                ],
+            }
+        )
+        await send({"type": "http.response.body", "body": data})
+
+    def stats(self) -> dict:
+        """The load of the server, to follow the saturation"""
+        return {
+            "running": self.running,
+            "waiting": self.waiting,
+            "answered": self.answered,
+            "failed": self.failed,
+            "rejected": self.rejected,
+            "concurrency": self.concurrency,
+            "queue_size": self.queue_size,
+        }
+
+
+async def read_body(receive) -> bytes:
+    """Read the whole request body, up to SERVER_MAX_BODY_BYTES"""
+    body = b""
+    while True:
+        message = await receive()
+        if message["type"] == "http.disconnect":
+            raise HTTPError(400, "Client disconnected")
+        body += message.get("body", b"")
+        if len(body) > SERVER_MAX_BODY_BYTES:
+            raise HTTPError(413, "The body is too big")
+        if not message.get("more_body"):
+            return body
+
+
+app = AnswerServer()
+
+if __name__ == "__main__":
+    import uvicorn
+
+    parser = argparse.ArgumentParser(description="Serve the graph over HTTP.")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8000)
+    parser.add_argument("--concurrency", type=int, default=SERVER_CONCURRENCY)
+    parser.add_argument("--queue-size", type=int, default=SERVER_QUEUE_SIZE)
+    parser.add_argument("--queue-timeout", type=float, default=SERVER_QUEUE_TIMEOUT_SECONDS)
+    args = parser.parse_args()
+
+    app = AnswerServer(
+        concurrency=args.concurrency,
+        queue_size=args.queue_size,
+        queue_timeout=args.queue_timeout,
+    )
+    uvicorn.run(app, host=args.host, port=args.port)
@@ -0,0 +1,156 @@
+import threading
+import time
+from collections import OrderedDict
+from dataclasses import dataclass, field
+
+from context import ContextDocument, make_context_reducer
+from document_index import index_terms
+from packing import BM25
+
+SESSION_ANSWER_SOURCE = "session_memory"
+"""The source_tool of the documents holding a previous answer of the session"""
+
+
+@dataclass
+class _Session:
+    documents: list[ContextDocument] = field(default_factory=list)
+    turns: int = 0
+    used_at: float = field(default_factory=time.time)
+    # The BM25 ranking and the terms of the documents, built again after a change
+    ranking: BM25 | None = None
+    terms: frozenset[str] = frozenset()
+
+
+class SessionMemory:
+    """
+    The documents and answers of the previous turns of each session, to reuse them in follow-ups.
+
+    - A session is identified by its user and session IDs, it is never shared between users.
+    - The documents of a session are bounded in tokens, the oldest ones are evicted first.
+    - The least recently used sessions are evicted over max_sessions,
+      and a session idle for more than idle_ttl is dropped.
+    """
+
+    def __init__(
+        self,
+        max_tokens: int = 8000,
+        max_sessions: int = 1000,
+        idle_ttl: float | None = None,
+        min_score: float = 0.4,
+    ):
+        self.max_sessions = max_sessions
+        """Maximum number of sessions kept, the least recently used ones are evicted"""
+        self.idle_ttl = idle_ttl
+        """Time in seconds after which an idle session is dropped. If None, only max_sessions applies."""
+        self.min_score = min_score
+        """The minimum share (0 to 1) of the terms of a question found in the session to reuse it"""
+        self.hits = 0
+        """Number of questions starting with documents of the session"""
+        self.misses = 0
+        """Number of questions with nothing relevant in the session"""
+        # Deduplicated by URL and bounded in tokens, like the context of a run
+        self._reduce = make_context_reducer(max_tokens, "oldest")
+        self._sessions: OrderedDict[tuple[str, str], _Session] = OrderedDict()
+        self._lock = threading.Lock()
+
+    def recall(self, user_id: str, session_id: str, question: str) -> list[ContextDocument]:
+        """
+        Return the documents of the session relevant to the question, the most relevant first.
+
+        The session is relevant when it has enough of the terms of the question (min_score),
+        then its documents matching the question are ranked with BM25.
+        A session has a few documents, their BM25 scores alone tell little about the relevance.
+        """
+        with self._lock:
+            self._expire()
+            session = self._sessions.get((user_id, session_id))
+            if session is None or not session.documents:
+                self.misses += 1
+                return []
+            self._sessions.move_to_end((user_id, session_id))
+            session.used_at = time.time()
+            if session.ranking is None:
+                texts = [" ".join(index_terms(f"{d.title} {d.content}")) for d in session.documents]
+                session.ranking = BM25(texts)
+                session.terms = frozenset(" ".join(texts).split())
+            documents = session.documents
+            ranking = session.ranking
+            session_terms = session.terms
+
+        terms = set(index_terms(question))
+        relevant = []
+        if terms and len(terms & session_terms) / len(terms) >= self.min_score:
+            scores = ranking.scores(" ".join(terms))
+            relevant = [
+                document
+                for score, document in sorted(zip(scores, documents), key=lambda pair: -pair[0])
+                if score > 0
+            ]
+        with self._lock:
+            if relevant:
+                self.hits += 1
+            else:
+                self.misses += 1
+        return relevant
+
+    def remember(
+        self,
+        user_id: str,
+        session_id: str,
+        question: str,
+        documents: list[ContextDocument],
+        answer: str | None = None,
+    ) -> None:
+        """
+        Add the documents of a turn to the session, and its answer if it was good.
+
+        The answer is stored as a document, a follow-up can build on it.
+        """
+        with self._lock:
+            session = self._sessions.pop((user_id, session_id), None) or _Session()
+            session.turns += 1
+            update = list(documents)
+            if answer:
+                update.append(
+                    ContextDocument(
+                        url=f"session://{session_id}/turns/{session.turns}",
+                        title=f"Previous answer to: {question}",
+                        content=answer,
+                        source_tool=SESSION_ANSWER_SOURCE,
+                    )
+                )
+            session.documents = self._reduce(session.documents, update)
+            session.ranking = None
+            session.used_at = time.time()
+            self._sessions[(user_id, session_id)] = session
+            while len(self._sessions) > self.max_sessions:
+                self._sessions.popitem(last=False)
+
+    def forget(self, user_id: str, session_id: str) -> None:
+        """Drop a session, e.g. when the user starts a new conversation"""
+        with self._lock:
+            self._sessions.pop((user_id, session_id), None)
+
+    def stats(self) -> dict:
+        """Hit/miss counters and size, to follow the reuse rate"""
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": self.hits / lookups if lookups else 0.0,
+                "sessions": len(self._sessions),
+                "documents": sum(len(s.documents) for s in self._sessions.values()),
+                "tokens": sum(d.tokens for s in self._sessions.values() for d in s.documents),
+            }
+
+    # Called with the lock held. The sessions are in LRU order, the idle ones are first.
+    def _expire(self) -> None:
+        if self.idle_ttl is None:
+            return
+        now = time.time()
+        while self._sessions:
+            key, session = next(iter(self._sessions.items()))
+            if now - session.used_at <= self.idle_ttl:
+                break
+            del self._sessions[key]
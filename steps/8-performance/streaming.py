@@ -0,0 +1,98 @@
+import json
+from dataclasses import dataclass, field
+from typing import Literal
+
+STREAM_MODES = ["updates", "messages", "values"]
+"""
+The LangGraph stream modes read by GraphStreamReader:
+- "updates" for the progress of the nodes,
+- "messages" for the tokens of the LLM,
+- "values" for the final state.
+"""
+
+
+@dataclass(frozen=True)
+class StreamEvent:
+    """An event of a streamed run, for the caller or as a server-sent event"""
+
+    event: Literal["node", "token", "answer", "error"]
+    """
+    - "node": a node finished, with its name, its steps and if it came from the node cache,
+    - "token": a piece of the answer being generated,
+    - "answer": the final answer, last event of the run,
+    - "error": the run failed, last event of the run.
+    """
+    data: dict = field(default_factory=dict)
+
+    def sse(self) -> bytes:
+        """The event in the server-sent events format"""
+        return f"event: {self.event}\ndata: {json.dumps(self.data)}\n\n".encode()
+
+
+class GraphStreamReader:
+    """
+    Turn the chunks of graph.stream(..., stream_mode=STREAM_MODES) into StreamEvents.
+
+    Only the tokens of answer_node are streamed, not those of the answer check.
+    An answer coming from the node cache has no tokens, it is sent as a single token.
+    """
+
+    def __init__(self, answer_node: str = "generate_answer"):
+        self.answer_node = answer_node
+        self.state: dict = {}
+        """The last state of the graph, the final one at the end of the stream"""
+        self._streamed = False
+
+    def read(self, mode: str, chunk) -> list[StreamEvent]:
+        """The events of a chunk of the stream"""
+        if mode == "values":
+            self.state = chunk
+            return []
+
+        if mode == "messages":
+            message, metadata = chunk
+            text = message_text(message)
+            if metadata.get("langgraph_node") != self.answer_node or not text:
+                return []
+            self._streamed = True
+            return [StreamEvent("token", {"text": text})]
+
+        events = []
+        cached = bool(chunk.get("__metadata__", {}).get("cached"))
+        for node, update in chunk.items():
+            if node == "__metadata__":
+                continue
+            update = update or {}
+            if node == self.answer_node:
+                if not self._streamed and "answer" in update:
+                    events.append(StreamEvent("token", {"text": message_text(update["answer"])}))
+                # The next tokens are those of another try
+                self._streamed = False
+            events.append(
+                StreamEvent(
+                    "node",
+                    {"node": node, "steps": update.get("steps_history", []), "cached": cached},
+                )
+            )
+        return events
+
+    def answer_event(self, run_id: str) -> StreamEvent:
+        """The last event, with the final answer"""
+        return StreamEvent(
+            "answer",
+            {
+                "run_id": run_id,
+                "answer": message_text(self.state.get("answer", "")),
+                "steps": self.state.get("steps_history", []),
+            },
+        )
+
+
+def message_text(message) -> str:
+    """The text content of a message (or of a plain string)"""
+    content = getattr(message, "content", message)
+    if isinstance(content, list):
+        content = " ".join(str(item) for item in content)
+    elif not isinstance(content, str):
+        content = str(content)
+    return content
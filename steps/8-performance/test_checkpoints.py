@@ -0,0 +1,61 @@
+"""
+Run with `python -m unittest` from this directory, no API key needed.
+"""
+
+import os
+import tempfile
+import unittest
+
+from checkpoints import SqliteCheckpointSaver
+from langgraph.checkpoint.memory import InMemorySaver
+from node_cache import InMemoryNodeCache, SqliteNodeCache
+from test_node_cache import build_graph
+
+
+class ResumeTest(unittest.TestCase):
+    def setUp(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.directory = directory.name
+
+    def checkpointers(self):
+        yield "memory", InMemorySaver()
+        yield "sqlite", SqliteCheckpointSaver(os.path.join(self.directory, "checkpoints.sqlite"))
+
+    def caches(self):
+        yield "no cache", None
+        yield "memory cache", InMemoryNodeCache()
+        yield "sqlite cache", SqliteNodeCache(os.path.join(self.directory, "node_cache.sqlite"))
+
+    def test_resume_a_failed_run(self):
+        for saver_name, saver in self.checkpointers():
+            for cache_name, cache in self.caches():
+                with self.subTest(f"{saver_name} checkpointer, {cache_name}"):
+                    # The sqlite cache is shared by the subtests, each one has its question
+                    question = f"{saver_name} {cache_name}"
+                    graph, calls = build_graph(cache, failures=1, checkpointer=saver)
+                    config = {"configurable": {"thread_id": question}}
+                    with self.assertRaises(RuntimeError):
+                        graph.invoke({"question": question}, config)
+                    self.assertEqual(graph.get_state(config).next, ("generate_answer",))
+
+                    result = graph.invoke(None, config)
+                    self.assertEqual(result["answer"], f"answer to {question}")
+                    self.assertEqual(len(calls), 2)
+
+    def test_old_runs_are_deleted(self):
+        saver = SqliteCheckpointSaver(os.path.join(self.directory, "checkpoints.sqlite"))
+        graph, _ = build_graph(None, failures=1, checkpointer=saver)
+        config = {"configurable": {"thread_id": "failed"}}
+        with self.assertRaises(RuntimeError):
+            graph.invoke({"question": "q"}, config)
+
+        self.assertEqual(saver.delete_older_than(3600), 0)
+        self.assertEqual(graph.get_state(config).next, ("generate_answer",))
+        # Its last checkpoint is older than a cutoff in the future
+        self.assertEqual(saver.delete_older_than(-1), 1)
+        self.assertEqual(graph.get_state(config).values, {})
+
+
+if __name__ == "__main__":
+    unittest.main()
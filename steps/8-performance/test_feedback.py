@@ -0,0 +1,59 @@
+"""
+Run with `python -m unittest` from this directory, no API key needed.
+"""
+
+import os
+import tempfile
+import unittest
+from types import SimpleNamespace
+
+from feedback import FeedbackQueue, Score, langfuse_sender
+
+
+class FakeLangfuse:
+    """Records the ingestion batches, Langfuse accepts every event"""
+
+    def __init__(self):
+        self.batches = []
+        self.client = SimpleNamespace(ingestion=SimpleNamespace(batch=self.batch))
+
+    def batch(self, batch):
+        self.batches.append(batch)
+        return SimpleNamespace(errors=[])
+
+
+class FeedbackTest(unittest.TestCase):
+    def setUp(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.spool_path = os.path.join(directory.name, "spool.sqlite")
+        self.langfuse = FakeLangfuse()
+
+    def test_invalid_score_does_not_block_its_batch(self):
+        send = langfuse_sender(lambda: self.langfuse)
+        scores = [
+            Score(id="good", run_id="run", name="user_feedback", value=4, data_type="NUMERIC"),
+            Score(id="bad", run_id="run", name="user_feedback", value=4, data_type="FOO"),
+        ]
+        # Nothing to send again: the bad score is dropped, the good one is sent
+        self.assertEqual(list(send(scores)), [])
+        batches = [[event.id for event in batch] for batch in self.langfuse.batches]
+        self.assertEqual(batches, [["good"]])
+
+    def test_queue_sends_the_valid_scores(self):
+        queue = FeedbackQueue(
+            langfuse_sender(lambda: self.langfuse), self.spool_path, flush_interval=0.05
+        )
+        self.addCleanup(queue.close)
+        self.assertTrue(queue.submit("run", "user_feedback", 4, "NUMERIC"))
+        self.assertTrue(queue.submit("run", "helpful", "yes", "CATEGORICAL"))
+        with self.assertRaises(ValueError):
+            queue.submit("run", "user_feedback", 4, "FOO")
+
+        self.assertTrue(queue.flush(timeout=5))
+        stats = queue.stats()
+        self.assertEqual((stats["sent"], stats["spooled"], stats["failures"]), (2, 0, 0))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,93 @@
+"""
+Run with `python -m unittest` from this directory, no API key needed.
+"""
+
+import os
+import tempfile
+import unittest
+
+from langgraph.graph import END, START, StateGraph
+from langgraph.types import CachePolicy
+from typing_extensions import TypedDict
+
+from node_cache import InMemoryNodeCache, SqliteNodeCache, is_cacheable, state_key
+
+
+class State(TypedDict):
+    question: str
+    answer: str
+
+
+def build_graph(cache, failures: int = 0, checkpointer=None):
+    """A one node graph, its node fails the first `failures` calls, its calls are counted"""
+    calls = []
+
+    def answer(state: State) -> dict:
+        calls.append(state["question"])
+        if len(calls) <= failures:
+            raise RuntimeError("transient failure")
+        return {"answer": f"answer to {state['question']}"}
+
+    builder = StateGraph(State)
+    builder.add_node(
+        "generate_answer", answer, cache_policy=CachePolicy(key_func=state_key("question"))
+    )
+    builder.add_edge(START, "generate_answer")
+    builder.add_edge("generate_answer", END)
+    return builder.compile(cache=cache, checkpointer=checkpointer), calls
+
+
+class NodeCacheTest(unittest.TestCase):
+    def setUp(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.caches = {
+            "memory": InMemoryNodeCache,
+            "sqlite": lambda: SqliteNodeCache(os.path.join(directory.name, "node_cache.sqlite")),
+        }
+
+    def test_successful_node_is_cached(self):
+        for name, make_cache in self.caches.items():
+            with self.subTest(name):
+                graph, calls = build_graph(make_cache())
+                graph.invoke({"question": "q"})
+                result = graph.invoke({"question": "q"})
+                self.assertEqual(result["answer"], "answer to q")
+                self.assertEqual(len(calls), 1)
+
+    def test_failed_node_is_not_cached(self):
+        for name, make_cache in self.caches.items():
+            with self.subTest(name):
+                graph, calls = build_graph(make_cache(), failures=1)
+                with self.assertRaises(RuntimeError):
+                    graph.invoke({"question": "q"})
+                # Runs again instead of replaying empty writes
+                result = graph.invoke({"question": "q"})
+                self.assertEqual(result["answer"], "answer to q")
+                self.assertEqual(len(calls), 2)
+
+    def test_sqlite_skips_empty_writes_already_cached(self):
+        cache = self.caches["sqlite"]()
+        # As written before the failed nodes were excluded
+        key = state_key("question")({"question": "q"})
+        encoding, data = cache.serde.dumps_typed([])
+        cache._connection.execute(
+            "INSERT INTO node_writes VALUES (?, ?, ?, ?, NULL)",
+            ('["generate_answer"]', key, encoding, data),
+        )
+        self.assertEqual(cache.get([(("generate_answer",), key)]), {})
+
+    def test_is_cacheable(self):
+        self.assertTrue(is_cacheable([("answer", "a"), ("steps_history", ["generate answer"])]))
+        self.assertFalse(is_cacheable([]))
+        self.assertFalse(is_cacheable([("__error__", RuntimeError())]))
+        self.assertFalse(is_cacheable([("__interrupt__", [])]))
+        self.assertFalse(is_cacheable([("steps_history", ["timeout web search"])]))
+
+    def test_state_key_of_an_empty_state(self):
+        # graph.get_graph() calls the key functions with an empty state
+        self.assertEqual(state_key("question")({}), state_key("question")({"question": None}))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,135 @@
+"""
+Run with `python -m unittest` from this directory, no API key needed.
+
+The server is driven through the ASGI protocol, with stubs instead of the graph.
+"""
+
+import asyncio
+import json
+import unittest
+
+from server import SERVER_MAX_BODY_BYTES, AnswerServer
+from streaming import StreamEvent
+
+
+async def answer(question: str, user_id: str | None, session_id: str | None):
+    return "run-1", f"answer to {question}"
+
+
+async def stream(question: str, user_id: str | None, session_id: str | None):
+    yield StreamEvent("token", {"text": "answer "})
+    yield StreamEvent("token", {"text": f"to {question}"})
+    yield StreamEvent("answer", {"run_id": "run-1", "answer": f"answer to {question}"})
+
+
+async def request(
+    app: AnswerServer,
+    path: str,
+    body: bytes | dict = b"",
+    method: str = "POST",
+    headers: dict | None = None,
+) -> tuple[int, dict, bytes]:
+    """Send a request to the application, return the status, the headers and the body"""
+    if isinstance(body, dict):
+        body = json.dumps(body).encode()
+    headers = {"x-user-id": "user-1", **(headers or {})}
+    scope = {
+        "type": "http",
+        "method": method,
+        "path": path,
+        "headers": [(name.encode(), value.encode()) for name, value in headers.items()],
+    }
+    messages = [{"type": "http.request", "body": body, "more_body": False}]
+    sent = []
+
+    async def receive():
+        if messages:
+            return messages.pop(0)
+        await asyncio.Event().wait()
+
+    async def send(message):
+        sent.append(message)
+
+    await app(scope, receive, send)
+    start = sent[0]
+    response_headers = {name.decode(): value.decode() for name, value in start["headers"]}
+    return start["status"], response_headers, b"".join(m.get("body", b"") for m in sent[1:])
+
+
+class AnswerServerTest(unittest.IsolatedAsyncioTestCase):
+    def setUp(self):
+        self.app = AnswerServer(answer=answer, stream=stream, warm_up=False)
+
+    async def test_answer(self):
+        status, _, body = await request(self.app, "/answer", {"question": "Who is Carl?"})
+        self.assertEqual(status, 200)
+        self.assertEqual(json.loads(body)["answer"], "answer to Who is Carl?")
+        self.assertEqual(json.loads(body)["user_id"], "user-1")
+
+    async def test_bad_requests(self):
+        for body, headers in [
+            ({"question": "Who is Carl?"}, {"x-user-id": ""}),
+            (b"not json", {}),
+            ({"question": "  "}, {}),
+        ]:
+            with self.subTest(body=body, headers=headers):
+                status, _, _ = await request(self.app, "/answer", body, headers=headers)
+                self.assertEqual(status, 400)
+
+        status, _, _ = await request(
+            self.app, "/feedback", {"run_id": "run-1", "name": "n", "value": 1, "data_type": "FOO"}
+        )
+        self.assertEqual(status, 400)
+
+    async def test_body_too_big(self):
+        body = b"x" * (SERVER_MAX_BODY_BYTES + 1)
+        status, _, _ = await request(self.app, "/answer", body)
+        self.assertEqual(status, 413)
+
+    def blocked_server(self, **kwargs) -> tuple[AnswerServer, asyncio.Event]:
+        """One slot, its answers wait for the returned event"""
+        release = asyncio.Event()
+
+        async def slow_answer(question, user_id, session_id):
+            await release.wait()
+            return "run-1", "answer"
+
+        return AnswerServer(answer=slow_answer, concurrency=1, warm_up=False, **kwargs), release
+
+    async def test_backpressure(self):
+        app, release = self.blocked_server(queue_size=0)
+        first = asyncio.create_task(request(app, "/answer", {"question": "first"}))
+        await asyncio.sleep(0.01)
+
+        status, headers, _ = await request(app, "/answer", {"question": "second"})
+        self.assertEqual(status, 429)
+        self.assertIn("retry-after", headers)
+        self.assertEqual(app.stats()["rejected"], 1)
+
+        release.set()
+        self.assertEqual((await first)[0], 200)
+
+    async def test_queue_timeout(self):
+        app, release = self.blocked_server(queue_timeout=0.01)
+        first = asyncio.create_task(request(app, "/answer", {"question": "first"}))
+        await asyncio.sleep(0.01)
+
+        status, headers, _ = await request(app, "/answer", {"question": "second"})
+        self.assertEqual(status, 429)
+        self.assertIn("retry-after", headers)
+
+        release.set()
+        await first
+
+    async def test_stream(self):
+        status, headers, body = await request(self.app, "/stream", {"question": "Who is Carl?"})
+        self.assertEqual(status, 200)
+        self.assertEqual(headers["content-type"], "text/event-stream")
+        events = [block.split("\n") for block in body.decode().strip().split("\n\n")]
+        self.assertEqual([lines[0] for lines in events], ["event: token"] * 2 + ["event: answer"])
+        answer = json.loads(events[-1][1].removeprefix("data: "))["answer"]
+        self.assertEqual(answer, "answer to Who is Carl?")
+
+
+if __name__ == "__main__":
+    unittest.main()
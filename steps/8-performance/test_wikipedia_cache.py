@@ -0,0 +1,65 @@
+"""
+Run with `python -m unittest` from this directory, no network needed.
+"""
+
+import time
+import unittest
+from types import SimpleNamespace
+
+from wikipedia_cache import WikipediaPageCache
+
+REDIRECTS = {"Darth Vader": "Anakin Skywalker"}
+
+
+class FakeWikipedia:
+    """The wikipedia package, its pages follow REDIRECTS, its downloads are counted"""
+
+    exceptions = SimpleNamespace(PageError=KeyError, DisambiguationError=ValueError)
+
+    def __init__(self, results: dict[str, list[str]]):
+        self.results = results
+        self.downloads = []
+
+    def search(self, query: str, results: int = 2) -> list[str]:
+        return self.results.get(query, [])[:results]
+
+    def page(self, title: str, auto_suggest: bool = False):
+        self.downloads.append(title)
+        resolved = REDIRECTS.get(title, title)
+        return SimpleNamespace(
+            title=resolved,
+            content=f"content of {resolved}",
+            summary=f"summary of {resolved}",
+            url=f"https://en.wikipedia.org/wiki/{resolved.replace(' ', '_')}",
+        )
+
+
+class WikipediaPageCacheTest(unittest.TestCase):
+    def make_cache(self, results: dict[str, list[str]], **kwargs) -> WikipediaPageCache:
+        cache = WikipediaPageCache(**kwargs)
+        cache._wrapper.wiki_client = self.wiki = FakeWikipedia(results)
+        return cache
+
+    def test_redirected_page_is_stored_once(self):
+        cache = self.make_cache({"vader": ["Darth Vader"], "anakin": ["Anakin Skywalker"]})
+        (redirected,) = cache.load("vader", load_max_docs=1)
+        (resolved,) = cache.load("anakin", load_max_docs=1)
+        self.assertEqual(self.wiki.downloads, ["Darth Vader"])
+        # Each document keeps the title it was searched with, as WikipediaLoader does
+        self.assertEqual(redirected.metadata["title"], "Darth Vader")
+        self.assertEqual(resolved.metadata["title"], "Anakin Skywalker")
+        self.assertEqual(resolved.page_content, redirected.page_content)
+
+    def test_query_without_page_expires_sooner(self):
+        cache = self.make_cache({}, ttl=3600, negative_ttl=0.05)
+        self.assertEqual(cache.load("nothing"), [])
+        self.wiki.results["nothing"] = ["Anakin Skywalker"]
+        self.assertEqual(cache.load("nothing"), [])
+
+        time.sleep(0.1)
+        (document,) = cache.load("nothing")
+        self.assertEqual(document.metadata["title"], "Anakin Skywalker")
+
+
+if __name__ == "__main__":
+    unittest.main()
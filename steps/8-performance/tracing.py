@@ -0,0 +1,205 @@
+import hashlib
+import logging
+import threading
+import time
+from datetime import datetime, timezone
+from typing import Callable, Iterable, Literal
+
+from langchain_core.callbacks import BaseCallbackHandler
+from langchain_core.outputs import LLMResult
+
+CALLBACK_METHODS = sorted(name for name in dir(BaseCallbackHandler) if name.startswith("on_"))
+"""The LangChain callbacks forwarded (or recorded) by RunTracer"""
+
+Sampling = Literal["user", "head", "tail", "off"]
+"""
+Why a run is traced:
+- "user": its user is always traced,
+- "head": it was drawn by the sampling rate,
+- "tail": not drawn, its callbacks are recorded and sent only if the run ends badly,
+- "off": not traced at all.
+"""
+
+
+class RunTracer(BaseCallbackHandler):
+    """
+    The callbacks of one run, forwarded to the Langfuse handler or recorded, and timed.
+
+    The time spent in the callbacks is the tracing overhead paid by the run.
+    A recorded run can be replayed to the Langfuse handler at the end, with the times
+    of the recording.
+    """
+
+    def __init__(self, sampling: Sampling, get_handler: Callable[[], BaseCallbackHandler]):
+        self.sampling = sampling
+        self.get_handler = get_handler
+        """The Langfuse handler, only built when the run is traced"""
+        self.recording = sampling == "tail"
+        self.started_at = datetime.now(timezone.utc)
+        """The start of the run, the time of its trace"""
+        self.events: list[tuple[str, tuple, dict, datetime]] = []
+        self.calls = 0
+        """Number of callbacks of the run"""
+        self.overhead = 0.0
+        """Time spent in the callbacks and in their replay, in seconds"""
+        self._handler = None if self.recording else get_handler()
+        self._lock = threading.Lock()
+
+    def _callback(self, name: str, args: tuple, kwargs: dict) -> None:
+        start = time.perf_counter()
+        if name == "on_llm_error" and isinstance(args[0], GeneratorExit):
+            # A stream closed on purpose (e.g. on a refusal) ends the generation, it did not fail
+            kwargs = dict(kwargs)
+            name, args = "on_llm_end", (closed_stream_result(kwargs.pop("response")),)
+        if self.recording:
+            event = (name, args, kwargs, datetime.now(timezone.utc))
+            with self._lock:
+                self.events.append(event)
+        else:
+            getattr(self._handler, name)(*args, **kwargs)
+        elapsed = time.perf_counter() - start
+        with self._lock:
+            self.calls += 1
+            self.overhead += elapsed
+
+    def replay(self) -> float:
+        """
+        Send the recorded callbacks to the Langfuse handler, return the time it took.
+
+        The replay is part of the tracing overhead of the run.
+        The observations are created at the replay, their start and end times
+        are then set back to those of the recording.
+        """
+        start = time.perf_counter()
+        handler = self.get_handler()
+        runs = getattr(handler, "runs", {})
+        for name, args, kwargs, timestamp in self.events:
+            run_id = kwargs.get("run_id")
+            getattr(handler, name)(*args, **kwargs)
+            observation = runs.get(run_id)
+            if observation is None or not hasattr(observation, "update"):
+                continue
+            try:
+                if name.endswith("_start"):
+                    observation.update(start_time=timestamp)
+                elif name.endswith(("_end", "_error")):
+                    observation.update(end_time=timestamp)
+            except Exception as e:
+                logging.debug(f"Cannot set the time of {name}: {e}")
+        self.events = []
+        self.recording = False
+        elapsed = time.perf_counter() - start
+        with self._lock:
+            self.overhead += elapsed
+        return elapsed
+
+
+def closed_stream_result(response: LLMResult) -> LLMResult:
+    """The result of a closed stream: the chunks generated so far, without the error"""
+    # The chunks come first, then the generation describing the error
+    return LLMResult(generations=response.generations[:1], llm_output=response.llm_output)
+
+
+def _forward(name: str):
+    def callback(self, *args, **kwargs):
+        self._callback(name, args, kwargs)
+
+    callback.__name__ = name
+    return callback
+
+
+for _name in CALLBACK_METHODS:
+    setattr(RunTracer, _name, _forward(_name))
+
+
+class TraceSampler:
+    """
+    Decide which runs are traced in Langfuse, to trade tracing fidelity for throughput.
+
+    - Head sampling: a run is traced with the probability rate, drawn from its run ID
+      (the same run, e.g. resumed, gets the same decision).
+    - The runs of always_user_ids are always traced.
+    - Tail sampling: the callbacks of the other runs are recorded, and sent to Langfuse
+      if the run ends with one of tail_steps (e.g. "too many steps").
+    """
+
+    def __init__(
+        self,
+        rate: float = 1.0,
+        always_user_ids: Iterable[str] = (),
+        tail_steps: Iterable[str] = (),
+        tail: bool = True,
+    ):
+        self.rate = rate
+        self.always_user_ids = frozenset(always_user_ids)
+        self.tail_steps = frozenset(tail_steps)
+        self.tail = tail
+        self._runs = {sampling: 0 for sampling in Sampling.__args__}
+        self._overhead = {sampling: 0.0 for sampling in Sampling.__args__}
+        self._tail_kept = 0
+        self._replay = 0.0
+        self._lock = threading.Lock()
+
+    def sampling(self, run_id: str, user_id: str) -> Sampling:
+        """Decide how to trace a run, at its start"""
+        if user_id in self.always_user_ids:
+            return "user"
+        # The first 8 bytes of the hash, uniform in [0, 1)
+        draw = int.from_bytes(hashlib.sha256(run_id.encode()).digest()[:8], "big") / 2**64
+        if draw < self.rate:
+            return "head"
+        return "tail" if self.tail else "off"
+
+    def start(
+        self, run_id: str, user_id: str, get_handler: Callable[[], BaseCallbackHandler]
+    ) -> RunTracer | None:
+        """The callback handler of a run, None if the run is not traced at all"""
+        sampling = self.sampling(run_id, user_id)
+        if sampling == "off":
+            with self._lock:
+                self._runs["off"] += 1
+            return None
+        return RunTracer(sampling, get_handler)
+
+    def finish(self, tracer: RunTracer | None, steps_history: list[str]) -> bool:
+        """
+        Account for the end of a run, and send its recording if it ended badly.
+
+        Return True if the run is in Langfuse.
+        """
+        if tracer is None:
+            return False
+        kept = not tracer.recording
+        replay = 0.0
+        if tracer.recording and self.tail_steps.intersection(steps_history):
+            replay = tracer.replay()
+            kept = True
+        with self._lock:
+            self._runs[tracer.sampling] += 1
+            self._overhead[tracer.sampling] += tracer.overhead
+            self._tail_kept += tracer.sampling == "tail" and kept
+            self._replay += replay
+        logging.info(
+            f"Tracing ({tracer.sampling}{', kept' if kept else ''}): {tracer.calls} callbacks, "
+            f"{tracer.overhead * 1000:.2f} ms overhead"
+            + (f" (of which {replay * 1000:.2f} ms replay)" if replay else "")
+        )
+        return kept
+
+    def stats(self) -> dict:
+        """
+        The runs per sampling decision and their mean tracing overhead, in milliseconds.
+
+        The overhead of the tail runs includes the replay of those kept, also given apart.
+        """
+        with self._lock:
+            return {
+                "runs": dict(self._runs),
+                "tail_kept": self._tail_kept,
+                "overhead_ms": {
+                    sampling: self._overhead[sampling] * 1000 / count
+                    for sampling, count in self._runs.items()
+                    if count and sampling != "off"
+                },
+                "replay_ms": self._replay * 1000 / self._tail_kept if self._tail_kept else 0.0,
+            }
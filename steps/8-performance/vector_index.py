@@ -0,0 +1,341 @@
+"""
+A dense vector index of the Osedea docs, the vector backend of search_osedea.
+
+Usage:
+    python vector_index.py [--rebuild] [query ...]
+
+The documents are split into chunks, embedded once and stored in a NumPy matrix on disk,
+memory-mapped when searching. A search is a matrix product of the (batched) queries
+with the matrix, read by blocks of rows, keeping the top k chunks.
+
+Above VECTOR_IVF_MIN_CHUNKS chunks, the chunks are also clustered (IVF, inverted file):
+a query is only compared to the chunks of its VECTOR_IVF_PROBES closest clusters.
+"""
+
+import argparse
+import hashlib
+import json
+import logging
+import os
+import threading
+import time
+
+import numpy as np
+from numpy.lib.format import open_memmap
+
+from context import estimate_tokens
+from document_index import (
+    IndexHit,
+    document_url,
+    list_documents,
+    map_file,
+    read_document,
+    write_atomic,
+)
+from embeddings import Embedder
+from packing import split_passages
+
+VECTOR_CHUNK_TOKENS = 200
+"""The size in tokens of the chunks embedded"""
+
+VECTOR_EMBED_BATCH = 256
+"""The number of chunks embedded at once"""
+
+VECTOR_BLOCK_ROWS = 65536
+"""The number of rows of the matrix multiplied at once, to bound the memory of a search"""
+
+VECTOR_IVF_MIN_CHUNKS = 100_000
+"""From this number of chunks, the chunks are clustered and a search only looks at a few clusters"""
+
+VECTOR_IVF_PROBES = 8
+"""The number of clusters searched for each query"""
+
+VECTOR_IVF_ITERATIONS = 10
+"""The number of k-means iterations to find the clusters"""
+
+VECTOR_IVF_SAMPLE = 50_000
+"""The number of chunks the clusters are computed on"""
+
+META_NAME = "meta.json"
+
+
+def top_k(scores: np.ndarray, ids: np.ndarray, k: int) -> tuple[np.ndarray, np.ndarray]:
+    """The k best scores and their ids, best first"""
+    if len(scores) > k:
+        best = np.argpartition(-scores, k - 1)[:k]
+        scores, ids = scores[best], ids[best]
+    order = np.argsort(-scores, kind="stable")
+    return scores[order], ids[order]
+
+
+def build_ivf(
+    vectors: np.ndarray, list_count: int, seed: int = 0
+) -> tuple[np.ndarray, np.ndarray, np.ndarray]:
+    """
+    Cluster the vectors with a spherical k-means.
+
+    Return the centroids, the rows sorted by cluster, and the offset of each cluster in those rows.
+    """
+    rng = np.random.default_rng(seed)
+    sample = np.asarray(
+        vectors[np.sort(rng.choice(len(vectors), min(len(vectors), VECTOR_IVF_SAMPLE), replace=False))]
+    )
+    centroids = sample[rng.choice(len(sample), list_count, replace=False)]
+    for _ in range(VECTOR_IVF_ITERATIONS):
+        assignments = np.argmax(sample @ centroids.T, axis=1)
+        sums = np.zeros_like(centroids)
+        np.add.at(sums, assignments, sample)
+        counts = np.bincount(assignments, minlength=list_count)
+        # An empty cluster keeps its centroid
+        centroids = np.where(counts[:, None] > 0, sums, centroids)
+        centroids /= np.maximum(np.linalg.norm(centroids, axis=1, keepdims=True), 1e-12)
+
+    assignments = np.concatenate(
+        [
+            np.argmax(vectors[start : start + VECTOR_BLOCK_ROWS] @ centroids.T, axis=1)
+            for start in range(0, len(vectors), VECTOR_BLOCK_ROWS)
+        ]
+    )
+    rows = np.argsort(assignments, kind="stable").astype(np.int64)
+    offsets = np.searchsorted(assignments[rows], np.arange(list_count + 1))
+    return centroids.astype(np.float32), rows, offsets
+
+
+class VectorIndex:
+    """
+    Search the Osedea docs by similarity of embeddings.
+
+    The matrix is rebuilt when a document changes, but the chunks with the same text
+    keep their vector: only the new chunks are embedded again.
+    """
+
+    def __init__(self, index_dir: str, docs_dir: str, embedder: Embedder, base_url: str = ""):
+        self.index_dir = index_dir
+        """Where the index files are"""
+        self.docs_dir = docs_dir
+        """The directory of the documents to index"""
+        self.embedder = embedder
+        """The embedder of the documents and of the queries"""
+        self.base_url = base_url
+        """The URL of a document is the base URL followed by its path without extension"""
+        self._lock = threading.Lock()
+        self._meta: dict = {}
+        self._vectors: np.ndarray | None = None
+        self._ivf: tuple[np.ndarray, np.ndarray, np.ndarray] | None = None
+        self._text = None
+        os.makedirs(index_dir, exist_ok=True)
+        self._load()
+
+    def update(self, rebuild: bool = False) -> int:
+        """
+        Embed the documents again if they changed since the last update (or the embedder did).
+
+        Return the number of chunks embedded.
+        """
+        files = list_documents(self.docs_dir)
+        with self._lock:
+            meta, vectors = self._meta, self._vectors
+        same_embedder = meta.get("embedder") == self.embedder.name
+        if same_embedder and meta.get("documents") == files and not rebuild:
+            return 0
+
+        start = time.perf_counter()
+        docs, chunks, texts = [], [], []
+        for path in sorted(files):
+            title, content = read_document(os.path.join(self.docs_dir, path))
+            docs.append({"path": path, "url": document_url(self.base_url, path), "title": title})
+            for passage in split_passages(content, VECTOR_CHUNK_TOKENS, estimate_tokens):
+                chunks.append(len(docs) - 1)
+                texts.append(passage)
+        hashes = [hashlib.sha1(text.encode()).hexdigest() for text in texts]
+
+        # The vectors of the chunks already embedded are copied from the current matrix
+        known = {}
+        if same_embedder and vectors is not None and not rebuild:
+            known = {h: row for row, h in enumerate(meta["hashes"])}
+        generation = meta.get("generation", 0) + 1
+        name = f"vectors-{generation}"
+        matrix = open_memmap(
+            os.path.join(self.index_dir, name + ".npy"),
+            mode="w+",
+            dtype=np.float32,
+            shape=(len(texts), self.embedder.dimension),
+        )
+        missing = []
+        for row, h in enumerate(hashes):
+            if h in known:
+                matrix[row] = vectors[known[h]]  # type: ignore[index]
+            else:
+                missing.append(row)
+        for i in range(0, len(missing), VECTOR_EMBED_BATCH):
+            rows = missing[i : i + VECTOR_EMBED_BATCH]
+            matrix[rows] = self.embedder.embed([texts[row] for row in rows])
+        matrix.flush()
+
+        text = bytearray()
+        offsets = []
+        for passage in texts:
+            encoded = passage.encode("utf-8")
+            offsets.append([len(text), len(encoded)])
+            text += encoded
+        write_atomic(os.path.join(self.index_dir, name + ".text"), bytes(text))
+
+        ivf = len(texts) >= VECTOR_IVF_MIN_CHUNKS
+        if ivf:
+            centroids, rows, list_offsets = build_ivf(matrix, int(np.sqrt(len(texts))))
+            np.savez(
+                os.path.join(self.index_dir, name + ".ivf.npz"),
+                centroids=centroids,
+                rows=rows,
+                offsets=list_offsets,
+            )
+        del matrix
+
+        write_atomic(
+            os.path.join(self.index_dir, META_NAME),
+            json.dumps(
+                {
+                    "embedder": self.embedder.name,
+                    "generation": generation,
+                    "documents": files,
+                    "docs": docs,
+                    "chunks": chunks,
+                    "text": offsets,
+                    "hashes": hashes,
+                    "ivf": ivf,
+                }
+            ).encode(),
+        )
+        self._load()
+        for file in os.listdir(self.index_dir):
+            if file.startswith("vectors-") and file.split(".")[0] != name:
+                os.remove(os.path.join(self.index_dir, file))
+        logging.info(
+            f"Vector index updated in {time.perf_counter() - start:.3f}s: "
+            f"{len(texts)} chunks, {len(missing)} embedded, IVF {'on' if ivf else 'off'}."
+        )
+        return len(missing)
+
+    def search(self, queries: list[str], k: int = 3) -> list[list[IndexHit]]:
+        """
+        Return the k best documents for each query, embedded and searched together.
+
+        The score of a document is its best chunk (the cosine similarity, at least 0),
+        its content is made of its chunks among the best ones.
+        """
+        with self._lock:
+            meta, vectors, ivf, text = self._meta, self._vectors, self._ivf, self._text
+        if vectors is None or not len(vectors) or not queries:
+            return [[] for _ in queries]
+
+        embedded = self.embedder.embed(queries)
+        # More chunks than documents, several chunks can come from the same document
+        chunk_count = min(len(vectors), k * 4)
+        if ivf is None:
+            best = self._search_all(vectors, embedded, chunk_count)
+        else:
+            best = self._search_ivf(vectors, ivf, embedded, chunk_count)
+
+        results = []
+        for scores, rows in best:
+            by_document: dict[int, list[tuple[int, float]]] = {}
+            for score, row in zip(scores.tolist(), rows.tolist()):
+                by_document.setdefault(meta["chunks"][row], []).append((row, score))
+            ranking = sorted(
+                by_document.items(), key=lambda item: -max(score for _, score in item[1])
+            )
+            hits = []
+            for doc, doc_chunks in ranking[:k]:
+                content = "\n\n".join(
+                    text[start : start + length].decode("utf-8")  # type: ignore[index]
+                    for start, length in (meta["text"][row] for row, _ in sorted(doc_chunks))
+                )
+                hits.append(
+                    IndexHit(
+                        path=meta["docs"][doc]["path"],
+                        url=meta["docs"][doc]["url"],
+                        title=meta["docs"][doc]["title"],
+                        content=content,
+                        score=max(0.0, max(score for _, score in doc_chunks)),
+                    )
+                )
+            results.append(hits)
+        return results
+
+    def stats(self) -> dict:
+        """The size of the index"""
+        with self._lock:
+            return {
+                "chunks": 0 if self._vectors is None else len(self._vectors),
+                "documents": len(self._meta.get("docs", [])),
+                "ivf": self._ivf is not None,
+            }
+
+    @staticmethod
+    def _search_all(vectors: np.ndarray, queries: np.ndarray, k: int) -> list:
+        """Compare the queries with every chunk, by blocks of rows"""
+        best = [(np.empty(0, np.float32), np.empty(0, np.int64)) for _ in queries]
+        for start in range(0, len(vectors), VECTOR_BLOCK_ROWS):
+            block = vectors[start : start + VECTOR_BLOCK_ROWS] @ queries.T
+            ids = np.arange(start, start + len(block))
+            for j, (scores, rows) in enumerate(best):
+                best[j] = top_k(
+                    np.concatenate([scores, block[:, j]]), np.concatenate([rows, ids]), k
+                )
+        return best
+
+    @staticmethod
+    def _search_ivf(vectors: np.ndarray, ivf: tuple, queries: np.ndarray, k: int) -> list:
+        """Compare each query with the chunks of its closest clusters only"""
+        centroids, rows, offsets = ivf
+        probes = min(VECTOR_IVF_PROBES, len(centroids))
+        closest = np.argsort(-(queries @ centroids.T), axis=1)[:, :probes]
+        best = []
+        for j, clusters in enumerate(closest):
+            # Sorted rows, the memory-mapped matrix is read in order
+            candidates = np.sort(
+                np.concatenate([rows[offsets[c] : offsets[c + 1]] for c in clusters])
+            )
+            best.append(top_k(vectors[candidates] @ queries[j], candidates, k))
+        return best
+
+    def _load(self) -> None:
+        path = os.path.join(self.index_dir, META_NAME)
+        if not os.path.exists(path):
+            return
+        with open(path) as f:
+            meta = json.load(f)
+        base = os.path.join(self.index_dir, f"vectors-{meta['generation']}")
+        vectors = np.load(base + ".npy", mmap_mode="r")
+        ivf = None
+        if meta["ivf"]:
+            with np.load(base + ".ivf.npz") as data:
+                ivf = (data["centroids"], data["rows"], data["offsets"])
+        text = map_file(base + ".text")
+        with self._lock:
+            self._meta, self._vectors, self._ivf, self._text = meta, vectors, ivf, text
+
+
+if __name__ == "__main__":
+    from main import OSEDEA_DOCS_DIR, OSEDEA_DOCS_URL, OSEDEA_EMBEDDER, OSEDEA_VECTOR_INDEX_DIR
+
+    from embeddings import make_embedder
+
+    parser = argparse.ArgumentParser(description="Embed the Osedea docs.")
+    parser.add_argument("queries", nargs="*", help="Search the index after the update")
+    parser.add_argument("--rebuild", action="store_true", help="Embed every chunk again")
+    args = parser.parse_args()
+
+    index = VectorIndex(
+        OSEDEA_VECTOR_INDEX_DIR, OSEDEA_DOCS_DIR, make_embedder(OSEDEA_EMBEDDER), OSEDEA_DOCS_URL
+    )
+    index.update(rebuild=args.rebuild)
+    logging.info(f"Vector index: {index.stats()}")
+    if args.queries:
+        start = time.perf_counter()
+        results = index.search(args.queries)
+        logging.info(f"Search done in {(time.perf_counter() - start) * 1000:.3f}ms.")
+        for query, hits in zip(args.queries, results):
+            print(query)
+            for hit in hits:
+                print(f"  {hit.score:.3f} {hit.title} ({hit.url})")
@@ -0,0 +1,301 @@
+import asyncio
+import json
+import logging
+import os
+import sqlite3
+import threading
+import time
+import zlib
+
+import aiohttp
+from langchain_core.documents import Document
+from langchain_community.utilities.wikipedia import (
+    WIKIPEDIA_MAX_QUERY_LENGTH,
+    WikipediaAPIWrapper,
+)
+from search_cache import normalize_question
+
+WIKIPEDIA_API_URL = "https://en.wikipedia.org/w/api.php"
+"""The MediaWiki API used by the async client, the same as the wikipedia package"""
+WIKIPEDIA_USER_AGENT = "osedea-workshop-langgraph-langfuse"
+
+
+class WikipediaPageCache:
+    """
+    Cache in front of the Wikipedia API, storing each page only once.
+
+    Three tables are kept:
+    - pages: the Document of each page, keyed by the resolved page title (after the redirects),
+    - redirects: the resolved title of the titles redirected to another page,
+    - queries: the page titles returned by a search, keyed by the normalized query.
+
+    Many queries can point to the same pages, so a new query resolving to pages
+    already in hand only costs the (small) search call, not the page downloads.
+    A repeated query costs no network call at all.
+    A query without any page is kept for negative_ttl only: the search may find pages later.
+    """
+
+    def __init__(
+        self,
+        path: str = ":memory:",
+        ttl: float | None = None,
+        negative_ttl: float | None = 10 * 60,
+        compress: bool = True,
+        doc_content_chars_max: int = 4000,
+    ):
+        self.ttl = ttl
+        """Time to live of the pages and queries in seconds. If None, entries never expire."""
+        self.negative_ttl = negative_ttl
+        """Time to live of the queries without any page, in seconds. If None, the same as ttl."""
+        self.compress = compress
+        """Compress the pages with zlib before storing them"""
+        self.doc_content_chars_max = doc_content_chars_max
+        """The maximum number of characters kept from a page, as in WikipediaLoader"""
+        self.query_hits = 0
+        """Number of queries answered without any network call"""
+        self.page_hits = 0
+        """Number of pages reused from the cache"""
+        self.page_misses = 0
+        """Number of pages downloaded from Wikipedia"""
+        self._lock = threading.Lock()
+        self._wrapper = WikipediaAPIWrapper(  # type: ignore[call-arg]
+            doc_content_chars_max=doc_content_chars_max
+        )
+        if path != ":memory:" and os.path.dirname(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+        self._connection = sqlite3.connect(path, check_same_thread=False)
+        self._connection.executescript(
+            "CREATE TABLE IF NOT EXISTS pages ("
+            " title TEXT PRIMARY KEY,"
+            " document BLOB NOT NULL,"
+            " compressed INTEGER NOT NULL,"
+            " fetched_at REAL NOT NULL);"
+            "CREATE TABLE IF NOT EXISTS redirects ("
+            " title TEXT PRIMARY KEY,"
+            " resolved TEXT NOT NULL);"
+            "CREATE TABLE IF NOT EXISTS queries ("
+            " query TEXT NOT NULL,"
+            " load_max_docs INTEGER NOT NULL,"
+            " titles TEXT NOT NULL,"
+            " created_at REAL NOT NULL,"
+            " PRIMARY KEY (query, load_max_docs));"
+        )
+        self._connection.commit()
+
+    def load(self, query: str, load_max_docs: int = 2) -> list[Document]:
+        """Same result as WikipediaLoader(query, load_max_docs).load(), from cache when possible"""
+        documents = self._load_cached_query(query, load_max_docs)
+        if documents is not None:
+            return documents
+
+        titles = self._wrapper.wiki_client.search(
+            query[:WIKIPEDIA_MAX_QUERY_LENGTH], results=load_max_docs
+        )[:load_max_docs]
+        fetched = {
+            title: self._fetch_page(title)
+            for title in titles
+            if self._cached_page(title) is None
+        }
+        return self._store_query(query, load_max_docs, titles, fetched)
+
+    async def aload(self, query: str, load_max_docs: int = 2) -> list[Document]:
+        """Async version of load, the missing pages are downloaded concurrently"""
+        documents = self._load_cached_query(query, load_max_docs)
+        if documents is not None:
+            return documents
+
+        async with aiohttp.ClientSession(
+            headers={"User-Agent": WIKIPEDIA_USER_AGENT}
+        ) as session:
+            titles = await self._asearch(session, query, load_max_docs)
+            missing = [title for title in titles if self._cached_page(title) is None]
+            pages = await asyncio.gather(
+                *(self._afetch_page(session, title) for title in missing)
+            )
+        return self._store_query(query, load_max_docs, titles, dict(zip(missing, pages)))
+
+    def stats(self) -> dict:
+        """Counters to see how many network calls the cache saved"""
+        return {
+            "query_hits": self.query_hits,
+            "page_hits": self.page_hits,
+            "page_misses": self.page_misses,
+        }
+
+    def _is_expired(self, created_at: float, ttl: float | None) -> bool:
+        return ttl is not None and time.time() - created_at > ttl
+
+    def _load_cached_query(self, query: str, load_max_docs: int) -> list[Document] | None:
+        """Return the documents of an already seen query, if all its pages are still cached"""
+        titles = self._cached_titles(normalize_question(query), load_max_docs)
+        if titles is None:
+            return None
+        documents = [self._cached_page(title) for title in titles]
+        if any(document is None for document in documents):
+            return None
+        with self._lock:
+            self.query_hits += 1
+            self.page_hits += len(documents)
+        logging.info(f"Wikipedia pages found in cache for the query: {query}")
+        return documents  # type: ignore[return-value]
+
+    def _store_query(
+        self,
+        query: str,
+        load_max_docs: int,
+        titles: list[str],
+        fetched: dict[str, tuple[str, Document] | None],
+    ) -> list[Document]:
+        """Store the fetched pages and the titles of the query, return the documents in search order"""
+        documents = []
+        for title in titles:
+            if title in fetched:
+                if fetched[title] is None:
+                    continue
+                resolved, document = fetched[title]  # type: ignore[misc]
+                with self._lock:
+                    self.page_misses += 1
+                self._store_page(title, resolved, document)
+            else:
+                document = self._cached_page(title)
+                if document is None:
+                    continue
+                with self._lock:
+                    self.page_hits += 1
+            documents.append(document)
+
+        self._store_titles(
+            normalize_question(query),
+            load_max_docs,
+            [document.metadata["title"] for document in documents],
+        )
+        return documents
+
+    def _fetch_page(self, title: str) -> tuple[str, Document] | None:
+        """The resolved title of the page and its Document, None if there is no such page"""
+        client = self._wrapper.wiki_client
+        try:
+            page = client.page(title=title, auto_suggest=False)
+        except (client.exceptions.PageError, client.exceptions.DisambiguationError):
+            return None
+        return page.title, Document(
+            page_content=page.content[: self.doc_content_chars_max],
+            metadata={"title": title, "summary": page.summary, "source": page.url},
+        )
+
+    async def _asearch(
+        self, session: aiohttp.ClientSession, query: str, load_max_docs: int
+    ) -> list[str]:
+        params = {
+            "action": "query",
+            "format": "json",
+            "list": "search",
+            "srprop": "",
+            "srlimit": load_max_docs,
+            "srsearch": query[:WIKIPEDIA_MAX_QUERY_LENGTH],
+        }
+        async with session.get(WIKIPEDIA_API_URL, params=params) as response:
+            response.raise_for_status()
+            data = await response.json()
+        return [result["title"] for result in data["query"]["search"]][:load_max_docs]
+
+    async def _afetch_page(
+        self, session: aiohttp.ClientSession, title: str
+    ) -> tuple[str, Document] | None:
+        params = {
+            "action": "query",
+            "format": "json",
+            "prop": "extracts|info|pageprops",
+            "explaintext": "",
+            "inprop": "url",
+            "ppprop": "disambiguation",
+            "redirects": "",
+            "titles": title,
+        }
+        async with session.get(WIKIPEDIA_API_URL, params=params) as response:
+            response.raise_for_status()
+            data = await response.json()
+        page = next(iter(data["query"]["pages"].values()))
+        # Same as the PageError and DisambiguationError skipped by the sync client.
+        if "missing" in page or "disambiguation" in page.get("pageprops", {}):
+            return None
+        content = page.get("extract", "")
+        return page["title"], Document(
+            page_content=content[: self.doc_content_chars_max],
+            metadata={
+                "title": title,
+                # The summary is the introduction, before the first section.
+                "summary": content.split("\n\n\n==")[0].strip(),
+                "source": page["fullurl"],
+            },
+        )
+
+    def _cached_titles(self, key: str, load_max_docs: int) -> list[str] | None:
+        with self._lock:
+            row = self._connection.execute(
+                "SELECT titles, created_at FROM queries WHERE query = ? AND load_max_docs = ?",
+                (key, load_max_docs),
+            ).fetchone()
+        if row is None:
+            return None
+        titles = json.loads(row[0])
+        ttl = self.ttl if titles or self.negative_ttl is None else self.negative_ttl
+        if self._is_expired(row[1], ttl):
+            return None
+        return titles
+
+    def _store_titles(self, key: str, load_max_docs: int, titles: list[str]) -> None:
+        with self._lock:
+            self._connection.execute(
+                "INSERT OR REPLACE INTO queries VALUES (?, ?, ?, ?)",
+                (key, load_max_docs, json.dumps(titles), time.time()),
+            )
+            self._connection.commit()
+
+    def _cached_page(self, title: str) -> Document | None:
+        with self._lock:
+            row = self._connection.execute(
+                "SELECT document, compressed, fetched_at FROM pages WHERE title ="
+                " COALESCE((SELECT resolved FROM redirects WHERE title = ?), ?)",
+                (title, title),
+            ).fetchone()
+        if row is None or self._is_expired(row[2], self.ttl):
+            return None
+        data = zlib.decompress(row[0]) if row[1] else row[0]
+        document = Document(**json.loads(data))
+        # As returned for this title, the page may have been fetched under another one
+        document.metadata["title"] = title
+        return document
+
+    def _store_page(self, title: str, resolved: str, document: Document) -> None:
+        data = json.dumps(
+            {"page_content": document.page_content, "metadata": document.metadata}
+        ).encode()
+        if self.compress:
+            data = zlib.compress(data)
+        with self._lock:
+            self._connection.execute(
+                "INSERT OR REPLACE INTO pages VALUES (?, ?, ?, ?)",
+                (resolved, data, int(self.compress), time.time()),
+            )
+            if resolved != title:
+                self._connection.execute(
+                    "INSERT OR REPLACE INTO redirects VALUES (?, ?)", (title, resolved)
+                )
+            if self.ttl is not None:
+                expired_before = time.time() - self.ttl
+                self._connection.execute(
+                    "DELETE FROM pages WHERE fetched_at < ?", (expired_before,)
+                )
+                self._connection.execute(
+                    "DELETE FROM queries WHERE created_at < ?", (expired_before,)
+                )
+                self._connection.execute(
+                    "DELETE FROM redirects WHERE resolved NOT IN (SELECT title FROM pages)"
+                )
+            if self.negative_ttl is not None:
+                self._connection.execute(
+                    "DELETE FROM queries WHERE titles = '[]' AND created_at < ?",
+                    (time.time() - self.negative_ttl,),
+                )
+            self._connection.commit()